@@ -0,0 +1,205 @@
+"""
+End-to-end pipeline benchmark on synthetic movies with known ROIs and motion.
+
+Times each stage (tiff_to_binary, register_binary, detect, create_masks_and_extract, oasis, classify)
+and reports throughput and peak memory for every combination of frame size, frame count and ROI count:
+
+    python -m benchmarks.pipeline --Ly 256 512 --nframes 2000 --n_rois 100 400 --out results.json
+"""
+import argparse
+import json
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from itertools import product
+from pathlib import Path
+from typing import NamedTuple
+
+import numpy as np
+from tifffile import imwrite
+
+import suite2p
+from suite2p import classification, detection, extraction, io, profiling, registration
+
+
+class StageResult(NamedTuple):
+    stage: str
+    time: float
+    fps: float
+    rois_per_s: float
+    peak_rss_mb: float
+
+
+def make_synthetic_movie(nframes=1000, Ly=256, Lx=256, n_rois=100, diameter=10, max_shift=5,
+                         fs=30., tau=1., baseline=500., seed=0):
+    """
+    Generates a calcium-imaging movie of n_rois gaussian somata with sparse exponentially decaying
+    transients on a neuropil background, rigidly shifted by a random walk of at most max_shift pixels.
+
+    Returns
+    -------
+    mov : int16 array
+        size [nframes x Ly x Lx]
+    rois : float32 array
+        size [n_rois x 2], y and x centers of the ROIs (in the unshifted frame)
+    yshifts, xshifts : int arrays
+        size [nframes], shifts applied to each frame
+    """
+    rs = np.random.RandomState(seed)
+    pad = max_shift
+    Lyp, Lxp = Ly + 2 * pad, Lx + 2 * pad
+    rois = np.stack([rs.uniform(diameter, Ly - diameter, n_rois), rs.uniform(diameter, Lx - diameter, n_rois)], axis=1)
+    yy, xx = np.meshgrid(np.arange(Lyp) - pad, np.arange(Lxp) - pad, indexing='ij')
+    sig = diameter / 4
+    footprints = np.exp(-((yy[None] - rois[:, 0, None, None])**2 + (xx[None] - rois[:, 1, None, None])**2) / (2 * sig**2))
+    footprints = footprints.reshape(n_rois, -1).astype(np.float32)
+
+    spikes = (rs.rand(nframes, n_rois) < 0.02).astype(np.float32) * rs.uniform(0.5, 2., (nframes, n_rois)).astype(np.float32)
+    decay = np.exp(-1. / (tau * fs))
+    traces = np.zeros_like(spikes)
+    for t in range(nframes):
+        traces[t] = spikes[t] + (decay * traces[t - 1] if t > 0 else 0)
+
+    walk = np.cumsum(rs.randint(-1, 2, (nframes, 2)), axis=0)
+    yshifts, xshifts = np.clip(walk, -max_shift, max_shift).T
+    neuropil = 0.3 * baseline * (1 + 0.1 * np.sin(np.linspace(0, 20 * np.pi, nframes)))
+
+    mov = np.zeros((nframes, Ly, Lx), np.int16)
+    for t0 in range(0, nframes, 500):
+        t1 = min(t0 + 500, nframes)
+        frames = baseline * (1 + traces[t0:t1] @ footprints).reshape(t1 - t0, Lyp, Lxp) + neuropil[t0:t1, None, None]
+        frames += rs.randn(*frames.shape).astype(np.float32) * np.sqrt(baseline)
+        for t in range(t0, t1):
+            y0, x0 = pad - yshifts[t], pad - xshifts[t]
+            mov[t] = np.clip(frames[t - t0, y0:y0 + Ly, x0:x0 + Lx], 0, 2**15 - 1)
+    return mov, rois.astype(np.float32), yshifts, xshifts
+
+
+def current_rss():
+    """ resident set size of this process in bytes (its high-water mark where it cannot be read) """
+    return profiling._rss() or profiling._peak_rss()
+
+
+@contextmanager
+def peak_memory(interval=0.01):
+    """ samples the RSS of this process in a background thread, yields a dict whose 'peak' is set on exit """
+    result = {'peak': current_rss()}
+    done = threading.Event()
+
+    def sample():
+        while not done.wait(interval):
+            result['peak'] = max(result['peak'], current_rss())
+
+    thread = threading.Thread(target=sample, daemon=True)
+    thread.start()
+    try:
+        yield result
+    finally:
+        done.set()
+        thread.join()
+        result['peak'] = max(result['peak'], current_rss())
+
+
+def benchmark_ops(data_path, save_path0, **kwargs):
+    ops = suite2p.default_ops()
+    ops.update({
+        'data_path': [str(data_path)],
+        'save_path0': str(save_path0),
+        'use_builtin_classifier': True,
+        'do_regmetrics': False,
+    })
+    ops.update(kwargs)
+    return ops
+
+
+def run_pipeline(nframes=1000, Ly=256, Lx=256, n_rois=100, workdir=None, **ops_kwargs):
+    """ runs every pipeline stage on a synthetic movie and returns a list of StageResults """
+    with tempfile.TemporaryDirectory(dir=workdir) as tmpdir:
+        mov, rois, _, _ = make_synthetic_movie(nframes=nframes, Ly=Ly, Lx=Lx, n_rois=n_rois)
+        data_path = Path(tmpdir).joinpath('tiffs')
+        data_path.mkdir()
+        imwrite(data_path.joinpath('movie.tif'), mov)
+        del mov
+        ops = benchmark_ops(data_path, Path(tmpdir).joinpath('results'), **ops_kwargs)
+        classfile = classification.builtin_classfile
+
+        results = []
+        state = {'stat': None, 'F': None, 'dF': None}
+
+        def stage(name, func, count=None):
+            with peak_memory() as mem:
+                t0 = time.time()
+                func()
+                dt = time.time() - t0
+            n = count() if count is not None else 0
+            results.append(StageResult(stage=name, time=dt, fps=nframes / dt, rois_per_s=n / dt,
+                                       peak_rss_mb=mem['peak'] / 2**20))
+
+        def to_binary():
+            state['ops'] = io.tiff_to_binary(ops)
+
+        def register():
+            state['ops'] = registration.register_binary(state['ops'])
+
+        def detect():
+            state['ops'], state['stat'] = detection.detect(state['ops'], classfile=classfile)
+
+        def extract():
+            state['ops'], state['stat'], state['F'], state['Fneu'], _, _ = extraction.create_masks_and_extract(
+                state['ops'], state['stat'])
+
+        def deconvolve():
+            o = state['ops']
+            dF = extraction.preprocess(F=state['F'] - o['neucoeff'] * state['Fneu'], baseline=o['baseline'],
+                                       win_baseline=o['win_baseline'], sig_baseline=o['sig_baseline'],
+                                       fs=o['fs'], prctile_baseline=o['prctile_baseline'])
+            extraction.oasis(F=dF, batch_size=o['batch_size'], tau=o['tau'], fs=o['fs'])
+
+        def classify():
+            classification.classify(stat=state['stat'], classfile=classfile)
+
+        found = lambda: len(state['stat'])
+        stage('tiff_to_binary', to_binary)
+        stage('register_binary', register)
+        stage('detect', detect, found)
+        stage('create_masks_and_extract', extract, found)
+        stage('oasis', deconvolve, found)
+        stage('classify', classify, found)
+        print('found %d ROIs (%d simulated)' % (found(), n_rois))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description='suite2p pipeline benchmark on synthetic data')
+    parser.add_argument('--Ly', default=[256], type=int, nargs='+', help='frame heights')
+    parser.add_argument('--Lx', default=None, type=int, nargs='+', help='frame widths (default Ly)')
+    parser.add_argument('--nframes', default=[1000], type=int, nargs='+', help='frame counts')
+    parser.add_argument('--n_rois', default=[100], type=int, nargs='+', help='simulated ROI counts')
+    parser.add_argument('--workdir', default=None, type=str, help='directory for temporary files')
+    parser.add_argument('--out', default=None, type=str, help='save results as json')
+    parser.add_argument('--no_warmup', action='store_true', help='include numba compilation in the first timings')
+    args = parser.parse_args()
+
+    if not args.no_warmup:
+        # compile the numba functions on a small movie so that they are not timed
+        run_pipeline(nframes=300, Ly=96, Lx=96, n_rois=20, workdir=args.workdir)
+
+    Lxs = args.Lx if args.Lx is not None else [None]
+    all_results = []
+    for Ly, Lx, nframes, n_rois in product(args.Ly, Lxs, args.nframes, args.n_rois):
+        Lx = Ly if Lx is None else Lx
+        results = run_pipeline(nframes=nframes, Ly=Ly, Lx=Lx, n_rois=n_rois, workdir=args.workdir)
+        print(f'\nLy={Ly} Lx={Lx} nframes={nframes} n_rois={n_rois}')
+        print(f'{"stage":<26}{"time (s)":>10}{"frames/s":>12}{"ROIs/s":>12}{"peak RSS (MB)":>16}')
+        for r in results:
+            print(f'{r.stage:<26}{r.time:>10.2f}{r.fps:>12.1f}{r.rois_per_s:>12.1f}{r.peak_rss_mb:>16.1f}')
+        all_results.extend([dict(Ly=Ly, Lx=Lx, nframes=nframes, n_rois=n_rois, **r._asdict()) for r in results])
+
+    if args.out is not None:
+        with open(args.out, 'w') as f:
+            json.dump(all_results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
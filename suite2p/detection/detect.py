@@ -6,7 +6,8 @@ from typing import Dict, Any
 from . import sourcery, sparsedetect, chan2detect, utils
 from .stats import roi_stats
 # from .denoise import pca_denoise
-from ..io.binary import BinaryFile
+from .. import profiling
+from ..registration.register import open_registered
 from ..classification import classify, user_classfile
 
 # try:
@@ -31,12 +32,13 @@ def detect(ops, classfile=None):
     t0 = time.time()
     bin_size = int(max(1, ops['nframes'] // ops['nbinned'], np.round(ops['tau'] * ops['fs'])))
     print('Binning movie in chunks of length %2.2d' % bin_size)
-    with BinaryFile(read_filename=ops['reg_file'], Ly=ops['Ly'], Lx=ops['Lx']) as f:
+    with profiling.stage('bin_movie'), open_registered(ops) as f:
         mov = f.bin_movie(
             bin_size=bin_size,
             bad_frames=ops.get('badframes'),
             y_range=ops['yrange'],
             x_range=ops['xrange'],
+            cache=ops.get('bin_cache', False),
         )
     print('Binned movie [%d,%d,%d] in %0.2f sec.' % (mov.shape[0], mov.shape[1], mov.shape[2], time.time() - t0))
     if ops.get('inverted_activity', False):
@@ -65,18 +67,19 @@ def detect(ops, classfile=None):
                     diameter=ops['diameter'])
         
     else:            
-        stat = select_rois(
-            ops=ops,
-            mov=mov,
-            dy=dy,
-            dx=dx,
-            Ly=ops['Ly'],
-            Lx=ops['Lx'],
-            max_overlap=ops['max_overlap'],
-            sparse_mode=ops['sparse_mode'],
-            do_crop=ops['soma_crop'],
-            classfile=classfile,
-        )
+        with profiling.stage('select_rois'):
+            stat = select_rois(
+                ops=ops,
+                mov=mov,
+                dy=dy,
+                dx=dx,
+                Ly=ops['Ly'],
+                Lx=ops['Lx'],
+                max_overlap=ops['max_overlap'],
+                sparse_mode=ops['sparse_mode'],
+                do_crop=ops['soma_crop'],
+                classfile=classfile,
+            )
 
     # if second channel, detect bright cells in second channel
     if 'meanImg_chan2' in ops:
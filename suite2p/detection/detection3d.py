@@ -1,6 +1,6 @@
 from dask_image.ndfilters import uniform_filter as dask_uniform_filter
-import cProfile
-from ..suite3d import utils as utils3d
+from .. import shmem_utils
+from .. import profiling
 from ctypes import util
 from http.client import MOVED_PERMANENTLY
 import multiprocessing
@@ -50,14 +50,14 @@ def standard_deviation_over_time(mov: np.ndarray, batch_size: int,sqrt=True, das
     # return frame - frame / c1
 def npsub_worker(mov_params, idxs, filt_size, mode, c1):
     print("RUNNING idxs: %s" % str(idxs))
-    cp = cProfile.Profile()
-    cp.enable()
-    shmem, mov = utils3d.load_shmem(mov_params)
-    for idx in idxs:
-        # mov[idx] = mov[idx] - (uniform_filter(mov[idx], size=filt_size, mode = mode) / c1)
-        mov[idx] = mov[idx] - mov[idx] / c1
-    cp.disable()
-    cp.print_stats(sort='cumtime')
+    # recorded only if a profiler is active in this process
+    with profiling.stage('npsub_worker', n_frames=len(idxs)):
+        shmem, mov = shmem_utils.load_shmem(mov_params)
+        for idx in idxs:
+            # mov[idx] = mov[idx] - (uniform_filter(mov[idx], size=filt_size, mode = mode) / c1)
+            mov[idx] = mov[idx] - mov[idx] / c1
+        del mov
+        shmem.close()
 
 def neuropil_subtraction(mov: np.ndarray, filter_size: int, filter_size_z: int, mode='constant') -> None:
     """Returns movie subtracted by a low-pass filtered version of itself to help ignore neuropil."""
@@ -149,35 +149,37 @@ def get_vmap3d(movu0,intensity_threshold=None, fix_edges=True, sqrt=True,mean_su
     return vmap
 
 def get_vmap3d_shmem_w(shmem_in, shmem_vmap, z_idx, intensity_threshold, fix_edges, sqrt):
-    shin, mov_in = utils3d.load_shmem(shmem_in)
-    shvmap, vmap_z = utils3d.load_shmem(shmem_vmap)
+    shin, mov_in = shmem_utils.load_shmem(shmem_in)
+    shvmap, vmap_z = shmem_utils.load_shmem(shmem_vmap)
 
     vmap_z[z_idx] = threshold_reduce(
         mov_in[:, z_idx], intensity_threshold, fix_edges, sqrt)
+    del mov_in, vmap_z
+    shin.close(); shvmap.close()
 
-def get_vmap3d_shmem(shmem_in, shmem_vmap, intensity_threshold=None, fix_edges=True, sqrt=True, n_proc=15, pool=None):
+def get_vmap3d_shmem(shmem_in, shmem_vmap, intensity_threshold=None, fix_edges=True, sqrt=True, n_proc=None, pool=None):
     nt, nz, ny, nx = shmem_in['shape']
     if pool is None:
-        pool = multiprocessing.Pool(n_proc)
+        pool = shmem_utils.get_pool(n_proc)
     pool.starmap(get_vmap3d_shmem_w, [(shmem_in, shmem_vmap, z_idx, intensity_threshold, fix_edges, sqrt) for z_idx in range(nz)])
 
 def np_sub_and_conv3d_shmem_w(in_par, idxs, np_filt_size,conv_filt_size, c1, np_filt, conv_filt):
-    shin, mov_in = utils3d.load_shmem(in_par)
+    shin, mov_in = shmem_utils.load_shmem(in_par)
     for idx in idxs:
         mov_in[idx] = mov_in[idx] - \
             (np_filt(mov_in[idx], size=np_filt_size, mode='constant') / c1)
         mov_in[idx] = conv_filt(mov_in[idx], size=conv_filt_size, mode='constant')
+    del mov_in
+    shin.close()
 
-def np_sub_and_conv3d_shmem(shmem_in, np_filt_size, conv_filt_size, n_proc=8, batch_size=50, pool=None,
+def np_sub_and_conv3d_shmem(shmem_in, np_filt_size, conv_filt_size, n_proc=None, batch_size=50, pool=None,
                             np_filt_type = 'unif', conv_filt_type = 'unif'):
     """
-    WARNING: this is not optimal because the process startup time is quite long for each process
-    seems like this is because each subprocess imports suite2p, which takes about 1-2 seconds
-    this should all be in parallel, but in reality it causes memory bottlenecks so lasts about ~10 seconsds
-    so if you have a mp.pool().starmap() that does nothing, it takes 10 seconds to run
-    this is because windows does not have forking and python uses the "spawn" start method
+    process startup is slow (each subprocess imports suite2p, which takes about 1-2 seconds,
+    since windows does not have forking and python uses the "spawn" start method)
     https://docs.python.org/3/library/multiprocessing.html#contexts-and-start-methods
-    in the future: either maintain the same processes for the whole thing, or figure out something else
+    so if pool is None, the long-lived pool from shmem_utils.get_pool is used and the
+    processes are only started on the first call
     """
     nt, Lz, Ly, Lx = shmem_in['shape']
     if np_filt_type == 'unif': np_filt = uniform_filter
@@ -190,27 +192,23 @@ def np_sub_and_conv3d_shmem(shmem_in, np_filt_size, conv_filt_size, n_proc=8, ba
 
     batches = [n.arange(idx, min(nt, idx+batch_size))
                for idx in n.arange(0, nt, batch_size)]
-    close = True
     if pool is None:
-        pool = multiprocessing.Pool(n_proc)
-        close=False
+        pool = shmem_utils.get_pool(n_proc)
     pool.starmap(np_sub_and_conv3d_shmem_w, [
                  (shmem_in, b, np_filt_size, conv_filt_size, c1, np_filt, conv_filt) for b in batches])
-    if close:
-        pool.close()
-        pool.terminate()
 
 
 def np_sub_and_conv3d_split_shmem_w(sub_par, filt_par, idxs, np_filt_size, conv_filt_size, c1, c2, np_filt, conv_filt):
-    sub_sh, mov_sub = utils3d.load_shmem(sub_par)
-    filt_sh,   mov_filt = utils3d.load_shmem(filt_par)
+    sub_sh, mov_sub = shmem_utils.load_shmem(sub_par)
+    filt_sh,   mov_filt = shmem_utils.load_shmem(filt_par)
     for idx in idxs:
         mov_sub[idx] = mov_sub[idx] - \
             (np_filt(mov_sub[idx], np_filt_size, mode='constant') / c1)
         mov_filt[idx] = conv_filt_size[-1] * conv_filt(mov_sub[idx], conv_filt_size, mode='constant') #/ c2
+    del mov_sub, mov_filt
     sub_sh.close(); filt_sh.close()
 
-def np_sub_and_conv3d_split_shmem(shmem_sub, shmem_filt, np_filt_size, conv_filt_size, n_proc=8, batch_size=50, pool=None, np_filt_type='unif', conv_filt_type='unif'):
+def np_sub_and_conv3d_split_shmem(shmem_sub, shmem_filt, np_filt_size, conv_filt_size, n_proc=None, batch_size=50, pool=None, np_filt_type='unif', conv_filt_type='unif'):
     nt, Lz, Ly, Lx = shmem_sub['shape']
     if np_filt_type == 'unif': np_filt = uniform_filter
     elif np_filt_type == 'gaussian' : np_filt = gaussian_filter
@@ -223,52 +221,42 @@ def np_sub_and_conv3d_split_shmem(shmem_sub, shmem_filt, np_filt_size, conv_filt
 
     batches = [n.arange(idx, min(nt, idx+batch_size))
                for idx in n.arange(0, nt, batch_size)]
-    close = True
     if pool is None:
-        pool = multiprocessing.Pool(n_proc)
-        close=False
+        pool = shmem_utils.get_pool(n_proc)
     # print(batches)
     pool.starmap(np_sub_and_conv3d_split_shmem_w, [
                  (shmem_sub, shmem_filt, b.astype(int), np_filt_size, conv_filt_size, c1, c2, np_filt, conv_filt) for b in batches])
-    if close:
-        pool.close()
-        pool.terminate()
 
 
 
 def np_sub_shmem_w(in_par, idxs, np_filt_size, c1):
-    shin, mov_in = utils3d.load_shmem(in_par)
+    shin, mov_in = shmem_utils.load_shmem(in_par)
     for idx in idxs:
         mov_in[idx] = mov_in[idx] - \
             (uniform_filter(mov_in[idx],
              size=np_filt_size, mode='constant') / c1)
+    del mov_in
+    shin.close()
 
 
 
-def np_sub_shmem(shmem_in, np_filt_size, n_proc=8, batch_size=50, pool=None):
+def np_sub_shmem(shmem_in, np_filt_size, n_proc=None, batch_size=50, pool=None):
     """
-    WARNING: this is not optimal because the process startup time is quite long for each process
-    seems like this is because each subprocess imports suite2p, which takes about 1-2 seconds
-    this should all be in parallel, but in reality it causes memory bottlenecks so lasts about ~10 seconsds
-    so if you have a mp.pool().starmap() that does nothing, it takes 10 seconds to run
-    this is because windows does not have forking and python uses the "spawn" start method
+    process startup is slow (each subprocess imports suite2p, which takes about 1-2 seconds,
+    since windows does not have forking and python uses the "spawn" start method)
     https://docs.python.org/3/library/multiprocessing.html#contexts-and-start-methods
-    in the future: either maintain the same processes for the whole thing, or figure out something else
+    so if pool is None, the long-lived pool from shmem_utils.get_pool is used and the
+    processes are only started on the first call
     """
     nt, Lz, Ly, Lx = shmem_in['shape']
     c1 = uniform_filter(n.ones((Lz, Ly, Lx)), np_filt_size, mode='constant')
 
     batches = [n.arange(idx, min(nt, idx+batch_size))
                for idx in n.arange(0, nt, batch_size)]
-    close = True
     if pool is None:
-        pool = multiprocessing.Pool(n_proc)
-        close = False
+        pool = shmem_utils.get_pool(n_proc)
     pool.starmap(np_sub_shmem_w, [
                  (shmem_in, b, np_filt_size, c1) for b in batches])
-    if close:
-        pool.close()
-        pool.terminate()
 
 
 def square_convolution_2d(mov: np.ndarray, filter_size: int, filter_size_z: int) -> np.ndarray:
@@ -282,28 +270,28 @@ def square_convolution_2d(mov: np.ndarray, filter_size: int, filter_size_z: int)
 
 
 
-def hp_rolling_mean_filter_mp(shmem_par, width, nz, n_proc = 16):
-    pool = multiprocessing.Pool(n_proc)
+def hp_rolling_mean_filter_mp(shmem_par, width, nz, n_proc=None, pool=None):
+    if pool is None:
+        pool = shmem_utils.get_pool(n_proc)
     pool.starmap(hp_rolling_mean_filter_shmem_w, [(shmem_par, z_idx, width) for z_idx in range(nz)])
-    pool.close()
-    pool.terminate()
 
 import time
 def hp_rolling_mean_filter_shmem_w(shmem_par, z_idx, width) -> np.ndarray:
     if z_idx == 0:
         tic = time.time()
-    mov_sh, mov = utils3d.load_shmem(shmem_par)
+    mov_sh, mov = shmem_utils.load_shmem(shmem_par)
     if z_idx == 0: print(time.time() - tic)
     for i in range(0, mov.shape[0], width):
         mov[i:i + width, z_idx] -= mov[i:i + width, z_idx].mean(axis=0)
 
     if z_idx == 0:
         print(time.time() - tic)
+    del mov
     mov_sh.close()
 
 # def np_sub_shmem_w(in_par, out_par, idxs, size, c1):
-#     shin, mov_in = utils3d.load_shmem(in_par)
-#     shout, mov_out = utils3d.load_shmem(out_par)
+#     shin, mov_in = shmem_utils.load_shmem(in_par)
+#     shout, mov_out = shmem_utils.load_shmem(out_par)
 #     for idx in idxs:
 #         mov_out[idx] = mov_in[idx] - \
 #             (uniform_filter(mov_in[idx], size=size, mode='constant') / c1)
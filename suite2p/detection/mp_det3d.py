@@ -1,67 +1,63 @@
 import numpy as n
 import multiprocessing
 from scipy.ndimage import uniform_filter
-import cProfile
-from ..suite3d import utils as utils3d
+from .. import shmem_utils
+from .. import profiling
 
 def filtframe_shmem_w(in_par, out_par, idxs, size, c1):
-    shin, mov_in = utils3d.load_shmem(in_par)
-    shout, mov_out = utils3d.load_shmem(out_par)
+    shin, mov_in = shmem_utils.load_shmem(in_par)
+    shout, mov_out = shmem_utils.load_shmem(out_par)
     for idx in idxs:
         mov_out[idx] = mov_in[idx] - (uniform_filter(mov_in[idx], size=size, mode='constant') / c1)
+    del mov_in, mov_out
+    shin.close(); shout.close()
 
-def filtframe_shmem(mov, size, n_proc, batch_size=50):
+def filtframe_shmem(mov, size, n_proc=None, batch_size=50):
     nt, Lz, Ly, Lx = mov.shape
     c1 = uniform_filter(n.ones((Lz, Ly, Lx)), size, mode='constant')
-    shmem, shpar, shmov = utils3d.create_shmem_from_arr(mov, copy=True)
-    shmem_out, shpar_out, shmov_out = utils3d.create_shmem_from_arr(mov, copy=True)
+    shmem, shpar, shmov = shmem_utils.create_shmem_from_arr(mov, copy=True)
+    shmem_out, shpar_out, shmov_out = shmem_utils.create_shmem_from_arr(mov, copy=True)
 
     batches = [n.arange(idx, min(nt,idx+batch_size)) for idx in n.arange(0,nt, batch_size)]
-    pool = multiprocessing.Pool(n_proc)
+    pool = shmem_utils.get_pool(n_proc)
     pool.starmap(filtframe_shmem_w, [(shpar, shpar_out, b,size,c1) for b in batches])
+    movt = shmov_out.copy()
+    del shmov, shmov_out
+    shmem_utils.free_shmem(shmem); shmem_utils.free_shmem(shmem_out)
+    return movt
 
-def filtframe_shmem_2(shmem_in, shmem_out, size, n_proc, batch_size=50):
+def filtframe_shmem_2(shmem_in, shmem_out, size, n_proc=None, batch_size=50):
     nt, Lz, Ly, Lx = shmem_in['shape']
     c1 = uniform_filter(n.ones((Lz, Ly, Lx)), size, mode='constant')
 
     batches = [n.arange(idx, min(nt,idx+batch_size)) for idx in n.arange(0,nt, batch_size)]
-    pool = multiprocessing.Pool(n_proc)
+    pool = shmem_utils.get_pool(n_proc)
     pool.starmap(filtframe_shmem_w, [(shmem_in, shmem_out, b,size,c1) for b in batches])
 
 
 def filtframe_w(frame, size, mode, c1):
-    # cp = cProfile.Profile()
-    # cp.enable()
     minus = (uniform_filter(frame, size=size, mode=mode) / c1)
     ret = frame - minus
-    # cp.disable()
-    # cp.print_stats(sort='cumtime')
     return ret
 
 
 def filtframe_mp(mov, size, n_proc):
-    cp = cProfile.Profile()
-    cp.enable()
-    nt, Lz, Ly, Lx = mov.shape
-    c1 = uniform_filter(n.ones((Lz, Ly, Lx)), size, mode='constant')
-    movt = []
-    pool = multiprocessing.Pool(n_proc)
-    movt = pool.starmap(
-        filtframe_w, [(mov[i], size, 'constant', c1) for i in range(nt)])
-    cp.disable()
-    cp.print_stats(sort='cumtime')
+    with profiling.stage('filtframe_mp', n_proc=n_proc):
+        nt, Lz, Ly, Lx = mov.shape
+        c1 = uniform_filter(n.ones((Lz, Ly, Lx)), size, mode='constant')
+        movt = []
+        pool = multiprocessing.Pool(n_proc)
+        movt = pool.starmap(
+            filtframe_w, [(mov[i], size, 'constant', c1) for i in range(nt)])
     return movt
 
 
 def filtframe(mov, size):
-    cp = cProfile.Profile()
-    cp.enable()
-    nt, Lz, Ly, Lx = mov.shape
-    c1 = uniform_filter(n.ones((Lz, Ly, Lx)), size, mode='constant')
-    movt = []
-    movt = [filtframe_w(mov[i], size, 'constant', c1) for i in range(nt)]
-    cp.disable()
-    cp.print_stats(sort='cumtime')
+    with profiling.stage('filtframe'):
+        nt, Lz, Ly, Lx = mov.shape
+        c1 = uniform_filter(n.ones((Lz, Ly, Lx)), size, mode='constant')
+        movt = []
+        movt = [filtframe_w(mov[i], size, 'constant', c1) for i in range(nt)]
     return movt
 
 
@@ -86,10 +82,7 @@ def filtframe_globals(mov, size, n_procs = 10, batch_size=10):
 
 
 def wrap_filtframe(mov, size):
-    cp = cProfile.Profile()
-    cp.enable()
-    pool = multiprocessing.Pool(2)
-    movts = pool.starmap(filtframe, [(mov[:50], size), (mov[50:], size)])
-    cp.disable()
-    cp.print_stats(sort='cumtime')
+    with profiling.stage('wrap_filtframe'):
+        pool = multiprocessing.Pool(2)
+        movts = pool.starmap(filtframe, [(mov[:50], size), (mov[50:], size)])
     return movts
\ No newline at end of file
@@ -11,6 +11,7 @@ from scipy.ndimage import maximum_filter, gaussian_filter, uniform_filter
 from scipy.stats import mode
 
 from . import utils
+from .. import profiling
 
 def neuropil_subtraction(mov: np.ndarray, filter_size: int) -> None:
     """Returns movie subtracted by a low-pass filtered version of itself to help ignore neuropil."""
@@ -30,7 +31,7 @@ def square_convolution_2d(mov: np.ndarray, filter_size: int, mode='constant') ->
     return movt
 
 
-def multiscale_mask(ypix0,xpix0,lam0, Lyp, Lxp,extend_mask=False):
+def multiscale_mask(ypix0,xpix0,lam0, Lyp, Lxp,extend=False):
     # given a set of masks on the raw image, this functions returns the downsampled masks for all spatial scales
     xs = [xpix0]
     ys = [ypix0]
@@ -43,7 +44,7 @@ def multiscale_mask(ypix0,xpix0,lam0, Lyp, Lxp,extend_mask=False):
         lms.append(LAM)
         ys.append(np.int32(ipix/Lxp[j]))
         xs.append(np.int32(ipix%Lxp[j]))
-    if extend_mask:
+    if extend:
         for j in range(len(Lyp)):
             ys[j], xs[j], lms[j] = extend_mask(ys[j], xs[j], lms[j], Lyp[j], Lxp[j])
     return ys, xs, lms
@@ -390,22 +391,23 @@ def sparsery(mov: np.ndarray, high_pass: int, neuropil_high_pass: int, batch_siz
             seeds.append([yi, xi])
 
         # extend mask based on activity similarity
-        for j in range(3):
-            ypix0, xpix0, lam0 = iter_extend(ypix0, xpix0, mov, Lyc, Lxc, active_frames)
-            tproj = mov[:, ypix0*Lxc+ xpix0] @ lam0
-            # print("           active frames before recompute: %d" % len(active_frames))
-            active_frames = np.nonzero(tproj>threshold)[0]
-            # print("           active frames after recompute: %d" % len(active_frames))
+        with profiling.stage('sparsery_extend', iteration=tj):
+            for j in range(3):
+                ypix0, xpix0, lam0 = iter_extend(ypix0, xpix0, mov, Lyc, Lxc, active_frames)
+                tproj = mov[:, ypix0*Lxc+ xpix0] @ lam0
+                # print("           active frames before recompute: %d" % len(active_frames))
+                active_frames = np.nonzero(tproj>threshold)[0]
+                # print("           active frames after recompute: %d" % len(active_frames))
+                if len(active_frames)<1:
+                    if tj < nmasks:
+                        continue
+                    else:
+                        break
             if len(active_frames)<1:
                 if tj < nmasks:
                     continue
                 else:
                     break
-        if len(active_frames)<1:
-            if tj < nmasks:
-                continue
-            else:
-                break
 
         # check if ROI should be split
         if split_test:
@@ -424,21 +426,22 @@ def sparsery(mov: np.ndarray, high_pass: int, neuropil_high_pass: int, batch_siz
                 med = [ypix0[imin], xpix0[imin]]
           
         # update residual on raw movie
-        mov[np.ix_(active_frames, ypix0*Lxc+ xpix0)] -= tproj[active_frames][:,np.newaxis] * lam0
-        # update filtered movie
-        ys, xs, lms = multiscale_mask(ypix0,xpix0,lam0, Lyp, Lxp, extend_mask=extend_multiscale_mask)
-        for j in range(nscales):
-            # print("Zero:" , movu[j][0,0])
-            # print("Act", active_frames[0])
-            # print("Subtracting: ", np.outer(tproj[active_frames], lms[j])[0][:5])
-
-            # print('Before sub:', movu[j][np.ix_(active_frames, xs[j]+Lxp[j]*ys[j])][0][:5])
-            movu[j][np.ix_(active_frames, xs[j]+Lxp[j]*ys[j])] -= np.outer(tproj[active_frames], lms[j])
-            # print('After sub:', movu[j][np.ix_(active_frames, xs[j]+Lxp[j]*ys[j])][0][:5])
-            Mx = movu[j][:,xs[j]+Lxp[j]*ys[j]]
-            # print(Mx[0])
-            # print(Mx.shape)
-            V1[j][ys[j], xs[j]] = (Mx**2 * np.float32(Mx>threshold)).sum(axis=0)**.5
+        with profiling.stage('sparsery_update', iteration=tj):
+            mov[np.ix_(active_frames, ypix0*Lxc+ xpix0)] -= tproj[active_frames][:,np.newaxis] * lam0
+            # update filtered movie
+            ys, xs, lms = multiscale_mask(ypix0,xpix0,lam0, Lyp, Lxp, extend=extend_multiscale_mask)
+            for j in range(nscales):
+                # print("Zero:" , movu[j][0,0])
+                # print("Act", active_frames[0])
+                # print("Subtracting: ", np.outer(tproj[active_frames], lms[j])[0][:5])
+
+                # print('Before sub:', movu[j][np.ix_(active_frames, xs[j]+Lxp[j]*ys[j])][0][:5])
+                movu[j][np.ix_(active_frames, xs[j]+Lxp[j]*ys[j])] -= np.outer(tproj[active_frames], lms[j])
+                # print('After sub:', movu[j][np.ix_(active_frames, xs[j]+Lxp[j]*ys[j])][0][:5])
+                Mx = movu[j][:,xs[j]+Lxp[j]*ys[j]]
+                # print(Mx[0])
+                # print(Mx.shape)
+                V1[j][ys[j], xs[j]] = (Mx**2 * np.float32(Mx>threshold)).sum(axis=0)**.5
         if verbose:
             # print("Cell %d with activity_thresh: %.3f, peak_thresh: %.3f, %d active frames" % (tj+1, threshold, vmultiplier*Th2, len(active_frames)))
             print("Added cell %d at %03d, %03d, peak %.3f, %d frames, %d pixels" % (tj+1, med[0], med[1], v0max.max(), len(active_frames), len(xpix0)))
@@ -111,8 +111,48 @@ def block_and_svd(mov_reg, n_comp, block_shape= (1, 128, 128), block_overlaps=(0
 
 import time
 
-def reconstruct(svd_info, t_indices):
-    pass
+def reconstruct_stream(svd_info, t_indices=None, t_chunk=200, n_comps=None, log_cb=default_log):
+    """ yields the overlapping-block blended movie from its block SVD in chunks of at most t_chunk frames
+
+    only the spatial components (s * v) of all blocks and the temporal components of one chunk
+    are in memory at a time, so that any time window can be reviewed without reconstructing
+    every block over the full time range
+
+    Parameters
+    ----------
+    svd_info : dict or str
+        output of block_and_svd, or the directory containing svd_info.npy
+    t_indices : tuple (t_start, t_end), optional
+        time range to reconstruct, defaults to the whole movie
+    t_chunk : int
+        number of frames reconstructed per chunk
+    n_comps : int, optional
+        number of components used for reconstruction, defaults to svd_info['n_comps']
+
+    Yields
+    ------
+    t_start : int
+        index of the first frame of the chunk
+    mov : ndarray
+        size [nt_chunk x nz x ny x nx], float32
+    """
+    if type(svd_info) == str:
+        svd_info = n.load(os.path.join(svd_info, 'svd_info.npy'), allow_pickle=True).item()
+    nz, nt, ny, nx = svd_info['mov_shape']
+    if t_indices is None:
+        t_indices = (0, nt)
+    if n_comps is None: n_comps = svd_info['n_comps']
+    svd_dirs = svd_info['svd_dirs']
+    # blocks skipped by block_validity have no svd_dir, the dirs are named by block index
+    block_idxs = [int(os.path.basename(os.path.normpath(d))) for d in svd_dirs]
+    block_limits = svd_info['blocks'][:, block_idxs]
+
+    svs = load_and_multiply_stack_svs(svd_dirs, n_comps, compute=True)
+    log_cb("Loaded SVs of %d blocks" % len(svd_dirs), 3)
+    for t_start in range(t_indices[0], t_indices[1], t_chunk):
+        t_end = min(t_start + t_chunk, t_indices[1])
+        yield t_start, reconstruct_movie_batch(svd_dirs, svs, (t_start, t_end), (nz, ny, nx),
+                                               block_limits, log_cb=log_cb)
 
 def get_overlap_mask(block_shape, overlaps, bsize=3, fsize=1.4):
     mask = n.zeros(block_shape)
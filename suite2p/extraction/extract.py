@@ -4,9 +4,11 @@ import time
 import numpy as np
 from numba import prange, njit, jit, int64, float32
 from numba.typed import List
-from scipy import stats, signal
+from scipy import sparse, stats, signal
 from .masks import create_masks
-from ..io import BinaryFile
+from .. import profiling
+from ..io import TiledBinaryFile, registration_key
+from ..registration.register import open_registered
 
 def extract_traces(ops, cell_masks, neuropil_masks, reg_file):
     """ extracts activity from reg_file using masks in stat and neuropil_masks
@@ -79,6 +81,9 @@ def extract_traces(ops, cell_masks, neuropil_masks, reg_file):
     else:
         neuropil_ipix = None
 
+    # single sparse matrix with the cell masks in the first ncells rows and the neuropil masks in the rest
+    W = weight_matrix(cell_ipix, cell_lam, neuropil_ipix, Ly * Lx) if ops.get('sparse_extraction', False) else None
+
     ix = 0
     for k, (_, data) in enumerate(reg_file.iter_frames(batch_size=ops['batch_size'])):
         nimg = data.shape[0]
@@ -86,7 +91,6 @@ def extract_traces(ops, cell_masks, neuropil_masks, reg_file):
             break
         inds = ix+np.arange(0,nimg,1,int)
         data = np.reshape(data, (nimg,-1)).astype(np.float32)
-        Fi = np.zeros((ncells, data.shape[0]), np.float32)
         
         # extract traces and neuropil
         
@@ -95,10 +99,20 @@ def extract_traces(ops, cell_masks, neuropil_masks, reg_file):
         #    F[n,inds] = np.dot(data[:, cell_masks[n][0]], cell_masks[n][1])
         #Fneu[:,inds] = np.dot(neuropil_masks , data.T)
 
-        # WITH NUMBA
-        F[:,inds] = matmul_traces(Fi, data, cell_ipix, cell_lam)
-        if neuropil_ipix is not None:
-            Fneu[:,inds] = matmul_neuropil(Fi, data, neuropil_ipix, neuropil_npix)
+        with profiling.stage('extract_batch', batch=k):
+            if W is not None:
+                # pixels x time, so that each mask pixel is a contiguous row
+                Fi = np.zeros((W.shape[0], nimg), np.float32)
+                matmul_sparse(Fi, W.indptr, W.indices, W.data, np.ascontiguousarray(data.T))
+                F[:,inds] = Fi[:ncells]
+                if neuropil_ipix is not None:
+                    Fneu[:,inds] = Fi[ncells:]
+            else:
+                # WITH NUMBA
+                Fi = np.zeros((ncells, data.shape[0]), np.float32)
+                F[:,inds] = matmul_traces(Fi, data, cell_ipix, cell_lam)
+                if neuropil_ipix is not None:
+                    Fneu[:,inds] = matmul_neuropil(Fi, data, neuropil_ipix, neuropil_npix)
 
         ix += nimg
     print('Extracted fluorescence from %d ROIs in %d frames, %0.2f sec.'%(ncells, ops['nframes'], time.time()-t0))
@@ -120,19 +134,97 @@ def matmul_neuropil(Fi, data, neuropil_ipix, neuropil_npix):
     return Fi
 
 
-def extract_traces_from_masks(ops, cell_masks, neuropil_masks):
+def weight_matrix(cell_ipix, cell_lam, neuropil_ipix, npix):
+    """ CSR matrix of mask weights, size [ncells (+ ncells if neuropil_ipix) x npix]
+
+    rows are cell masks weighted by lam, followed by neuropil masks weighted by 1 / number of neuropil pixels
+    """
+    ipix = list(cell_ipix)
+    lam = list(cell_lam)
+    if neuropil_ipix is not None:
+        ipix.extend(neuropil_ipix)
+        lam.extend([np.full(len(n_ipix), 1. / max(1, len(n_ipix)), np.float32) for n_ipix in neuropil_ipix])
+    rows = np.repeat(np.arange(len(ipix)), [len(i) for i in ipix])
+    cols = np.concatenate(ipix) if len(ipix) else np.zeros(0, np.int64)
+    vals = np.concatenate(lam).astype(np.float32) if len(lam) else np.zeros(0, np.float32)
+    W = sparse.csr_matrix((vals, (rows, cols)), shape=(len(ipix), npix), dtype=np.float32)
+    W.sum_duplicates()
+    return W
+
+
+@njit(parallel=True)
+def matmul_sparse(Fi, indptr, indices, weights, dataT):
+    nrows = Fi.shape[0]
+    for n in prange(nrows):
+        for k in range(indptr[n], indptr[n+1]):
+            Fi[n] += weights[k] * dataT[indices[k]]
+    return Fi
+
+
+def extract_traces_tiled(ops, cell_masks, neuropil_masks, tiled_file):
+    """ extracts activity of a few ROIs from the tile-major copy of the registered movie
+
+    same output as extract_traces, but reads only the tiles under each ROI and its neuropil
+    instead of streaming every frame
+
+    Parameters
+    ----------------
+
+    ops : dictionary
+        'nframes'
+
+    cell_masks : list
+        each is a tuple where first element are cell pixels (flattened), and
+        second element are pixel weights normalized to sum 1 (lam)
+
+    neuropil_masks : list
+        each element is neuropil pixels in (Ly*Lx) coordinates
+
+    tiled_file : io.TiledBinaryFile object
+
+    Returns
+    ----------------
+
+    F : float, 2D array
+        size [ROIs x time]
+
+    Fneu : float, 2D array
+        size [ROIs x time]
+
+    ops : dictionary
+
+    """
+    t0 = time.time()
+    ncells = len(cell_masks)
+    nframes = int(ops['nframes'])
+    F = np.zeros((ncells, nframes), np.float32)
+    Fneu = np.zeros((ncells, nframes), np.float32)
+    for n, (ipix, lam) in enumerate(cell_masks):
+        F[n] = lam.astype(np.float32) @ tiled_file.pixel_traces(ipix)[:, :nframes]
+        if neuropil_masks is not None and len(neuropil_masks[n]) > 0:
+            Fneu[n] = tiled_file.pixel_traces(neuropil_masks[n])[:, :nframes].mean(axis=0)
+    print('Extracted fluorescence from %d ROIs in %d frames from tiled file, %0.2f sec.'%(ncells, nframes, time.time()-t0))
+    return F, Fneu, ops
+
+def extract_traces_from_masks(ops, cell_masks, neuropil_masks, tiled=False):
     """ extract fluorescence from both channels 
     
-    also used in drawroi.py
+    also used in drawroi.py, which extracts a few ROIs from the tile-major copy of the
+    registered movie (tiled=True) if it was saved with the current registration offsets
     
     """
     F_chan2, Fneu_chan2 = [], []
-    with BinaryFile(Ly=ops['Ly'], Lx=ops['Lx'],
-                    read_filename=ops['reg_file']) as f:    
-        F, Fneu, ops = extract_traces(ops, cell_masks, neuropil_masks, f)
+    tiled_file = ops.get('reg_file_tiled')
+    if (tiled and tiled_file is not None and os.path.exists(tiled_file)
+            and ops.get('reg_file_tiled_key') == registration_key(ops)):
+        with TiledBinaryFile(Ly=ops['Ly'], Lx=ops['Lx'], read_filename=tiled_file,
+                             tile_size=ops.get('tile_size', 32)) as f:
+            F, Fneu, ops = extract_traces_tiled(ops, cell_masks, neuropil_masks, f)
+    else:
+        with open_registered(ops) as f:
+            F, Fneu, ops = extract_traces(ops, cell_masks, neuropil_masks, f)
     if 'reg_file_chan2' in ops:
-        with BinaryFile(Ly=ops['Ly'], Lx=ops['Lx'],
-                        read_filename=ops['reg_file_chan2']) as f:    
+        with open_registered(ops, chan2=True) as f:
             F_chan2, Fneu_chan2, _ = extract_traces(ops.copy(), cell_masks, neuropil_masks, f)
     return F, Fneu, F_chan2, Fneu_chan2, ops
 
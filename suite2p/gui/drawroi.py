@@ -50,7 +50,8 @@ def masks_and_traces(ops, stat_manual, stat_orig):
 
     F, Fneu, F_chan2, Fneu_chan2, ops = extract_traces_from_masks(ops, 
                                                                   manual_cell_masks, 
-                                                                  manual_neuropil_masks)
+                                                                  manual_neuropil_masks,
+                                                                  tiled=True)
 
     # compute activity statistics for classifier
     npix = np.array([stat_orig[n]['npix'] for n in range(len(stat_orig))]).astype('float32')
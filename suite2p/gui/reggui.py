@@ -6,13 +6,13 @@ import numpy as np
 import pyqtgraph as pg
 from PyQt5 import QtGui, QtCore
 from PyQt5.QtWidgets import QStyle
-from PyQt5.QtWidgets import QMainWindow, QGridLayout, QCheckBox, QLabel, QLineEdit, QSlider, QFileDialog, QPushButton, QToolButton, QButtonGroup, QWidget
+from PyQt5.QtWidgets import QMainWindow, QGridLayout, QCheckBox, QLabel, QLineEdit, QSlider, QFileDialog, QPushButton, QToolButton, QButtonGroup, QWidget, QComboBox
 from scipy.ndimage import gaussian_filter1d
 from natsort import natsorted
 from tifffile import imread
 
 from . import masks, views, graphics, traces, classgui, utils
-from .. import registration
+from .. import io, registration
 from ..io.save import compute_dydx
 
 
@@ -133,6 +133,18 @@ class BinaryPlayer(QMainWindow):
         self.ROIedit.setAlignment(QtCore.Qt.AlignRight)
         self.ROIedit.returnPressed.connect(self.number_chosen)
         self.l0.addWidget(self.ROIedit, 8,0,1,1)
+        # play temporally binned movie (if saved with ops['temporal_pyramid'])
+        qlabel = QLabel(self)
+        qlabel.setText("<font color='white'>Playback bin:</font>")
+        self.l0.addWidget(qlabel,9,0,1,2)
+        self.tbinbox = QComboBox(self)
+        self.tbinbox.addItem('1x')
+        self.tbinbox.setEnabled(False)
+        self.tbinbox.activated.connect(self.set_tbin)
+        self.l0.addWidget(self.tbinbox, 10,0,1,1)
+        self.tbin = 1
+        self.pyramid = {}
+        self.pyramid_file = None
         # create frame slider
         self.frameLabel = QLabel("Current frame:")
         self.frameLabel.setStyleSheet("color: white;")
@@ -235,9 +247,23 @@ class BinaryPlayer(QMainWindow):
                 self.win.removeItem(self.vside)
             self.next_frame()
 
+    def set_tbin(self):
+        """ plays the level of the temporal pyramid binned by the chosen factor (1x plays data.bin) """
+        if self.pyramid_file is not None:
+            self.pyramid_file.close()
+            self.pyramid_file = None
+        self.tbin = int(self.tbinbox.currentText()[:-1])
+        if self.tbin > 1:
+            # frames are read one at a time in any order, so view them through a memory map
+            self.pyramid_file = io.BinaryFile(Ly=self.LY, Lx=self.LX, read_filename=self.pyramid[self.tbin],
+                                              mmap_mode='r')
+            self.cframe = (self.cframe // self.tbin) * self.tbin
+        if self.loaded:
+            self.jump_to_frame()
+
     def next_frame(self):
         # loop after video finishes
-        self.cframe+=1
+        self.cframe+=self.tbin
         if self.cframe > self.nframes - 1:
             self.cframe = 0
             if self.LY>0:
@@ -251,17 +277,21 @@ class BinaryPlayer(QMainWindow):
                     self.reg_file_chan2.seek(0, 0)
                 if self.wraw_wred:
                     self.reg_file_raw_chan2.seek(0, 0)
-        self.img = np.zeros((self.LY, self.LX), dtype=np.int16)
-        for n in range(len(self.reg_loc)):
-            buff = self.reg_file[n].read(self.nbytesread[n])
-            img = np.reshape(np.frombuffer(buff, dtype=np.int16, offset=0),(self.Ly[n],self.Lx[n]))
-            self.img[self.dy[n]:self.dy[n]+self.Ly[n], self.dx[n]:self.dx[n]+self.Lx[n]] = img
+        if self.tbin > 1:
+            # binned frame from the temporal pyramid, side views are only shown at full resolution
+            self.img = self.pyramid_file[self.cframe // self.tbin][0]
+        else:
+            self.img = np.zeros((self.LY, self.LX), dtype=np.int16)
+            for n in range(len(self.reg_loc)):
+                buff = self.reg_file[n].read(self.nbytesread[n])
+                img = np.reshape(np.frombuffer(buff, dtype=np.int16, offset=0),(self.Ly[n],self.Lx[n]))
+                self.img[self.dy[n]:self.dy[n]+self.Ly[n], self.dx[n]:self.dx[n]+self.Lx[n]] = img
             
-        if self.wred and self.red_on:
+        if self.tbin == 1 and self.wred and self.red_on:
             buff = self.reg_file_chan2.read(self.nbytesread[0])
             imgred = np.reshape(np.frombuffer(buff, dtype=np.int16, offset=0),(self.Ly[0],self.Lx[0]))[:,:,np.newaxis]
             self.img = np.concatenate((self.img[:,:,np.newaxis], imgred, np.zeros_like(imgred)), axis=-1)
-        if self.wraw and self.raw_on:
+        if self.tbin == 1 and self.wraw and self.raw_on:
             buff = self.reg_file_raw.read(self.nbytesread[0])
             self.imgraw = np.reshape(np.frombuffer(buff, dtype=np.int16, offset=0),(self.Ly[0],self.Lx[0]))
             if self.wraw_wred:
@@ -368,6 +398,7 @@ class BinaryPlayer(QMainWindow):
             self.LX = 0
             self.reg_loc = []
             self.reg_file = []
+            self.pyramid = {}
             self.Ly = []
             self.Lx = []
             self.dy = []
@@ -425,6 +456,7 @@ class BinaryPlayer(QMainWindow):
             else:
                 self.reg_loc = [os.path.abspath(os.path.join(os.path.dirname(filename),'data.bin'))]
             self.reg_file = [open(self.reg_loc[-1],'rb')]
+            self.pyramid = io.pyramid_levels(self.reg_loc[-1])
             self.wraw = False
             self.wred = False
             self.wraw_wred = False
@@ -501,6 +533,13 @@ class BinaryPlayer(QMainWindow):
         self.srange = frames.mean() + frames.std()*np.array([-2,5])
 
         self.movieLabel.setText(self.reg_loc[-1])
+        self.tbinbox.clear()
+        self.tbinbox.addItems(['1x'] + ['%dx' % factor for factor in self.pyramid])
+        self.tbinbox.setEnabled(len(self.pyramid) > 0)
+        self.tbin = 1
+        if self.pyramid_file is not None:
+            self.pyramid_file.close()
+            self.pyramid_file = None
         self.nbytesread = []
         for n in range(len(self.reg_loc)):
             self.nbytesread.append(2 * self.Ly[n] * self.Lx[n])
@@ -772,7 +811,7 @@ class BinaryPlayer(QMainWindow):
                 self.reg_file_chan2.seek(self.nbytesread[-1] * self.cframe, 0)
             if self.wraw_wred:
                 self.reg_file_raw_chan2.seek(self.nbytesread[-1] * self.cframe, 0)
-            self.cframe -= 1
+            self.cframe -= self.tbin
             self.next_frame()
 
     def start(self):
@@ -810,20 +849,17 @@ class BinaryPlayer(QMainWindow):
         self.p3.setXLink('plot_shift')
 
 def subsample_frames(ops, nsamps, reg_loc):
+    """ nsamps frames spread over the recording, from the coarsest temporal pyramid level with enough frames """
     nFrames = ops['nframes']
     Ly = ops['Ly']
     Lx = ops['Lx']
-    frames = np.zeros((nsamps, Ly, Lx), dtype='int16')
-    nbytesread = 2 * Ly * Lx
-    istart = np.linspace(0, nFrames, 1+nsamps).astype('int64')
-    reg_file = open(reg_loc, 'rb')
-    for j in range(0,nsamps):
-        reg_file.seek(nbytesread * istart[j], 0)
-        buff = reg_file.read(nbytesread)
-        data = np.frombuffer(buff, dtype=np.int16, offset=0)
-        buff = []
-        frames[j,:,:] = np.reshape(data, (Ly, Lx))
-    reg_file.close()
+    tbin = 1
+    for factor, filename in io.pyramid_levels(reg_loc).items():
+        if nFrames // factor >= nsamps:
+            tbin, reg_loc = factor, filename
+    istart = np.linspace(0, nFrames // tbin, 1+nsamps).astype('int64')[:-1]
+    with io.BinaryFile(Ly=Ly, Lx=Lx, read_filename=reg_loc) as reg_file:
+        frames = reg_file.ix(istart)
     return frames
 
 class PCViewer(QMainWindow):
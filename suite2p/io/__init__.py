@@ -1,7 +1,9 @@
 from .h5 import h5py_to_binary
 from .nwb import save_nwb, read_nwb, nwb_to_binary
-from .save import combined, compute_dydx, save_mat
+from .save import combined, compute_dydx, save_mat, save_h5, load_h5
 from .sbx import sbx_to_binary
 from .tiff import mesoscan_to_binary, ome_to_binary, tiff_to_binary, generate_tiff_filename, save_tiff
-from .binary import BinaryFile, BinaryFileCombined
+from .binary import BinaryFile, BinaryFileCombined, BinaryFilePipeline, TiledBinaryFile, write_tiled
+from .binary import TemporalPyramidWriter, pyramid_filename, pyramid_levels
+from .binary import RegisteredBinaryFile, registered_filename, registration_key
 from .server import send_jobs
@@ -1,4 +1,9 @@
-from typing import Optional, Tuple, Sequence
+import hashlib
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, Tuple, Sequence
 from contextlib import contextmanager
 
 import numpy as np
@@ -6,7 +11,8 @@ import numpy as np
 
 class BinaryFile:
 
-    def __init__(self, Ly: int, Lx: int, read_filename: str, write_filename: Optional[str] = None):
+    def __init__(self, Ly: int, Lx: int, read_filename: str, write_filename: Optional[str] = None,
+                 mmap_mode: Optional[str] = None):
         """
         Creates/Opens a Suite2p BinaryFile for reading and writing image data
 
@@ -20,13 +26,29 @@ class BinaryFile:
             The filename of the file to read from
         write_filename: str
             The filename to write to, if different from the read_filename (optional)
+        mmap_mode: str
+            If 'r' (read-only) or 'r+' (read-write, in place), the file is accessed through np.memmap and
+            indexing, "data" and int16 reads return views into the file instead of copies (optional)
         """
         self.Ly = Ly
         self.Lx = Lx
         self.read_filename = read_filename
         self.write_filename = write_filename
-
-        if read_filename == write_filename:
+        self.mmap_mode = mmap_mode
+        self.file = None
+
+        if mmap_mode is not None:
+            if mmap_mode not in ('r', 'r+'):
+                raise ValueError("mmap_mode must be 'r' or 'r+'")
+            if write_filename and (mmap_mode == 'r' or write_filename != read_filename):
+                raise IOError("memory-mapped BinaryFile can only write in place with mmap_mode='r+'")
+            n_frames = os.path.getsize(read_filename) // (2 * Ly * Lx)
+            # an empty file cannot be memory-mapped, but still reads as 0 frames
+            self.file = (np.memmap(read_filename, mode=mmap_mode, dtype=np.int16, shape=(n_frames, Ly, Lx))
+                         if n_frames > 0 else np.zeros((0, Ly, Lx), np.int16))
+            self.read_file = None
+            self.write_file = None
+        elif read_filename == write_filename:
             self.read_file = open(read_filename, mode='r+b')
             self.write_file = self.read_file
         elif read_filename and not write_filename:
@@ -38,8 +60,10 @@ class BinaryFile:
         else:
             raise IOError("Invalid combination of read_file and write_file")
 
+        self._in_place = mmap_mode == 'r+' if mmap_mode is not None else self.read_file is self.write_file
         self._index = 0
         self._can_read = True
+        self._write_buffer = Int16Buffer()
 
     @staticmethod
     def convert_numpy_file_to_suite2p_binary(from_filename: str, to_filename: str) -> None:
@@ -63,6 +87,11 @@ class BinaryFile:
     @property
     def nbytes(self):
         """total number of bytes in the read_file."""
+        if self.file is not None:
+            return np.int64(self.file.nbytes)
+        if self.read_file is None or self.read_file.closed:
+            # closed (or closed memory-mapped) file
+            return np.int64(os.path.getsize(self.read_filename))
         with temporary_pointer(self.read_file) as f:
             f.seek(0, 2)
             return f.tell()
@@ -103,7 +132,14 @@ class BinaryFile:
         """
         Closes the file.
         """
-        self.read_file.close()
+        if self.file is not None:
+            if self.mmap_mode == 'r+':
+                self.file.flush()
+            # views handed out earlier keep the underlying map alive
+            self.file = None
+            return
+        if self.read_file is not None:
+            self.read_file.close()
         if self.write_file:
             self.write_file.close()
 
@@ -115,6 +151,11 @@ class BinaryFile:
 
     def __getitem__(self, *items):
         frame_indices, *crop = items
+        if self.file is not None:
+            if isinstance(frame_indices, (int, np.integer)):
+                frame_indices = slice(frame_indices, frame_indices + 1)
+            frames = self.file[frame_indices]
+            return frames[(slice(None),) + tuple(crop)] if crop else frames
         if isinstance(frame_indices, int):
             frames = self.ix(indices=[frame_indices], is_slice=False)
         elif isinstance(frame_indices, slice):
@@ -162,39 +203,34 @@ class BinaryFile:
         """
         Returns the frames at index values "indices".
 
+        The indices are sorted and grouped into runs of nearby frames, each run is read with
+        a single positioned read (the file pointer and the read/write position are not changed).
+
         Parameters
         ----------
         indices: int array
             The frame indices to get
 
         is_slice: bool, default False
-            if indices are slice, read slice with "read" function and return
+            if indices are slice, read them as one contiguous run
 
         Returns
         -------
         frames: len(indices) x Ly x Lx
             The requested frames
         """
-        if not is_slice:
+        if self.file is not None:
+            if is_slice:
+                return self.file[indices[0]:indices[-1] + 1]
+            return self.file[np.asarray(indices, dtype=np.int64)]
+        if self.write_file is not None:
+            # positioned reads bypass the buffer of the (in-place) write file
+            self.write_file.flush()
+        if is_slice:
             frames = np.empty((len(indices), self.Ly, self.Lx), np.int16)
-            # load and bin data
-            with temporary_pointer(self.read_file) as f:
-                for frame, ixx in zip(frames, indices):
-                    if ixx!=self._index:
-                        f.seek(self.nbytesread * ixx)
-                    buff = f.read(self.nbytesread)
-                    data = np.frombuffer(buff, dtype=np.int16, offset=0)
-                    frame[:] = np.reshape(data, (self.Ly, self.Lx))
-                    self._index = ixx+1
-        else:
-            i0 = indices[0]
-            batch_size = len(indices)
-            if self._index != i0:
-                f.seek(self.nbytesread * i0)
-            _, frames = self.read(batch_size=batch_size, dtype=np.int16)
-            self._index = i0 + batch_size
-        
-        return frames
+            pread_into(self.read_file, frames, self.nbytesread * indices[0])
+            return frames
+        return read_frames(self.read_file, indices, self.Ly, self.Lx)
 
     @property
     def data(self) -> np.ndarray:
@@ -206,6 +242,8 @@ class BinaryFile:
         frames: nImg x Ly x Lx
             The frame data
         """
+        if self.file is not None:
+            return self.file
         with temporary_pointer(self.read_file) as f:
             return np.fromfile(f, np.int16).reshape(-1, self.Ly, self.Lx)
 
@@ -222,14 +260,18 @@ class BinaryFile:
         """
         if not self._can_read:
             raise IOError("BinaryFile needs to write before it can read again.")
-        nbytes = self.nbytesread * batch_size
-        buff = self.read_file.read(nbytes)
-        data = np.frombuffer(buff, dtype=np.int16, offset=0).reshape(-1, self.Ly, self.Lx).astype(dtype)
+        if self.file is not None:
+            data = self.file[self._index:self._index + batch_size]
+            data = data if np.dtype(dtype) == np.int16 else data.astype(dtype)
+        else:
+            data = np.empty((batch_size, self.Ly, self.Lx), np.int16)
+            nframes = self.read_file.readinto(data) // self.nbytesread
+            data = data[:nframes].astype(dtype, copy=False)
         if data.size == 0:
             return None
         indices = np.arange(self._index, self._index + data.shape[0])
         self._index += data.shape[0]
-        if self.read_file is self.write_file:
+        if self._in_place:
             self._can_read = False
         return indices, data
 
@@ -241,18 +283,57 @@ class BinaryFile:
         ----------
         data: 2D or 3D array
             The frame(s) to write.  Should be the same width and height as the other frames in the file.
+            int16 data is written as is, other types are clipped and converted in a reused int16 buffer.
         """
-        if self._can_read and self.read_file is self.write_file:
+        if self._can_read and self._in_place:
             raise IOError("BinaryFile needs to read before it can write again.")
+        data = data.reshape(-1, self.Ly, self.Lx)
+        if self.file is not None:
+            if self.mmap_mode != 'r+':
+                raise IOError("BinaryFile opened with mmap_mode='r', writing not possible.")
+            out = self.file[self._index - data.shape[0]:self._index]
+            data = to_int16(data, out=out)
+            if data is not out:
+                out[:] = data
+            self._can_read = True
+            return
         if not self.write_file:
             raise IOError("No write_file specified, writing not possible.")
         if self.read_file is self.write_file:
             self.write_file.seek(-2 * data.size, 1)
             self._can_read = True
-        self.write_file.write(bytearray(np.minimum(data, 2 ** 15 - 2).astype('int16')))
+        self.write_file.write(self._write_buffer.to_int16(data))
+
+    def fingerprint(self) -> str:
+        """
+        Returns a hash of the size, modification time and first, middle and last frames of the read_file,
+        which changes whenever the file is rewritten (e.g. registered again).
+        """
+        stat = os.stat(self.read_filename)
+        h = hashlib.sha1(('%d %d %d %d' % (stat.st_size, stat.st_mtime_ns, self.Ly, self.Lx)).encode())
+        n_frames = self.n_frames
+        if n_frames > 0:
+            h.update(self.ix(indices=np.unique([0, n_frames // 2, n_frames - 1])).tobytes())
+        return h.hexdigest()
+
+    def bin_movie_cache_filename(self, bin_size: int, x_range: Optional[Tuple[int, int]] = None,
+                                 y_range: Optional[Tuple[int, int]] = None, bad_frames: Optional[np.ndarray] = None,
+                                 reject_threshold: float = 0.5) -> str:
+        """
+        Returns the filename of the binned movie cache next to the read_file, keyed by the binning parameters
+        and the fingerprint of the read_file.
+        """
+        h = hashlib.sha1(self.fingerprint().encode())
+        h.update(repr((int(bin_size), reject_threshold,
+                       None if x_range is None else [int(x) for x in x_range],
+                       None if y_range is None else [int(y) for y in y_range])).encode())
+        if bad_frames is not None:
+            h.update(np.packbits(np.asarray(bad_frames, dtype=bool)).tobytes())
+        return os.path.join(os.path.dirname(os.path.abspath(self.read_filename)),
+                            'data_binned_%s.npy' % h.hexdigest()[:16])
 
     def bin_movie(self, bin_size: int, x_range: Optional[Tuple[int, int]] = None, y_range: Optional[Tuple[int, int]] = None,
-                  bad_frames: Optional[np.ndarray] = None, reject_threshold: float = 0.5) -> np.ndarray:
+                  bad_frames: Optional[np.ndarray] = None, reject_threshold: float = 0.5, cache: bool = False) -> np.ndarray:
         """
         Returns binned movie that rejects bad_frames (bool array) and crops to (y_range, x_range).
 
@@ -267,12 +348,28 @@ class BinaryFile:
         bad_frames: int array
             The indices to *not* include.
         reject_threshold: float
+        cache: bool, default False
+            if True, the binned movie is saved next to the read_file (see bin_movie_cache_filename) and
+            later calls with the same parameters on the same (unchanged) file memory-map it instead of
+            binning again. The returned array is then copy-on-write: changes to it are not saved.
 
         Returns
         -------
         frames: nImg x Ly x Lx
             The frames
         """
+        if cache:
+            cache_filename = self.bin_movie_cache_filename(bin_size=bin_size, x_range=x_range, y_range=y_range,
+                                                           bad_frames=bad_frames, reject_threshold=reject_threshold)
+            if os.path.isfile(cache_filename):
+                return np.load(cache_filename, mmap_mode='c')
+            mov = self.bin_movie(bin_size=bin_size, x_range=x_range, y_range=y_range, bad_frames=bad_frames,
+                                 reject_threshold=reject_threshold)
+            # write to a temporary file first, so that an interrupted run never leaves a partial cache
+            tmp_filename = cache_filename[:-len('.npy')] + '.tmp.npy'
+            np.save(tmp_filename, mov)
+            os.replace(tmp_filename, cache_filename)
+            return mov
 
         good_frames = ~bad_frames if bad_frames is not None else np.ones(self.n_frames, dtype=bool)
         print("Good Frames: %d" % (good_frames.sum()))
@@ -302,6 +399,302 @@ class BinaryFile:
         return mov
 
 
+class BinaryFilePipeline:
+
+    def __init__(self, Ly: int, Lx: int, read_filename: str, write_filename: str, n_prefetch: int = 2):
+        """
+        Streams batches from read_filename on a background thread while processed batches are
+        written to write_filename by a second thread, so that disk reads and writes overlap with compute.
+
+        Has the same iter_frames / write interface as BinaryFile: each written batch replaces the
+        next batch in write_filename, in the order the batches were read.
+
+        Parameters
+        ----------
+        Ly: int
+            The height of each frame
+        Lx: int
+            The width of each frame
+        read_filename: str
+            The filename of the file to read from
+        write_filename: str
+            The filename to write to (can be the same as read_filename)
+        n_prefetch: int
+            The maximum number of batches held in each of the read and write queues
+        """
+        self.Ly = Ly
+        self.Lx = Lx
+        self.read_filename = read_filename
+        self.write_filename = write_filename
+        self.reader = BinaryFile(Ly=Ly, Lx=Lx, read_filename=read_filename)
+        in_place = os.path.abspath(read_filename) == os.path.abspath(write_filename)
+        self.write_file = open(write_filename, mode='r+b' if in_place else 'wb')
+
+        self._read_queue = queue.Queue(maxsize=max(1, n_prefetch))
+        self._write_queue = queue.Queue(maxsize=max(1, n_prefetch))
+        self._stop = threading.Event()
+        self._error = None
+        self._write_index = 0
+        self._closed = False
+        self._reader_thread = None
+        self._writer_thread = threading.Thread(target=self._write_worker, daemon=True)
+        self._writer_thread.start()
+
+    @property
+    def nbytesread(self):
+        """number of bytes per frame (FIXED for given file)"""
+        return np.int64(2 * self.Ly * self.Lx)
+
+    @property
+    def n_frames(self) -> int:
+        """total number of frames in the read_file."""
+        return self.reader.n_frames
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close(raise_errors=exc_type is None)
+
+    def _put(self, q: queue.Queue, item) -> bool:
+        """puts item on q, giving up if the pipeline is being shut down."""
+        while not self._stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _read_worker(self, batch_size: int, dtype) -> None:
+        try:
+            for indices, data in self.reader.iter_frames(batch_size=batch_size, dtype=dtype):
+                if not self._put(self._read_queue, (indices, data)):
+                    return
+            self._put(self._read_queue, None)
+        except Exception as e:
+            self._put(self._read_queue, e)
+
+    def _write_worker(self) -> None:
+        buffer = Int16Buffer()
+        while True:
+            item = self._write_queue.get()
+            if item is None:
+                return
+            if self._error is not None:
+                continue
+            try:
+                i0, data = item
+                self.write_file.seek(self.nbytesread * i0)
+                self.write_file.write(buffer.to_int16(data))
+            except Exception as e:
+                self._error = e
+
+    def iter_frames(self, batch_size: int = 1, dtype=np.float32):
+        """
+        Iterates through each set of frames, depending on batch_size, yielding both the frame index and frame data.
+        The next batch is read from disk while the current one is being processed.
+
+        Parameters
+        ---------
+        batch_size: int
+            The number of frames to get at a time
+        dtype: np.dtype
+            The nympy data type that the data should return as
+
+        Yields
+        ------
+        indices: array int
+            The frame indices.
+        data: batch_size x Ly x Lx
+            The frames
+        """
+        if self._reader_thread is not None:
+            raise IOError("BinaryFilePipeline can only be iterated once.")
+        self._reader_thread = threading.Thread(target=self._read_worker, args=(batch_size, dtype), daemon=True)
+        self._reader_thread.start()
+        while True:
+            item = self._read_queue.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def write(self, data: np.ndarray) -> None:
+        """
+        Queues frame(s) to be written behind the next frames in the file.  The array must not be modified afterwards.
+
+        Parameters
+        ----------
+        data: 2D or 3D array
+            The frame(s) to write.  Should be the same width and height as the other frames in the file.
+        """
+        if self._error is not None:
+            raise self._error
+        data = data.reshape(-1, self.Ly, self.Lx)
+        self._write_queue.put((self._write_index, data))
+        self._write_index += data.shape[0]
+
+    def close(self, raise_errors: bool = True) -> None:
+        """
+        Flushes the pending writes, stops the background threads and closes the files.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        self._write_queue.put(None)
+        self._writer_thread.join()
+        self._stop.set()
+        if self._reader_thread is not None:
+            self._reader_thread.join()
+        self.reader.close()
+        self.write_file.close()
+        if raise_errors and self._error is not None:
+            raise self._error
+
+
+class RegisteredBinaryFile(BinaryFile):
+
+    def __init__(self, Ly: int, Lx: int, read_filename: str, ops: dict, shift_frames: Callable):
+        """
+        Opens an unregistered (raw) Suite2p binary read-only and registers frames when they are read,
+        with the offsets that registration stored in ops (see ops['lazy_registration'])
+
+        Frames are shifted with shift_frames, as the second channel is during registration (see
+        registration.register.open_registered), so they are the same as in the registered binary that
+        registration would have written.
+
+        Parameters
+        ----------
+        Ly: int
+            The height of each frame
+        Lx: int
+            The width of each frame
+        read_filename: str
+            The filename of the raw binary
+        ops: dict
+            'yoff', 'xoff' (and 'yoff1', 'xoff1' if 'nonrigid') from registration, and the
+            'bidiphase', 'bidi_corrected', 'nonrigid', 'nblocks', 'xblock', 'yblock', 'bilinear_reg',
+            'subpixel_rigid' and 'fft_backend' options used to shift frames
+        shift_frames: callable
+            shift_frames(frames, yoff, xoff, yoff1, xoff1, ops) returns the frames shifted by the offsets
+        """
+        super().__init__(Ly=Ly, Lx=Lx, read_filename=read_filename)
+        self.shift_frames = shift_frames
+        self.yoff, self.xoff = ops['yoff'], ops['xoff']
+        self.yoff1, self.xoff1 = (ops['yoff1'], ops['xoff1']) if ops['nonrigid'] else (None, None)
+        self.shift_ops = {key: ops[key] for key in ('bidiphase', 'bidi_corrected', 'nonrigid', 'nblocks', 'xblock',
+                                                     'yblock', 'bilinear_reg', 'subpixel_rigid', 'fft_backend') if key in ops}
+
+    @property
+    def n_frames(self) -> int:
+        """number of registered frames in the read_file."""
+        return min(super().n_frames, len(self.yoff))
+
+    def fingerprint(self) -> str:
+        """
+        Returns the fingerprint of the raw read_file (see BinaryFile.fingerprint) combined with a hash of the
+        registration offsets, which change when the movie is registered again although the raw file does not.
+        """
+        offsets = {'yoff': self.yoff, 'xoff': self.xoff}
+        if self.yoff1 is not None:
+            offsets.update({'yoff1': self.yoff1, 'xoff1': self.xoff1})
+        h = hashlib.sha1(super().fingerprint().encode())
+        h.update(registration_key(offsets).encode())
+        return h.hexdigest()
+
+    def register(self, indices: Sequence[int], frames: np.ndarray) -> np.ndarray:
+        """
+        Returns the int16 frames at index values "indices" shifted by their registration offsets.
+        """
+        indices = np.asarray(indices)
+        yoff1, xoff1 = (self.yoff1[indices], self.xoff1[indices]) if self.shift_ops['nonrigid'] else (None, None)
+        frames = self.shift_frames(frames, self.yoff[indices], self.xoff[indices], yoff1, xoff1, self.shift_ops)
+        return to_int16(frames)
+
+    def ix(self, indices: Sequence[int], is_slice=False):
+        """
+        Returns the registered frames at index values "indices" (see BinaryFile.ix).
+        """
+        return self.register(indices, super().ix(indices, is_slice=is_slice))
+
+    @property
+    def data(self) -> np.ndarray:
+        """
+        Returns all the registered frames in the file.
+        """
+        return self.ix(np.arange(self.n_frames), is_slice=True)
+
+    def read(self, batch_size=1, dtype=np.float32) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """
+        Returns the next registered frame(s) in the file and its associated indices.
+        """
+        batch_size = min(batch_size, self.n_frames - self._index)
+        if batch_size <= 0:
+            return None
+        indices, data = super().read(batch_size=batch_size, dtype=np.int16)
+        return indices, self.register(indices, data).astype(dtype, copy=False)
+
+    def write(self, data: np.ndarray) -> None:
+        raise IOError("RegisteredBinaryFile is read-only.")
+
+
+def registered_filename(ops: dict, chan2: bool = False) -> str:
+    """
+    Returns the binary holding the frames of the functional (or the other, if chan2) channel: the registered binary,
+    or the raw binary if registration is applied when frames are read (ops['lazy_registration']).
+    """
+    if ops.get('lazy_registration', False):
+        return ops['raw_file_chan2'] if chan2 else ops['raw_file']
+    return ops['reg_file_chan2'] if chan2 else ops['reg_file']
+
+
+def registration_key(ops: dict) -> str:
+    """
+    Returns a hash of the registration offsets in ops ('yoff', 'xoff', 'yoff1', 'xoff1'), which changes whenever
+    the movie is registered again, whether the registered frames were written or are shifted when read.
+    """
+    h = hashlib.sha1()
+    for key in ('yoff', 'xoff', 'yoff1', 'xoff1'):
+        if key in ops:
+            h.update(key.encode())
+            h.update(np.ascontiguousarray(ops[key]).tobytes())
+    return h.hexdigest()
+
+
+def to_int16(data: np.ndarray, out: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Returns data clipped to 2**15 - 2 as a C-contiguous int16 array without intermediate copies.
+
+    int16 data is returned as is (unless it needs clipping), other types are clipped and converted in a single
+    pass into out (int16, same shape as data), which is allocated if not given.
+    """
+    if data.dtype == np.int16:
+        if data.size and data.max() > 2 ** 15 - 2:
+            return np.minimum(data, 2 ** 15 - 2)
+        return np.ascontiguousarray(data)
+    if out is None:
+        out = np.empty(data.shape, np.int16)
+    np.minimum(data, 2 ** 15 - 2, out=out, casting='unsafe')
+    return out
+
+
+class Int16Buffer:
+    """Reusable int16 buffer for converting batches of frames before writing them."""
+
+    def __init__(self):
+        self.buffer = np.empty(0, np.int16)
+
+    def to_int16(self, data: np.ndarray) -> np.ndarray:
+        """returns to_int16(data), converted into the buffer (grown if needed) if data is not int16."""
+        if data.dtype == np.int16:
+            return to_int16(data)
+        if self.buffer.size < data.size:
+            self.buffer = np.empty(data.size, np.int16)
+        return to_int16(data, out=self.buffer[:data.size].reshape(data.shape))
+
+
 def from_slice(s: slice) -> Optional[np.ndarray]:
     """Creates an np.arange() array from a Python slice object.  Helps provide numpy-like slicing interfaces."""
     return np.arange(s.start, s.stop, s.step) if any([s.start, s.stop, s.step]) else None
@@ -314,6 +707,76 @@ def binned_mean(mov: np.ndarray, bin_size) -> np.ndarray:
     return mov.reshape(-1, bin_size, Ly, Lx).astype(np.float32).mean(axis=1)
 
 
+def coalesce_runs(indices: np.ndarray, nbytes_frame: int, max_gap_bytes: int = 2**20,
+                  max_run_bytes: int = 2**26):
+    """
+    Groups sorted, unique frame indices into runs that are each read with a single read.
+
+    Frames separated by gaps of at most max_gap_bytes are read together (skipping a small gap is cheaper than
+    a seek on spinning disks and network filesystems), and runs are split to read at most max_run_bytes at once.
+
+    Returns
+    -------
+    runs: list of (i0, i1)
+        runs of indices[i0:i1]
+    """
+    if len(indices) == 0:
+        return []
+    max_gap = max_gap_bytes // nbytes_frame
+    max_run = max(1, max_run_bytes // nbytes_frame)
+    runs = []
+    i0 = 0
+    for i in range(1, len(indices)):
+        if indices[i] - indices[i - 1] - 1 > max_gap or indices[i] - indices[i0] >= max_run:
+            runs.append((i0, i))
+            i0 = i
+    runs.append((i0, len(indices)))
+    return runs
+
+
+def read_frames(file, indices: Sequence[int], Ly: int, Lx: int) -> np.ndarray:
+    """
+    Returns the int16 frames at "indices" of a binary file of Ly x Lx frames, reading sorted runs of nearby frames
+    (see coalesce_runs) with positioned reads that do not move the file pointer.
+    """
+    nbytes_frame = 2 * Ly * Lx
+    indices = np.asarray(indices, dtype=np.int64)
+    uniq, inverse = np.unique(indices, return_inverse=True)
+    frames = np.empty((len(uniq), Ly, Lx), np.int16)
+    for i0, i1 in coalesce_runs(uniq, nbytes_frame):
+        first, last = uniq[i0], uniq[i1 - 1]
+        if last - first + 1 == i1 - i0:
+            pread_into(file, frames[i0:i1], nbytes_frame * first)
+        else:
+            run = np.empty((last - first + 1, Ly, Lx), np.int16)
+            pread_into(file, run, nbytes_frame * first)
+            frames[i0:i1] = run[uniq[i0:i1] - first]
+    if len(uniq) == len(indices) and np.array_equal(uniq, indices):
+        return frames
+    return frames[inverse.ravel()]
+
+
+def pread_into(file, buffer: np.ndarray, offset: int) -> None:
+    """reads buffer.nbytes bytes of file at offset into buffer, without moving the file pointer."""
+    view = memoryview(buffer).cast('B')
+    nread = 0
+    if hasattr(os, 'preadv'):
+        fd = file.fileno()
+        while nread < len(view):
+            n = os.preadv(fd, [view[nread:]], offset + nread)
+            if n == 0:
+                raise EOFError('frame %d beyond end of binary file' % ((offset + nread) // buffer[0].nbytes))
+            nread += n
+    else:
+        with temporary_pointer(file) as f:
+            f.seek(offset)
+            while nread < len(view):
+                n = f.readinto(view[nread:])
+                if not n:
+                    raise EOFError('frame %d beyond end of binary file' % ((offset + nread) // buffer[0].nbytes))
+                nread += n
+
+
 @contextmanager
 def temporary_pointer(file):
     """context manager that resets file pointer location to its original place upon exit."""
@@ -321,10 +784,210 @@ def temporary_pointer(file):
     yield file
     file.seek(orig_pointer)
 
+def tile_slices(Ly: int, Lx: int, tile_size: int = 32):
+    """ row-major list of the (y slice, x slice) of each tile_size x tile_size tile of an Ly x Lx frame """
+    return [(slice(y, min(y + tile_size, Ly)), slice(x, min(x + tile_size, Lx)))
+            for y in range(0, Ly, tile_size) for x in range(0, Lx, tile_size)]
+
+
+def write_tiled(f, tiled_filename: str, tile_size: int = 32, batch_size: int = 500) -> None:
+    """
+    Writes a tile-major, time-contiguous copy of the frames of binary file f to tiled_filename.
+
+    The frame is split into tile_size x tile_size tiles (smaller at the bottom and right edges), stored one after
+    another in row-major order; each tile stores the full time series of its pixels one after another, so that the
+    traces of a set of pixels are read from the tiles under them only (see TiledBinaryFile).
+
+    Parameters
+    ----------
+    f: BinaryFile
+        The (registered) movie to copy, read in batches with f.iter_frames
+    tiled_filename: str
+        The filename of the tiled copy
+    tile_size: int
+        The height and width of the tiles
+    batch_size: int
+        The number of frames read from f at a time
+    """
+    n_frames, Ly, Lx = f.shape
+    tiled = np.memmap(tiled_filename, mode='w+', dtype=np.int16, shape=(max(1, n_frames * Ly * Lx),))
+    tiles = []
+    offset = 0
+    for ys, xs in tile_slices(Ly, Lx, tile_size):
+        npix = (ys.stop - ys.start) * (xs.stop - xs.start)
+        tiles.append((ys, xs, tiled[offset:offset + npix * n_frames].reshape(npix, n_frames)))
+        offset += npix * n_frames
+    t0 = 0
+    for _, frames in f.iter_frames(batch_size=batch_size, dtype=np.int16):
+        t1 = t0 + frames.shape[0]
+        for ys, xs, tile in tiles:
+            tile[:, t0:t1] = frames[:, ys, xs].reshape(t1 - t0, -1).T
+        t0 = t1
+    tiled.flush()
+    del tiled, tiles
+
+
+class TiledBinaryFile:
+
+    def __init__(self, Ly: int, Lx: int, read_filename: str, tile_size: int = 32):
+        """
+        Opens a tile-major copy of a Suite2p binary file written by write_tiled for reading pixel traces
+
+        Parameters
+        ----------
+        Ly: int
+            The height of each frame
+        Lx: int
+            The width of each frame
+        read_filename: str
+            The filename of the tiled file
+        tile_size: int
+            The height and width of the tiles the file was written with
+        """
+        self.Ly = Ly
+        self.Lx = Lx
+        self.tile_size = tile_size
+        self.read_filename = read_filename
+        self.read_file = open(read_filename, mode='rb')
+        self.tiles = tile_slices(Ly, Lx, tile_size)
+        npix = [(ys.stop - ys.start) * (xs.stop - xs.start) for ys, xs in self.tiles]
+        self.tile_offsets = np.concatenate([[0], np.cumsum(npix)[:-1]]).astype(np.int64)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self) -> None:
+        """
+        Closes the file.
+        """
+        self.read_file.close()
+
+    @property
+    def n_frames(self) -> int:
+        """ total number of frames in the file """
+        return int(os.path.getsize(self.read_filename) // (2 * self.Ly * self.Lx))
+
+    def tile_index(self, ipix: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the tile of each pixel of ipix (in Ly*Lx coordinates) and the index of the pixel within its tile.
+        """
+        ypix, xpix = np.unravel_index(np.asarray(ipix, dtype=np.int64), (self.Ly, self.Lx))
+        ntx = -(-self.Lx // self.tile_size)
+        ty, tx = ypix // self.tile_size, xpix // self.tile_size
+        tile_width = np.minimum(self.tile_size, self.Lx - tx * self.tile_size)
+        return ty * ntx + tx, (ypix - ty * self.tile_size) * tile_width + (xpix - tx * self.tile_size)
+
+    def read_tile(self, k: int) -> np.ndarray:
+        """ returns the time series of the pixels of tile k, size [pixels x frames] """
+        ys, xs = self.tiles[k]
+        n_frames = self.n_frames
+        tile = np.empty(((ys.stop - ys.start) * (xs.stop - xs.start), n_frames), np.int16)
+        pread_into(self.read_file, tile, 2 * self.tile_offsets[k] * n_frames)
+        return tile
+
+    def pixel_traces(self, ipix: np.ndarray, dtype=np.float32) -> np.ndarray:
+        """
+        Returns the time series of pixels ipix (in Ly*Lx coordinates), size [len(ipix) x frames].
+
+        Only the tiles under the pixels are read.
+        """
+        tile_ids, tile_pix = self.tile_index(ipix)
+        traces = np.empty((len(tile_ids), self.n_frames), dtype)
+        for k in np.unique(tile_ids):
+            in_tile = tile_ids == k
+            traces[in_tile] = self.read_tile(k)[tile_pix[in_tile]]
+        return traces
+
+
+def pyramid_filename(filename: str, factor: int) -> str:
+    """ filename of the level of the temporal pyramid of binary file "filename" binned by factor (data_bin4x.bin) """
+    root, ext = os.path.splitext(filename)
+    return f'{root}_bin{int(factor)}x{ext}'
+
+
+def pyramid_levels(filename: str) -> dict:
+    """ returns {factor: filename} of the existing levels of the temporal pyramid of binary file "filename" """
+    root, ext = os.path.splitext(filename)
+    folder, name = os.path.split(root)
+    prefix, suffix = f'{name}_bin', f'x{ext}'
+    levels = {}
+    for fname in os.listdir(folder or '.'):
+        factor = fname[len(prefix):-len(suffix)]
+        if fname.startswith(prefix) and fname.endswith(suffix) and factor.isdigit():
+            levels[int(factor)] = os.path.join(folder, fname)
+    return dict(sorted(levels.items()))
+
+
+class TemporalPyramidWriter:
+
+    def __init__(self, filename: str, factors: Sequence[int], Ly: int, Lx: int):
+        """
+        Writes temporally binned copies of a movie next to binary file "filename" while its frames are written.
+
+        Frame i of the level binned by factor is the mean of frames factor * i to factor * (i + 1) - 1 (the last bin
+        averages the remaining frames), saved as int16 in pyramid_filename(filename, factor).
+
+        Parameters
+        ----------
+        filename: str
+            The filename of the binary file the frames are written to
+        factors: list of int
+            The bin sizes of the levels (factors <= 1 are ignored)
+        Ly: int
+            The height of each frame
+        Lx: int
+            The width of each frame
+        """
+        self.factors = sorted(set(int(factor) for factor in factors if int(factor) > 1))
+        self.filenames = [pyramid_filename(filename, factor) for factor in self.factors]
+        self.files = [open(fname, mode='wb') for fname in self.filenames]
+        self._sums = [np.zeros((Ly, Lx), np.float32) for _ in self.factors]
+        self._counts = [0 for _ in self.factors]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def write(self, frames: np.ndarray) -> None:
+        """ bins the next batch of frames into every level """
+        for n, factor in enumerate(self.factors):
+            # complete the bin started in the previous batch
+            take = min(factor - self._counts[n], len(frames))
+            self._sums[n] += frames[:take].sum(axis=0, dtype=np.float32)
+            self._counts[n] += take
+            if self._counts[n] == factor:
+                self._emit(n)
+            rest = frames[take:]
+            nbins = len(rest) // factor
+            if nbins:
+                binned = rest[:nbins * factor].reshape(nbins, factor, *rest.shape[1:]).mean(axis=1, dtype=np.float32)
+                self.files[n].write(to_int16(binned))
+            if len(rest) > nbins * factor:
+                self._sums[n] += rest[nbins * factor:].sum(axis=0, dtype=np.float32)
+                self._counts[n] += len(rest) - nbins * factor
+
+    def _emit(self, n: int) -> None:
+        self.files[n].write(to_int16(self._sums[n] / self._counts[n]))
+        self._sums[n][:] = 0
+        self._counts[n] = 0
+
+    def close(self) -> None:
+        """ writes the last (partial) bins and closes the level files """
+        for n in range(len(self.factors)):
+            if self._counts[n] > 0:
+                self._emit(n)
+            self.files[n].close()
+
+
 class BinaryFileCombined:
 
     def __init__(self, LY: int, LX: int, Ly: np.ndarray, Lx: np.ndarray, 
-                 dy: np.ndarray, dx: np.ndarray, read_filenames: str):
+                 dy: np.ndarray, dx: np.ndarray, read_filenames: str, n_threads: Optional[int] = None):
         """
         Creates/Opens a Suite2p BinaryFile for reading image data across planes
 
@@ -344,6 +1007,8 @@ class BinaryFileCombined:
             The x-positions of each frame
         read_filenames: array of str
             The filenames of the files to read from
+        n_threads: int
+            The number of planes read concurrently (optional, default min(number of planes, 8))
         """
         self.LY = LY
         self.LX = LX
@@ -354,6 +1019,8 @@ class BinaryFileCombined:
         self.read_filenames = read_filenames
         
         self.read_files = [open(read_filename, mode='rb') for read_filename in self.read_filenames]
+        self.n_threads = n_threads if n_threads is not None else min(len(self.read_files), 8)
+        self._pool = None
         self._index = 0
         self._can_read = True
 
@@ -367,6 +1034,9 @@ class BinaryFileCombined:
         """
         Closes the file.
         """
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
         for n in range(len(self.read_files)):
             self.read_files[n].close()
 
@@ -405,21 +1075,85 @@ class BinaryFileCombined:
         if not self._can_read:
             raise IOError("BinaryFile needs to write before it can read again.")
 
-        for n, (nbytesr, read_file) in enumerate(zip(self.nbytesread, self.read_files)):
-            nbytes = nbytesr * batch_size
-            buff = read_file.read(nbytes)
-            data = np.frombuffer(buff, dtype=np.int16, offset=0).reshape(-1, self.Ly[n], self.Lx[n]).astype(dtype)
-            if data.size == 0:
-                return None
-            if n==0:
-                data_all = np.zeros((data.shape[0], self.LY, self.LX), dtype=np.int16)
-            data_all[:, self.dy[n]:self.dy[n]+self.Ly[n], self.dx[n]:self.dx[n]+self.Lx[n]] = data
-            
-        indices = np.arange(self._index, self._index + data.shape[0])
-        self._index += data.shape[0]
-        
+        indices = np.arange(self._index, min(self._index + batch_size, self.n_frames))
+        if indices.size == 0:
+            return None
+        data_all = self.read_window(indices, dtype=dtype)
+        self._index += indices.size
+
         return indices, data_all
 
+    def __getitem__(self, items):
+        """ combined[frames, y0:y1, x0:x1] reads a window of the canvas, see read_window """
+        frame_indices, *crop = items if isinstance(items, tuple) else (items,)
+        if isinstance(frame_indices, (int, np.integer)):
+            frame_indices = [frame_indices]
+        elif isinstance(frame_indices, slice):
+            frame_indices = np.arange(self.n_frames)[frame_indices]
+        crop = crop + [slice(None)] * (2 - len(crop))
+        y_range, x_range = [s.indices(L)[:2] for s, L in zip(crop, (self.LY, self.LX))]
+        return self.read_window(frame_indices, y_range=y_range, x_range=x_range)
+
+    def overlapping_planes(self, y_range: Tuple[int, int], x_range: Tuple[int, int]) -> np.ndarray:
+        """
+        Returns the indices of the planes whose placement on the canvas overlaps the window (y_range, x_range).
+        """
+        dy, dx = np.asarray(self.dy), np.asarray(self.dx)
+        Ly, Lx = np.asarray(self.Ly), np.asarray(self.Lx)
+        return np.nonzero((dy < y_range[1]) & (dy + Ly > y_range[0]) &
+                          (dx < x_range[1]) & (dx + Lx > x_range[0]))[0]
+
+    def read_window(self, indices: Sequence[int], y_range: Optional[Tuple[int, int]] = None,
+                    x_range: Optional[Tuple[int, int]] = None, dtype=np.int16) -> np.ndarray:
+        """
+        Returns the frames at "indices" of the window (y_range, x_range) of the combined canvas.
+
+        Only the planes overlapping the window are read, concurrently on a pool of n_threads threads,
+        and the file positions of sequential reads are not changed.
+
+        Parameters
+        ----------
+        indices: int array
+            The frame indices to get
+        y_range: int, int
+            The minimum and maximum y of the window on the canvas (default full height)
+        x_range: int, int
+            The minimum and maximum x of the window on the canvas (default full width)
+        dtype: np.dtype
+            The numpy data type of the returned frames
+
+        Returns
+        -------
+        frames: len(indices) x (y_range[1] - y_range[0]) x (x_range[1] - x_range[0])
+            The requested window, zero where no plane is placed
+        """
+        y_range = (0, self.LY) if y_range is None else (max(0, int(y_range[0])), min(self.LY, int(y_range[1])))
+        x_range = (0, self.LX) if x_range is None else (max(0, int(x_range[0])), min(self.LX, int(x_range[1])))
+        indices = np.asarray(indices, dtype=np.int64)
+        window = np.zeros((len(indices), max(0, y_range[1] - y_range[0]), max(0, x_range[1] - x_range[0])), dtype)
+        planes = self.overlapping_planes(y_range, x_range)
+        if len(planes) == 0 or len(indices) == 0:
+            return window
+
+        def read_plane(n):
+            # canvas and plane coordinates of the part of plane n inside the window
+            y0, y1 = max(y_range[0], self.dy[n]), min(y_range[1], self.dy[n] + self.Ly[n])
+            x0, x1 = max(x_range[0], self.dx[n]), min(x_range[1], self.dx[n] + self.Lx[n])
+            frames = read_frames(self.read_files[n], indices, self.Ly[n], self.Lx[n])
+            window[:, y0 - y_range[0]:y1 - y_range[0], x0 - x_range[0]:x1 - x_range[0]] = \
+                frames[:, y0 - self.dy[n]:y1 - self.dy[n], x0 - self.dx[n]:x1 - self.dx[n]]
+
+        if len(planes) == 1 or self.n_threads <= 1:
+            for n in planes:
+                read_plane(n)
+        else:
+            if self._pool is None:
+                self._pool = ThreadPoolExecutor(max_workers=self.n_threads)
+            # each plane file is read by a single task, so the positioned reads never share a file
+            for future in [self._pool.submit(read_plane, n) for n in planes]:
+                future.result()
+        return window
+
     def iter_frames(self, batch_size: int = 1, dtype=np.float32):
         """
         Iterates through each set of frames, depending on batch_size, yielding both the frame index and frame data.
@@ -1,6 +1,7 @@
 import os
 from natsort import natsorted
 import numpy as np
+import h5py
 from datetime import datetime
 import scipy
 import pathlib
@@ -34,6 +35,134 @@ def save_mat(ops, stat, F, Fneu, spks, iscell, redcell):
         }
     )
 
+def _chunked_dataset(group, name, arr, chunks, compression):
+    """ writes arr to group[name], chunked and compressed unless it is empty """
+    arr = np.asarray(arr)
+    if arr.size == 0 or arr.ndim == 0:
+        return group.create_dataset(name, data=arr)
+    chunks = tuple(max(1, min(c, s)) for c, s in zip(chunks, arr.shape))
+    return group.create_dataset(name, data=arr, chunks=chunks, compression=compression,
+                                shuffle=compression is not None)
+
+
+def save_h5(ops, stat, F, Fneu, spks, iscell, redcell, F_chan2=None, Fneu_chan2=None,
+            roi_chunk=256, time_chunk=1024, compression='gzip'):
+    """ saves the results of a plane (or the combined view) into a single HDF5 file 'Fall.h5'
+
+    traces are chunked along ROIs and time so that a subset of ROIs or a time window
+    can be loaded with load_h5 without reading the whole file
+
+    Parameters
+    ----------
+    ops : dictionary
+        'save_path'; numeric arrays are saved as datasets in 'ops', scalars and strings as its attributes
+    stat : array of dicts
+        each key is saved as a dataset in 'stat', keys of variable length per ROI are concatenated
+        and saved along with their offsets in 'stat/<key>_offsets'
+    F, Fneu, spks : 2D arrays
+        size [ncells x nframes]
+    iscell, redcell : 2D arrays
+    F_chan2, Fneu_chan2 : 2D arrays, optional
+        saved if not None
+    roi_chunk, time_chunk : int
+        chunk size of the traces along ROIs and time
+    compression : str or None
+        HDF5 compression filter ('gzip', 'lzf' or None)
+
+    Returns
+    -------
+    filename : str
+    """
+    filename = os.path.join(ops['save_path'], 'Fall.h5')
+    with h5py.File(filename, 'w') as f:
+        traces = {'F': F, 'Fneu': Fneu, 'spks': spks, 'F_chan2': F_chan2, 'Fneu_chan2': Fneu_chan2}
+        for key, trace in traces.items():
+            if trace is not None:
+                _chunked_dataset(f, key, np.asarray(trace, np.float32), (roi_chunk, time_chunk), compression)
+        f.create_dataset('iscell', data=np.asarray(iscell))
+        f.create_dataset('redcell', data=np.asarray(redcell))
+
+        g = f.create_group('stat')
+        g.attrs['ncells'] = len(stat)
+        keys = set().union(*[s.keys() for s in stat]) if len(stat) else set()
+        for key in sorted(keys):
+            if not all(key in s for s in stat):
+                continue
+            vals = [np.asarray(s[key]) for s in stat]
+            if any(v.dtype == object for v in vals):
+                continue
+            if all(v.shape == vals[0].shape for v in vals):
+                _chunked_dataset(g, key, np.stack(vals), (roi_chunk,) + vals[0].shape, compression)
+            else:
+                lengths = np.array([v.size for v in vals], np.int64)
+                offsets = np.concatenate(([0], np.cumsum(lengths)))
+                _chunked_dataset(g, key, np.concatenate([v.ravel() for v in vals]), (2**16,), compression)
+                g.create_dataset(key + '_offsets', data=offsets)
+
+        g = f.create_group('ops')
+        for key, val in ops.items():
+            if isinstance(val, np.ndarray) and val.dtype != object:
+                _chunked_dataset(g, key, val, (256,) * val.ndim, compression)
+            elif isinstance(val, (bool, int, float, str, np.number, np.bool_)):
+                g.attrs[key] = val
+            elif isinstance(val, (pathlib.PurePath, datetime)):
+                g.attrs[key] = str(val)
+    return filename
+
+
+def load_h5(filename, rois=None, frames=None):
+    """ loads the results saved with save_h5, optionally only a subset of ROIs and frames
+
+    Parameters
+    ----------
+    filename : str
+        path to 'Fall.h5'
+    rois : slice or increasing array of ints, optional
+        ROIs to load (default all)
+    frames : slice, optional
+        time window to load (default all)
+
+    Returns
+    -------
+    results : dictionary
+        'F', 'Fneu', 'spks' (and 'F_chan2', 'Fneu_chan2' if saved) of size [len(rois) x len(frames)],
+        'iscell', 'redcell', 'stat' (array of dicts) for the loaded ROIs, and 'ops'
+    """
+    rois = slice(None) if rois is None else rois
+    frames = slice(None) if frames is None else frames
+    results = {}
+    with h5py.File(filename, 'r') as f:
+        for key in ['F', 'Fneu', 'spks', 'F_chan2', 'Fneu_chan2']:
+            if key in f:
+                results[key] = f[key][rois, frames] if f[key].size else f[key][()]
+        for key in ['iscell', 'redcell']:
+            val = f[key][()]
+            results[key] = val[rois] if val.ndim and len(val) else val
+
+        g = f['stat']
+        iroi = np.arange(g.attrs['ncells'])[rois]
+        stat = [{} for _ in iroi]
+        for key in g:
+            if key.endswith('_offsets'):
+                continue
+            if key + '_offsets' in g:
+                offsets = g[key + '_offsets'][()]
+                for s, i in zip(stat, iroi):
+                    s[key] = g[key][offsets[i]:offsets[i+1]]
+            else:
+                vals = g[key][()][iroi]
+                for s, v in zip(stat, vals):
+                    s[key] = v
+        results['stat'] = np.array(stat, dtype=object)
+
+        g = f['ops']
+        ops = dict(g.attrs)
+        for key in g:
+            ops[key] = g[key][()]
+        results['ops'] = ops
+    return results
+
+
 def compute_dydx(ops1):
     ops = ops1[0].copy()
     dx = np.zeros(len(ops1), np.int64)
@@ -195,6 +324,8 @@ def combined(save_folder, save=True):
         if ops.get('save_mat'):
             matpath = os.path.join(ops['save_path'],'Fall.mat')
             save_mat(ops, stat, F, Fneu, spks, iscell, redcell)
+        if ops.get('save_h5'):
+            save_h5(ops, stat, F, Fneu, spks, iscell, redcell)
             
     return stat, ops, F, Fneu, spks, iscell[:,0], iscell[:,1], redcell[:,0], redcell[:,1], hasred
 
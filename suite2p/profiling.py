@@ -0,0 +1,157 @@
+"""
+Stage profiler recording wall time, cpu time, memory and file io of (nested) pipeline stages.
+
+Stages are recorded on the active profiler, so that they can be marked anywhere in the pipeline
+without passing the profiler around; when no profiler is active, stage() does nothing:
+
+    with profiling.activate(profiling.StageProfiler()) as profiler:
+        with profiling.stage('registration'):
+            ...
+    profiler.save_json('profile.json')
+    profiler.save_chrome_trace('profile_trace.json')
+"""
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+# profiler that stage() records to, set with activate()
+_active = None
+
+
+def _rss():
+    """ resident set size of this process in bytes (0 if unavailable) """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return 0
+
+
+def _peak_rss():
+    """ high-water mark of the resident set size of this process in bytes (0 if unavailable) """
+    try:
+        import resource
+    except ImportError:
+        # no resource module on windows, where psutil reports the peak working set
+        try:
+            import psutil
+        except ImportError:
+            return 0
+        memory = psutil.Process().memory_info()
+        return getattr(memory, 'peak_wset', memory.rss)
+    # ru_maxrss is in kilobytes on linux and bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def _io_bytes():
+    """ (bytes read, bytes written) by this process through file io syscalls ((0, 0) if unavailable) """
+    try:
+        with open('/proc/self/io') as f:
+            counters = dict(line.split(':') for line in f.read().splitlines())
+        return int(counters['rchar']), int(counters['wchar'])
+    except (OSError, KeyError, ValueError):
+        return 0, 0
+
+
+class StageProfiler:
+    """
+    Records one event per stage with its wall time, cpu time (of the whole process), resident memory,
+    memory high-water mark and bytes read and written during the stage.
+
+    Stages can be nested and recorded from several threads; each event stores its depth and thread.
+    """
+
+    def __init__(self):
+        self.events = []
+        self._t0 = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def stage(self, name, **args):
+        """ records the enclosed code as stage name, args (e.g. batch indices) are stored with the event """
+        depth = getattr(self._local, 'depth', 0)
+        self._local.depth = depth + 1
+        read0, written0 = _io_bytes()
+        cpu0 = time.process_time()
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            t1 = time.perf_counter()
+            cpu1 = time.process_time()
+            read1, written1 = _io_bytes()
+            self._local.depth = depth
+            event = {
+                'name': name,
+                'start': t0 - self._t0,
+                'wall': t1 - t0,
+                'cpu': cpu1 - cpu0,
+                'rss': _rss(),
+                'peak_rss': _peak_rss(),
+                'bytes_read': read1 - read0,
+                'bytes_written': written1 - written0,
+                'depth': depth,
+                'thread': threading.get_ident(),
+                'args': args,
+            }
+            with self._lock:
+                self.events.append(event)
+
+    def summary(self):
+        """ total wall time, cpu time, bytes read and written, number of calls and peak memory per stage name """
+        totals = {}
+        for event in self.events:
+            total = totals.setdefault(event['name'], {'calls': 0, 'wall': 0., 'cpu': 0., 'bytes_read': 0,
+                                                      'bytes_written': 0, 'peak_rss': 0})
+            total['calls'] += 1
+            for key in ['wall', 'cpu', 'bytes_read', 'bytes_written']:
+                total[key] += event[key]
+            total['peak_rss'] = max(total['peak_rss'], event['peak_rss'])
+        return totals
+
+    def save_json(self, filename):
+        """ saves the per-stage summary and all events """
+        with open(filename, 'w') as f:
+            json.dump({'summary': self.summary(), 'events': self.events}, f, indent=1, default=str)
+
+    def save_chrome_trace(self, filename):
+        """ saves the events in chrome trace event format (open with chrome://tracing or ui.perfetto.dev) """
+        pid = os.getpid()
+        trace = []
+        for event in sorted(self.events, key=lambda e: e['start']):
+            args = {key: event[key] for key in ['cpu', 'rss', 'peak_rss', 'bytes_read', 'bytes_written']}
+            args.update(event['args'])
+            trace.append({
+                'name': event['name'], 'cat': 'suite2p', 'ph': 'X', 'pid': pid, 'tid': event['thread'],
+                'ts': event['start'] * 1e6, 'dur': event['wall'] * 1e6, 'args': args,
+            })
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f, default=str)
+
+
+@contextmanager
+def activate(profiler):
+    """ makes profiler the target of stage() in the enclosed code, restores the previous one on exit """
+    global _active
+    previous, _active = _active, profiler
+    try:
+        yield profiler
+    finally:
+        _active = previous
+
+
+def get_active():
+    """ returns the active profiler (None if profiling is off) """
+    return _active
+
+
+def stage(name, **args):
+    """ context manager recording the enclosed code as stage name on the active profiler (no-op if none) """
+    if _active is None:
+        return nullcontext()
+    return _active.stage(name, **args)
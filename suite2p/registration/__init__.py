@@ -1,3 +1,3 @@
-from .register import register_binary
+from .register import register_binary, open_registered
 from .metrics import get_pc_metrics
 from .zalign import compute_zpos
@@ -13,6 +13,7 @@ except ImportError:
     HAS_CV2 = False
 
 from . import rigid, nonrigid, utils, bidiphase
+from .register import open_registered
 from .. import io
 
 def pclowhigh(mov, nlowhigh, nPC, random_state):
@@ -222,9 +223,8 @@ def get_pc_metrics(ops, use_red=False):
     nPC = ops['reg_metric_n_pc'] if 'reg_metric_n_pc' in ops else 30
     # n frames to pick from full movie
     nsamp = min(2000 if ops['nframes'] < 5000 or ops['Ly'] > 700 or ops['Lx'] > 700 else 5000, ops['nframes'])
-    with io.BinaryFile(Lx=ops['Lx'], Ly=ops['Ly'],
-                       read_filename=ops['reg_file_chan2'] if use_red and 'reg_file_chan2' in ops else ops['reg_file']
-                       ) as f:
+    # sampled frames are read in sorted runs of nearby frames
+    with open_registered(ops, chan2=use_red and 'reg_file_chan2' in ops) as f:
         mov = f[np.linspace(0, ops['nframes'] - 1, nsamp).astype('int')]
         mov = mov[:, ops['yrange'][0]:ops['yrange'][-1], ops['xrange'][0]:ops['xrange'][-1]]
     pclow, pchigh, sv, ops['tPC'] = pclowhigh(mov, nlowhigh=np.minimum(300, int(ops['nframes'] / 2)),
@@ -6,7 +6,7 @@ from numba import float32, njit, prange
 from numpy import fft
 from scipy.fftpack import next_fast_len
 
-from .utils import addmultiply, spatial_taper, gaussian_fft, kernelD2, mat_upsample, convolve, convolve_faster
+from .utils import addmultiply, addmultiply_real, is_half_spectrum, reference_fft_shape, spatial_taper, gaussian_fft, kernelD2, mat_upsample, convolve
 
 
 def calculate_nblocks(L: int, block_size: int = 128) -> Tuple[int, int]:
@@ -63,7 +63,8 @@ def make_blocks(Ly, Lx, block_size=(128, 128)):
     return yblock, xblock, [ny, nx], block_size, NRsm
 
 
-def phasecorr_reference(refImg0: np.ndarray, maskSlope, smooth_sigma, yblock: np.ndarray, xblock: np.ndarray):
+def phasecorr_reference(refImg0: np.ndarray, maskSlope, smooth_sigma, yblock: np.ndarray, xblock: np.ndarray,
+                        real: bool = False, pad_fft: bool = False):
     """
     Computes taper and fft'ed reference image for phasecorr.
 
@@ -74,6 +75,10 @@ def phasecorr_reference(refImg0: np.ndarray, maskSlope, smooth_sigma, yblock: np
     smooth_sigma
     yblock: float array
     xblock: float array
+    real: bool
+        whether cfRefImg holds the half spectra of the blocks (for real-input FFTs)
+    pad_fft: bool
+        whether to pad the blocks to a size that is fast to transform, if they are not one already
     
     Returns
     -------
@@ -85,8 +90,10 @@ def phasecorr_reference(refImg0: np.ndarray, maskSlope, smooth_sigma, yblock: np
     nb, Ly, Lx = len(yblock), yblock[0][1] - yblock[0][0], xblock[0][1] - xblock[0][0]
     dims = (nb, Ly, Lx)
     cfRef_dims = dims
-    gaussian_filter = gaussian_fft(smooth_sigma, *cfRef_dims[1:])
-    cfRefImg1 = np.empty(cfRef_dims, 'complex64')
+    pLy, pLx = reference_fft_shape(Ly, Lx, real=real, pad_fft=pad_fft)
+    nfreq = pLx // 2 + 1 if real else pLx
+    gaussian_filter = gaussian_fft(smooth_sigma, pLy, pLx)[:, :nfreq]
+    cfRefImg1 = np.empty((nb, pLy, nfreq), 'complex64')
 
     maskMul = spatial_taper(maskSlope, *refImg0.shape)
     maskMul1 = np.empty(dims, 'float32')
@@ -101,7 +108,10 @@ def phasecorr_reference(refImg0: np.ndarray, maskSlope, smooth_sigma, yblock: np
         maskOffset1_n[:] = refImg.mean() * (1. - maskMul1_n)
 
         # gaussian filter
-        cfRefImg1_n[:] = np.conj(fft.fft2(refImg))
+        if (pLy, pLx) != (Ly, Lx):
+            # padded with its mean like the blocks (see utils.pad_frames)
+            refImg = refImg - refImg.mean()
+        cfRefImg1_n[:] = np.conj(fft.fft2(refImg, (pLy, pLx)))[:, :nfreq]
         cfRefImg1_n /= 1e-5 + np.absolute(cfRefImg1_n)
         cfRefImg1_n[:] *= gaussian_filter
 
@@ -135,7 +145,7 @@ def getSNR(cc: np.ndarray, lcorr: int, lpad: int) -> float:
 
 
 def phasecorr(data: np.ndarray, maskMul, maskOffset, cfRefImg, snr_thresh, NRsm, xblock, yblock, maxregshiftNR, subpixel: int = 10, lpad: int = 3,
-                convolve_method='old'):
+                convolve_method='old', fft_shape=None):
     """
     Compute phase correlations for each block
     
@@ -157,6 +167,8 @@ def phasecorr(data: np.ndarray, maskMul, maskOffset, cfRefImg, snr_thresh, NRsm,
     subpixel: int
     lpad: int
         upsample from a square +/- lpad
+    fft_shape: (int, int)
+        FFT size of the blocks of cfRefImg (utils.reference_fft_shape), needed if they are padded
 
     Returns
     -------
@@ -168,7 +180,7 @@ def phasecorr(data: np.ndarray, maskMul, maskOffset, cfRefImg, snr_thresh, NRsm,
     Kmat, nup = mat_upsample(lpad=3)
 
     nimg = data.shape[0]
-    ly, lx = cfRefImg.shape[-2:]
+    ly, lx = int(yblock[0][1] - yblock[0][0]), int(xblock[0][1] - xblock[0][0])
 
     # maximum registration shift allowed
     lcorr = int(np.minimum(np.round(maxregshiftNR), np.floor(np.minimum(ly, lx) / 2.) - lpad))
@@ -179,17 +191,8 @@ def phasecorr(data: np.ndarray, maskMul, maskOffset, cfRefImg, snr_thresh, NRsm,
     for n in range(nb):
         yind, xind = yblock[n], xblock[n]
         Y[:,n] = data[:, yind[0]:yind[-1], xind[0]:xind[-1]]
-    Y = addmultiply(Y, maskMul, maskOffset)
-    if convolve_method == 'fast_cpu':
-        Y = convolve_faster(mov=Y, img= cfRefImg)
-    elif convolve_method == 'old':
-        Y = convolve(mov=Y, img=cfRefImg)
-    elif convolve_method == 'part_gpu':
-        Y = convolve_part_gpu(mov=Y, img=cfRefImg)
-    elif convolve_method == 'full_gpu':
-        Y = convolve_full_gpu(mov=Y, img=cfRefImg)
-    elif convolve_method == 'tf_gpu':
-        Y = convolve_tf_gpu(mov=Y, img=cfRefImg)
+    Y = (addmultiply_real if is_half_spectrum(cfRefImg, lx) else addmultiply)(Y, maskMul, maskOffset)
+    Y = convolve(mov=Y, img=cfRefImg, backend=convolve_method, fft_shape=fft_shape)
 
     # calculate ccsm
     lhalf = lcorr + lpad
@@ -216,26 +219,51 @@ def phasecorr(data: np.ndarray, maskMul, maskOffset, cfRefImg, snr_thresh, NRsm,
                 ccsm[n, ism, :, :] = cc
             snr[ism] = getSNR(cc, lcorr, lpad)
 
-    # calculate ymax1, xmax1, cmax1
-    mdpt = nup // 2
-    ymax1 = np.empty((nimg, nb), np.float32)
-    cmax1 = np.empty((nimg, nb), np.float32)
-    xmax1 = np.empty((nimg, nb), np.float32)
-    ymax = np.empty((nb,), np.int32)
-    xmax = np.empty((nb,), np.int32)
-    for t in range(nimg):
-        ccmat = np.empty((nb, 2*lpad+1, 2*lpad+1), np.float32)
-        for n in range(nb):
-            ix = np.argmax(ccsm[n, t][lpad:-lpad, lpad:-lpad], axis=None)
-            ym, xm = np.unravel_index(ix, (2 * lcorr + 1, 2 * lcorr + 1))
-            ccmat[n] = ccsm[n, t][ym:ym + 2 * lpad + 1, xm:xm + 2 * lpad + 1]
-            ymax[n], xmax[n] = ym - lcorr, xm - lcorr
-        ccb = ccmat.reshape(nb, -1) @ Kmat
-        cmax1[t] = np.amax(ccb, axis=1)
-        ymax1[t], xmax1[t] = np.unravel_index(np.argmax(ccb, axis=1), (nup, nup))
-        ymax1[t] = (ymax1[t] - mdpt) / subpixel + ymax
-        xmax1[t] = (xmax1[t] - mdpt) / subpixel + xmax
+    # calculate ymax1, xmax1, cmax1 for all blocks and frames at once
+    ymax1, xmax1, cmax1 = find_subpixel_peaks(ccsm, lcorr=lcorr, lpad=lpad, Kmat=Kmat, nup=nup, subpixel=subpixel)
+    return ymax1.T, xmax1.T, cmax1.T
+
+
+def find_subpixel_peaks(ccsm: np.ndarray, lcorr: int, lpad: int, Kmat: np.ndarray, nup: int, subpixel: int = 10):
+    """
+    Finds the integer peak of each phase-correlation map and refines it with the upsampling matrix Kmat
+
+    Parameters
+    ----------
+    ccsm: nb x nimg x (2*lcorr+2*lpad+1) x (2*lcorr+2*lpad+1)
+        phase-correlation maps for each block and frame
+    lcorr: int
+        maximum integer shift
+    lpad: int
+        upsample from a square +/- lpad around the integer peak
+    Kmat: (2*lpad+1)**2 x nup**2
+        upsampling matrix from mat_upsample
+    nup: int
+        number of upsampled points along each dimension
+    subpixel: int
+
+    Returns
+    -------
+    ymax1: nb x nimg
+    xmax1: nb x nimg
+    cmax1: nb x nimg
+    """
+    nb, nimg = ccsm.shape[:2]
+    ncorr = 2 * lcorr + 1
+    ix = np.argmax(ccsm[:, :, lpad:-lpad, lpad:-lpad].reshape(nb, nimg, -1), axis=-1)
+    ym, xm = np.unravel_index(ix, (ncorr, ncorr))
+
+    # gather the (2*lpad+1) x (2*lpad+1) neighborhood of every peak in one indexing operation
+    win = np.arange(2 * lpad + 1)
+    ccmat = ccsm[np.arange(nb)[:, None, None, None], np.arange(nimg)[None, :, None, None],
+                 ym[:, :, None, None] + win[:, None], xm[:, :, None, None] + win[None, :]]
+    ccb = ccmat.astype(np.float32).reshape(nb, nimg, -1) @ Kmat
 
+    mdpt = nup // 2
+    cmax1 = np.amax(ccb, axis=-1).astype(np.float32)
+    yup, xup = np.unravel_index(np.argmax(ccb, axis=-1), (nup, nup))
+    ymax1 = ((yup - mdpt) / subpixel + (ym - lcorr)).astype(np.float32)
+    xmax1 = ((xup - mdpt) / subpixel + (xm - lcorr)).astype(np.float32)
     return ymax1, xmax1, cmax1
 
 
@@ -321,6 +349,30 @@ def block_interp(ymax1, xmax1, mshy, mshx, yup, xup):
         map_coordinates(xmax1[t], mshy, mshx, xup[t])  # x shifts for blocks to coordinate map
 
 
+def block_coordinates(Ly, Lx, nblocks, xblock, yblock):
+    """ coordinates of every row and column in units of blocks (block centers are integers), for upsampling block shifts
+
+    Parameters
+    ----------
+    Ly: int
+    Lx: int
+    nblocks: (int, int)
+    xblock: float array
+    yblock: float array
+
+    Returns
+    -------
+    iy : float32, Ly
+    ix : float32, Lx
+    """
+    yb = np.array(yblock[::nblocks[1]]).mean(axis=1)  # this recovers the coordinates of the meshgrid from (yblock, xblock)
+    xb = np.array(xblock[:nblocks[1]]).mean(axis=1)
+
+    iy = np.interp(np.arange(Ly), yb, np.arange(yb.size)).astype(np.float32)
+    ix = np.interp(np.arange(Lx), xb, np.arange(xb.size)).astype(np.float32)
+    return iy, ix
+
+
 def upsample_block_shifts(Lx, Ly, nblocks, xblock, yblock, ymax1, xmax1):
     """ upsample blocks of shifts into full pixel-wise maps for shifting
 
@@ -354,11 +406,7 @@ def upsample_block_shifts(Lx, Ly, nblocks, xblock, yblock, ymax1, xmax1):
     # includes centers of blocks AND edges of blocks
     # note indices are flipped for control points
     # block centers
-    yb = np.array(yblock[::nblocks[1]]).mean(axis=1)  # this recovers the coordinates of the meshgrid from (yblock, xblock)
-    xb = np.array(xblock[:nblocks[1]]).mean(axis=1)
-
-    iy = np.interp(np.arange(Ly), yb, np.arange(yb.size)).astype(np.float32)
-    ix = np.interp(np.arange(Lx), xb, np.arange(xb.size)).astype(np.float32)
+    iy, ix = block_coordinates(Ly=Ly, Lx=Lx, nblocks=nblocks, xblock=xblock, yblock=yblock)
     mshx, mshy = np.meshgrid(ix, iy)
 
     # interpolate from block centers to all points Ly x Lx
@@ -373,14 +421,85 @@ def upsample_block_shifts(Lx, Ly, nblocks, xblock, yblock, ymax1, xmax1):
     return yup, xup
 
 
+@njit(['int16[:, :, :], float32[:, :, :], float32[:, :, :], float32[:], float32[:], boolean, float32[:, :, :]',
+       'float32[:, :, :], float32[:, :, :], float32[:, :, :], float32[:], float32[:], boolean, float32[:, :, :]'],
+      parallel=True, cache=True)
+def shift_coordinates_blocks(data, ymax1, xmax1, iy, ix, bilinear, Y):
+    """
+    Shift data by the block shifts ymax1, xmax1 bilinearly upsampled pixel by pixel
+
+    Same result as block_interp followed by shift_coordinates, without the nimg x Ly x Lx shift maps
+
+    The kernel is only compiled for int16 and float32 data and float32 everything else; numba raises
+    a TypeError for other dtypes, which transform_data converts to float32 before calling it
+
+    Parameters
+    ----------
+    data : int16 or float32, nimg x Ly x Lx
+    ymax1 : float32, nimg x nblocks[0] x nblocks[1]
+        y shifts of blocks
+    xmax1 : float32, nimg x nblocks[0] x nblocks[1]
+        x shifts of blocks
+    iy : float32, Ly
+        block coordinate of each row (see block_coordinates)
+    ix : float32, Lx
+        block coordinate of each column (see block_coordinates)
+    bilinear : bool
+        bilinear interpolation of the data, if False the shifts are rounded (nearest neighbor)
+    Y : float32, nimg x Ly x Lx
+        shifted data
+    """
+    nimg, Ly, Lx = data.shape
+    nby, nbx = ymax1.shape[1], ymax1.shape[2]
+    for t in prange(nimg):
+        for i in range(Ly):
+            # upsampled shifts, as map_coordinates of the block shifts
+            byf = np.int32(iy[i])
+            by = iy[i] - byf
+            byf = min(nby - 1, max(0, byf))
+            byf1 = min(nby - 1, byf + 1)
+            for j in range(Lx):
+                bxf = np.int32(ix[j])
+                bx = ix[j] - bxf
+                bxf = min(nbx - 1, max(0, bxf))
+                bxf1 = min(nbx - 1, bxf + 1)
+                dy = np.float32(ymax1[t, byf, bxf] * (1 - by) * (1 - bx) + ymax1[t, byf, bxf1] * (1 - by) * bx +
+                                ymax1[t, byf1, bxf] * by * (1 - bx) + ymax1[t, byf1, bxf1] * by * bx)
+                dx = np.float32(xmax1[t, byf, bxf] * (1 - by) * (1 - bx) + xmax1[t, byf, bxf1] * (1 - by) * bx +
+                                xmax1[t, byf1, bxf] * by * (1 - bx) + xmax1[t, byf1, bxf1] * by * bx)
+                if not bilinear:
+                    dy = np.float32(np.round(dy))
+                    dx = np.float32(np.round(dx))
+
+                # bilinear interpolation of the data at the shifted coordinates
+                yc = np.float32(i) + dy
+                xc = np.float32(j) + dx
+                yf = np.int32(yc)
+                xf = np.int32(xc)
+                y = yc - yf
+                x = xc - xf
+                yf = min(Ly - 1, max(0, yf))
+                xf = min(Lx - 1, max(0, xf))
+                yf1 = min(Ly - 1, yf + 1)
+                xf1 = min(Lx - 1, xf + 1)
+                Y[t, i, j] = (np.float32(data[t, yf, xf]) * (1 - y) * (1 - x) +
+                              np.float32(data[t, yf, xf1]) * (1 - y) * x +
+                              np.float32(data[t, yf1, xf]) * y * (1 - x) +
+                              np.float32(data[t, yf1, xf1]) * y * x)
+
+
 def transform_data(data, nblocks, xblock, yblock, ymax1, xmax1, bilinear=True):
     """
     Piecewise affine transformation of data using block shifts ymax1, xmax1
+
+    The block shifts are upsampled to every pixel inside the interpolation kernel (shift_coordinates_blocks),
+    so no nimg x Ly x Lx shift maps are allocated (see upsample_block_shifts)
     
     Parameters
     ----------
 
     data : nimg x Ly x Lx
+        int16 or float32 data are shifted as they are, other dtypes are converted to float32
     nblocks: (int, int)
     xblock: float array
     yblock: float array
@@ -396,23 +515,15 @@ def transform_data(data, nblocks, xblock, yblock, ymax1, xmax1, bilinear=True):
     Y : float32, nimg x Ly x Lx
         shifted data
     """
-    _, Ly, Lx = data.shape
-    yup, xup = upsample_block_shifts(
-        Lx=Lx,
-        Ly=Ly,
-        nblocks=nblocks,
-        xblock=xblock,
-        yblock=yblock,
-        ymax1=ymax1,
-        xmax1=xmax1,
-    )
-    if not bilinear:
-        yup = np.round(yup)
-        xup = np.round(xup)
-
-    # use shifts and do bilinear interpolation
-    mshx, mshy = np.meshgrid(np.arange(Lx, dtype=np.float32), np.arange(Ly, dtype=np.float32))
+    nimg, Ly, Lx = data.shape
+    iy, ix = block_coordinates(Ly=Ly, Lx=Lx, nblocks=nblocks, xblock=xblock, yblock=yblock)
+    if data.dtype not in (np.int16, np.float32):
+        data = data.astype(np.float32)
     Y = np.zeros_like(data, dtype=np.float32)
-    shift_coordinates(data, yup, xup, mshy, mshx, Y)
+    shift_coordinates_blocks(
+        data,
+        np.ascontiguousarray(ymax1, dtype=np.float32).reshape(nimg, nblocks[0], nblocks[1]),
+        np.ascontiguousarray(xmax1, dtype=np.float32).reshape(nimg, nblocks[0], nblocks[1]),
+        iy, ix, bool(bilinear), Y,
+    )
     return Y
-
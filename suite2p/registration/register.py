@@ -6,7 +6,7 @@ from warnings import warn
 import numpy as np
 from scipy.signal import medfilt, medfilt2d
 
-from .. import io
+from .. import io, profiling, shmem_utils
 from . import bidiphase, utils, rigid, nonrigid
 
 
@@ -65,17 +65,27 @@ def compute_crop(xoff: int, yoff: int, corrXY, th_badframes, badframes, maxregsh
     return badframes, yrange, xrange
 
 
-def pick_initial_reference(frames: np.ndarray):
+def pick_initial_reference(frames: np.ndarray, bin_size: int = 1, n_seeds: int = None, seed: int = 0):
     """ computes the initial reference image
 
     the seed frame is the frame with the largest correlations with other frames;
     the average of the seed frame with its top 20 correlated pairs is the
     inital reference frame returned
 
+    the correlations are computed on frames binned spatially by bin_size, and only
+    n_seeds randomly sampled frames are tried as seed frames, so that the cost grows
+    linearly rather than quadratically with the number of frames
+
     Parameters
     ----------
     frames : 3D array, int16
         size [frames x Ly x Lx], frames from binary
+    bin_size : int (optional, default 1)
+        spatial binning of the frames for computing their correlations (0 bins frames to at most 128 x 128)
+    n_seeds : int (optional, default all frames)
+        number of frames tried as seed frames
+    seed : int (optional, default 0)
+        random seed for sampling the seed frames
 
     Returns
     -------
@@ -84,17 +94,32 @@ def pick_initial_reference(frames: np.ndarray):
 
     """
     nimg,Ly,Lx = frames.shape
-    frames = np.reshape(frames, (nimg,-1)).astype('float32')
-    frames = frames - np.reshape(frames.mean(axis=1), (nimg, 1))
-    cc = np.matmul(frames, frames.T)
-    ndiag = np.sqrt(np.diag(cc))
-    cc = cc / np.outer(ndiag, ndiag)
+    if bin_size == 0:
+        bin_size = int(np.ceil(max(Ly, Lx) / 128))
+    # sums of bin_size x bin_size pixels (the scale is removed by the normalization below)
+    Lyb, Lxb = Ly // bin_size, Lx // bin_size
+    if bin_size > 1:
+        binned = np.zeros((nimg, Lyb, Lxb), 'float32')
+        for iy in range(bin_size):
+            for ix in range(bin_size):
+                binned += frames[:, iy:Lyb * bin_size:bin_size, ix:Lxb * bin_size:bin_size]
+    else:
+        binned = frames.astype('float32')
+    binned = np.reshape(binned, (nimg, -1))
+    binned = binned - np.reshape(binned.mean(axis=1), (nimg, 1))
+    binned /= np.maximum(1e-10, np.linalg.norm(binned, axis=1))[:, np.newaxis]
+
+    if n_seeds is None or n_seeds >= nimg:
+        seeds = np.arange(nimg)
+    else:
+        seeds = np.sort(np.random.RandomState(seed).choice(nimg, n_seeds, replace=False))
+    cc = np.matmul(binned[seeds], binned.T)
     CCsort = -np.sort(-cc, axis = 1)
     bestCC = np.mean(CCsort[:, 1:20], axis=1);
     imax = np.argmax(bestCC)
     indsort = np.argsort(-cc[imax, :])
-    refImg = np.mean(frames[indsort[0:20], :], axis = 0)
-    refImg = np.reshape(refImg, (Ly,Lx))
+    refImg = np.mean(frames[indsort[0:20]].astype('float32'), axis = 0)
+    refImg = refImg - refImg.mean()
     return refImg
 
 
@@ -119,7 +144,7 @@ def compute_reference(ops, frames):
 
     """
     
-    refImg = pick_initial_reference(frames)
+    refImg = pick_initial_reference(frames, bin_size=ops.get('ref_bin_size', 1), n_seeds=ops.get('ref_n_seeds', None))
     if ops['1Preg']:
         if ops['pre_smooth']:
             refImg = utils.spatial_smooth(refImg, int(ops['pre_smooth']))
@@ -128,6 +153,8 @@ def compute_reference(ops, frames):
         frames = utils.spatial_high_pass(frames, int(ops['spatial_hp_reg']))
 
     niter = 8
+    ref_tol = ops.get('ref_tol', 0)
+    cmax_mean = None
     for iter in range(0, niter):
         # rigid registration
         ymax, xmax, cmax = rigid.phasecorr(
@@ -148,7 +175,13 @@ def compute_reference(ops, frames):
         for frame, dy, dx in zip(frames, ymax, xmax):
             frame[:] = rigid.shift_frame(frame=frame, dy=dy, dx=dx)
 
-        nmax = int(frames.shape[0] * (1. + iter) / (2 * niter))
+        # stop once the mean correlation with the reference no longer changes
+        converged = ref_tol > 0 and cmax_mean is not None and abs(cmax.mean() - cmax_mean) <= ref_tol * abs(cmax_mean)
+        cmax_mean = cmax.mean()
+        # the last reference averages the same number of frames as after all iterations
+        n_iter_avg = niter - 1 if converged else iter
+
+        nmax = int(frames.shape[0] * (1. + n_iter_avg) / (2 * niter))
         isort = np.argsort(-cmax)[1:nmax]
         # reset reference image
         refImg = frames[isort].mean(axis=0).astype(np.int16)
@@ -158,6 +191,8 @@ def compute_reference(ops, frames):
             dy=int(np.round(-ymax[isort].mean())),
             dx=int(np.round(-xmax[isort].mean()))
         )
+        if converged:
+            break
 
     return refImg
 
@@ -168,10 +203,16 @@ def compute_reference_masks(refImg, ops=None):
         refImg=refImg,
         maskSlope=ops['spatial_taper'] if ops['1Preg'] else 3 * ops['smooth_sigma'],
     )
+    # optionally half spectra for real-input FFTs, padded to fast FFT sizes
+    real, pad_fft = ops.get('real_fft', False), ops.get('pad_fft', False)
     cfRefImg = rigid.phasecorr_reference(
         refImg=refImg,
         smooth_sigma=ops['smooth_sigma'],
+        real=real,
+        pad_fft=pad_fft,
     )
+    # the padded FFT sizes of the reference spectra, which cannot always be told from their shapes
+    ops['fft_shape'] = utils.reference_fft_shape(*refImg.shape, real=real, pad_fft=pad_fft)
 
     if ops.get('nonrigid'):
         if 'yblock' not in ops:
@@ -184,13 +225,16 @@ def compute_reference_masks(refImg, ops=None):
             smooth_sigma=ops['smooth_sigma'],
             yblock=ops['yblock'],
             xblock=ops['xblock'],
+            real=real,
+            pad_fft=pad_fft,
         )
+        ops['fft_shape_NR'] = utils.reference_fft_shape(*maskMulNR.shape[-2:], real=real, pad_fft=pad_fft)
     else:
         maskMulNR, maskOffsetNR, cfRefImgNR = [], [], []
 
     return maskMul, maskOffset, cfRefImg, maskMulNR, maskOffsetNR, cfRefImgNR
 
-def register_frames(refAndMasks, frames, ops=None, base_shift=None, convolve_method='old', do_rigid=True):
+def register_frames(refAndMasks, frames, ops=None, base_shift=None, convolve_method=None, do_rigid=True):
     """ register frames to reference image 
     
     Parameters
@@ -226,10 +270,13 @@ def register_frames(refAndMasks, frames, ops=None, base_shift=None, convolve_met
         maskMul, maskOffset, cfRefImg, maskMulNR, maskOffsetNR, cfRefImgNR = compute_reference_masks(refImg, ops)
         
 
+    if convolve_method is None:
+        convolve_method = ops.get('fft_backend', 'old')
+
     if ops['bidiphase'] and not ops['bidi_corrected']:
         bidiphase.shift(frames, int(ops['bidiphase']))
 
-    fsmooth = frames.copy().astype(np.float32)
+    fsmooth = frames.astype(np.float32)
     if ops['smooth_sigma_time'] > 0:
         fsmooth = utils.temporal_smooth(data=fsmooth, sigma=ops['smooth_sigma_time'])
 
@@ -245,18 +292,23 @@ def register_frames(refAndMasks, frames, ops=None, base_shift=None, convolve_met
     
     if do_rigid:
         ymax, xmax, cmax = rigid.phasecorr(
-            data=rigid.apply_masks(data=fsmooth, maskMul=maskMul, maskOffset=maskOffset),
+            data=rigid.apply_masks(data=fsmooth, maskMul=maskMul, maskOffset=maskOffset,
+                                   real=utils.is_half_spectrum(cfRefImg, fsmooth.shape[-1])),
             cfRefImg=cfRefImg,
             maxregshift=ops['maxregshift'],
             smooth_sigma_time=ops['smooth_sigma_time'], convolve_method=convolve_method,
+            subpixel=ops['subpixel'] if ops.get('subpixel_rigid', False) else 1,
+            fft_shape=ops.get('fft_shape'),
         )
         if base_shift is not None:
             if ops['nonrigid']: print("base_shift with nonrigid on is broken!")
             ymax += base_shift[0]
             xmax += base_shift[1]
 
-        for frame, dy, dx in zip(frames, ymax, xmax):
-            frame[:] = rigid.shift_frame(frame=frame, dy=dy, dx=dx)
+        if ops.get('subpixel_rigid', False):
+            frames = rigid.shift_frames_subpixel(frames, ymax, xmax, backend=convolve_method)
+        else:
+            rigid.shift_frames_integer(frames, ymax, xmax)
     else:
         ymax = None; xmax = None; cmax = None;
 
@@ -264,10 +316,12 @@ def register_frames(refAndMasks, frames, ops=None, base_shift=None, convolve_met
     if ops['nonrigid']:
         # need to also shift smoothed data (if smoothing used)
         if ops['smooth_sigma_time'] or ops['1Preg']:
-            for fsm, dy, dx in zip(fsmooth, ymax, xmax):
-                fsm[:] = rigid.shift_frame(frame=fsm, dy=dy, dx=dx)
+            if ops.get('subpixel_rigid', False):
+                fsmooth = rigid.shift_frames_subpixel(fsmooth, ymax, xmax, backend=convolve_method)
+            else:
+                rigid.shift_frames_integer(fsmooth, ymax, xmax)
         else:
-            fsmooth = frames.copy()
+            fsmooth = frames.astype(np.float32)
 
         if ops.get('norm_frames', False):
             fsmooth = np.clip(fsmooth, ops['rmin'], ops['rmax'])
@@ -282,7 +336,8 @@ def register_frames(refAndMasks, frames, ops=None, base_shift=None, convolve_met
             xblock=ops['xblock'],
             yblock=ops['yblock'],
             maxregshiftNR=ops['maxregshiftNR'],
-            convolve_method=convolve_method
+            convolve_method=convolve_method,
+            fft_shape=ops.get('fft_shape_NR'),
         )
 
         frames = nonrigid.transform_data(
@@ -302,14 +357,137 @@ def shift_frames(frames, yoff, xoff, yoff1, xoff1, ops=None):
     if ops['bidiphase'] != 0 and not ops['bidi_corrected']:
         bidiphase.shift(frames, int(ops['bidiphase']))
     
-    for frame, dy, dx in zip(frames, yoff, xoff):
-        frame[:] = rigid.shift_frame(frame=frame, dy=dy, dx=dx)
+    if ops.get('subpixel_rigid', False):
+        frames = rigid.shift_frames_subpixel(frames, yoff, xoff, backend=ops.get('fft_backend', 'old'))
+    else:
+        rigid.shift_frames_integer(frames, yoff, xoff)
 
     if ops['nonrigid']:
         frames = nonrigid.transform_data(frames, nblocks=ops['nblocks'], xblock=ops['xblock'], yblock=ops['yblock'],
                                         ymax1=yoff1, xmax1=xoff1, bilinear=ops.get('bilinear_reg', True))
     return frames
 
+def open_registered(ops, chan2=False):
+    """
+    Opens the registered frames of the functional (or the other, if chan2) channel for reading: the registered binary,
+    or an io.RegisteredBinaryFile of the raw binary that shifts frames with shift_frames when they are read
+    (ops['lazy_registration']).
+    """
+    filename = io.registered_filename(ops, chan2=chan2)
+    if ops.get('lazy_registration', False):
+        return io.RegisteredBinaryFile(Ly=ops['Ly'], Lx=ops['Lx'], read_filename=filename, ops=ops,
+                                       shift_frames=shift_frames)
+    return io.BinaryFile(Ly=ops['Ly'], Lx=ops['Lx'], read_filename=filename)
+
+def register_chunk(ops, ref_params, read_filename, write_filename, batch_starts, k0=0, fft_backends=None):
+    """ registers the batches of frames starting at batch_starts and writes them at their offsets in write_filename
+
+    worker of register_binary_chunks, refAndMasks are loaded from the shared memory arrays described by ref_params
+    and the FFT backends chosen by the parent process ({(Ly, Lx): name}) are used
+
+    Returns
+    --------
+
+    rigid_offsets : list of [ymax, xmax, cmax] per batch
+
+    nonrigid_offsets : list of [ymax1, xmax1, cmax1] per batch (empty if not ops['nonrigid'])
+
+    mean_img : 2D array
+        sum of the registered frames divided by ops['nframes']
+
+    """
+    shmems, refAndMasks = zip(*[shmem_utils.load_shmem(params) for params in ref_params])
+    utils.set_fastest_fft_backends(fft_backends or {})
+    rigid_offsets, nonrigid_offsets = [], []
+    mean_img = np.zeros((ops['Ly'], ops['Lx']))
+    with io.BinaryFile(Ly=ops['Ly'], Lx=ops['Lx'], read_filename=read_filename) as f, \
+            open(write_filename, mode='r+b') as write_file:
+        n_frames = f.n_frames
+        for k, t0 in enumerate(batch_starts):
+            t1 = min(t0 + ops['batch_size'], n_frames)
+            frames = f[t0:t1]
+            frames, ymax, xmax, cmax, ymax1, xmax1, cmax1 = register_frames(list(refAndMasks), frames, ops)
+            rigid_offsets.append([ymax, xmax, cmax])
+            if ops['nonrigid']:
+                nonrigid_offsets.append([ymax1, xmax1, cmax1])
+            mean_img += frames.sum(axis=0) / ops['nframes']
+
+            write_file.seek(int(f.nbytesread) * t0)
+            write_file.write(io.binary.to_int16(frames))
+            if (ops['reg_tif'] if ops['functional_chan'] == ops['align_by_chan'] else ops['reg_tif_chan2']):
+                fname = io.generate_tiff_filename(
+                    functional_chan=ops['functional_chan'],
+                    align_by_chan=ops['align_by_chan'],
+                    save_path=ops['save_path'],
+                    k=k0 + k,
+                    ichan=True
+                )
+                io.save_tiff(mov=frames, fname=fname)
+    del refAndMasks
+    for shmem in shmems:
+        shmem.close()
+    return rigid_offsets, nonrigid_offsets, mean_img
+
+def register_binary_chunks(ops, refAndMasks, read_filename, write_filename, n_workers):
+    """ registers read_filename in n_workers processes, each registering a contiguous chunk of batches
+
+    refAndMasks are shared with the workers through shared memory; each worker writes its registered
+    frames at their byte offsets in write_filename. Chunks start on multiples of ops['batch_size'],
+    so the batches (and the results) are the same as when registering in a single process.
+
+    Returns
+    --------
+
+    rigid_offsets, nonrigid_offsets : lists of offsets per batch, in frame order
+
+    mean_img : 2D array
+        mean of the registered frames
+
+    """
+    with io.BinaryFile(Ly=ops['Ly'], Lx=ops['Lx'], read_filename=read_filename) as f:
+        n_frames = f.n_frames
+        nbytes = f.nbytes
+    if path.abspath(read_filename) != path.abspath(write_filename):
+        with open(write_filename, mode='wb') as write_file:
+            write_file.truncate(nbytes)
+    batch_starts = np.arange(0, n_frames, ops['batch_size'])
+    chunks = [chunk for chunk in np.array_split(batch_starts, n_workers) if len(chunk)]
+    k0 = np.cumsum([0] + [len(chunk) for chunk in chunks[:-1]])
+
+    # the workers only need the registration settings, not arrays stored in ops by earlier steps
+    worker_ops = {key: val for key, val in ops.items() if not isinstance(val, np.ndarray) or key in
+                  ['yblock', 'xblock', 'nblocks', 'NRsm', 'block_size']}
+    # FFT backends are chosen here so that every chunk is registered with the same ones
+    if ops.get('fft_backend', 'old') == 'auto':
+        pLy, pLx, real = utils.spectrum_fft_shape(refAndMasks[2], ops['Ly'], ops['Lx'], fft_shape=ops.get('fft_shape'))
+        utils.select_fft_backend((pLy, pLx), real=real)
+        if ops['nonrigid']:
+            pLy, pLx, real = utils.spectrum_fft_shape(refAndMasks[5], *refAndMasks[3].shape[-2:],
+                                                      fft_shape=ops.get('fft_shape_NR'))
+            utils.select_fft_backend((pLy, pLx), real=real)
+    fft_backends = utils.fastest_fft_backends()
+    with shmem_utils.SharedArrays() as shm:
+        ref_params = [shm.create(np.asarray(arr), copy=True)[0] for arr in refAndMasks]
+        pool = shmem_utils.get_pool(min(n_workers, len(chunks)))
+        results = pool.starmap(register_chunk, [(worker_ops, ref_params, read_filename, write_filename,
+                                                 chunk.tolist(), int(k), fft_backends) for chunk, k in zip(chunks, k0)])
+    rigid_offsets = [offsets for result in results for offsets in result[0]]
+    nonrigid_offsets = [offsets for result in results for offsets in result[1]]
+    mean_img = np.sum([result[2] for result in results], axis=0)
+    return rigid_offsets, nonrigid_offsets, mean_img
+
+def open_reg_binary(ops, read_filename, write_filename):
+    """ opens the binary read during registration and written with the registered frames
+
+    if ops['pipeline_io'], batches are prefetched and written behind on background threads
+    so that disk access overlaps with registration; without write_filename, the binary is only read
+
+    """
+    if ops.get('pipeline_io', True) and write_filename:
+        return io.BinaryFilePipeline(Ly=ops['Ly'], Lx=ops['Lx'], read_filename=read_filename,
+                                     write_filename=write_filename, n_prefetch=ops.get('n_prefetch', 2))
+    return io.BinaryFile(Ly=ops['Ly'], Lx=ops['Lx'], read_filename=read_filename, write_filename=write_filename)
+
 def register_binary(ops: Dict[str, Any], refImg=None, raw=True, base_shift = None):
     """ main registration function
 
@@ -360,6 +538,11 @@ def register_binary(ops: Dict[str, Any], refImg=None, raw=True, base_shift = Non
         raw_file_align = None
         if ops['do_bidiphase'] and ops['bidiphase'] != 0:
             ops['bidi_corrected'] = True
+    # with lazy registration only the offsets are computed, frames are registered when the raw binary is read
+    lazy = ops.get('lazy_registration', False)
+    if lazy and not raw:
+        print('WARNING: lazy_registration needs the raw binary (keep_movie_raw), writing the registered binary')
+        ops['lazy_registration'] = lazy = False
 
     ### ----- compute and use bidiphase shift -------------- ###
     if refImg is None or (ops['do_bidiphase'] and ops['bidiphase'] == 0):
@@ -378,7 +561,8 @@ def register_binary(ops: Dict[str, Any], refImg=None, raw=True, base_shift = Non
         print('NOTE: user reference frame given')
     else:
         t0 = time.time()
-        refImg = compute_reference(ops, frames)
+        with profiling.stage('reference'):
+            refImg = compute_reference(ops, frames)
         print('Reference frame, %0.2f sec.'%(time.time()-t0))
 
     ops['refImg'] = refImg
@@ -395,31 +579,53 @@ def register_binary(ops: Dict[str, Any], refImg=None, raw=True, base_shift = Non
 
     mean_img = np.zeros((ops['Ly'], ops['Lx']))
     rigid_offsets, nonrigid_offsets = [], []
-    with io.BinaryFile(Ly=ops['Ly'], Lx=ops['Lx'],
-                       read_filename=raw_file_align if raw_file_align else reg_file_align,
-                       write_filename=reg_file_align) as f:
+    # temporally binned copies of the functional channel for movie playback
+    pyramid_factors = ops.get('temporal_pyramid', [])
+    align_is_functional = ops['nchannels'] < 2 or ops['functional_chan'] == ops['align_by_chan']
+    n_workers = int(ops.get('n_reg_workers', 1))
+    if n_workers > 1 and not lazy:
         t0 = time.time()
-        for k, (_, frames) in enumerate(f.iter_frames(batch_size=ops['batch_size'])):
-            frames, ymax, xmax, cmax, ymax1, xmax1, cmax1 = register_frames(refAndMasks, frames, ops)
+        with profiling.stage('register_chunks', n_workers=n_workers):
+            rigid_offsets, nonrigid_offsets, mean_img = register_binary_chunks(
+                ops, refAndMasks, read_filename=raw_file_align if raw_file_align else reg_file_align,
+                write_filename=reg_file_align, n_workers=n_workers)
+        print('Registered %d frames in %d processes in %0.2fs' % (ops['nframes'], n_workers, time.time() - t0))
+        if align_is_functional and len(pyramid_factors):
+            with io.BinaryFile(Ly=ops['Ly'], Lx=ops['Lx'], read_filename=reg_file_align) as f, \
+                    io.TemporalPyramidWriter(reg_file_align, pyramid_factors, Ly=ops['Ly'], Lx=ops['Lx']) as pyramid:
+                for _, frames in f.iter_frames(batch_size=ops['batch_size'], dtype=np.int16):
+                    pyramid.write(frames)
+    else:
+        with open_reg_binary(ops, read_filename=raw_file_align if raw_file_align else reg_file_align,
+                             write_filename=None if lazy else reg_file_align) as f, \
+                io.TemporalPyramidWriter(reg_file_align, pyramid_factors if align_is_functional else [],
+                                         Ly=ops['Ly'], Lx=ops['Lx']) as pyramid:
+            t0 = time.time()
+            # frames are registered and written as int16 (nonrigid registration returns float32)
+            for k, (_, frames) in enumerate(f.iter_frames(batch_size=ops['batch_size'], dtype=np.int16)):
+                with profiling.stage('register_batch', batch=k):
+                    frames, ymax, xmax, cmax, ymax1, xmax1, cmax1 = register_frames(refAndMasks, frames, ops)
             
-            rigid_offsets.append([ymax, xmax, cmax])
-            if ops['nonrigid']:
-                nonrigid_offsets.append([ymax1, xmax1, cmax1])
+                rigid_offsets.append([ymax, xmax, cmax])
+                if ops['nonrigid']:
+                    nonrigid_offsets.append([ymax1, xmax1, cmax1])
 
-            mean_img += frames.sum(axis=0) / ops['nframes']
+                mean_img += frames.sum(axis=0) / ops['nframes']
 
-            f.write(frames)
-            if (ops['reg_tif'] if ops['functional_chan'] == ops['align_by_chan'] else ops['reg_tif_chan2']):
-                fname = io.generate_tiff_filename(
-                    functional_chan=ops['functional_chan'],
-                    align_by_chan=ops['align_by_chan'],
-                    save_path=ops['save_path'],
-                    k=k,
-                    ichan=True
-                )
-                io.save_tiff(mov=frames, fname=fname)
-            if (k+1)%4==0:
-                print('Registered %d/%d in %0.2fs'%(min((k+1)*ops['batch_size'], ops['nframes']), ops['nframes'], time.time()-t0))
+                if not lazy:
+                    f.write(frames)
+                pyramid.write(frames)
+                if (ops['reg_tif'] if ops['functional_chan'] == ops['align_by_chan'] else ops['reg_tif_chan2']):
+                    fname = io.generate_tiff_filename(
+                        functional_chan=ops['functional_chan'],
+                        align_by_chan=ops['align_by_chan'],
+                        save_path=ops['save_path'],
+                        k=k,
+                        ichan=True
+                    )
+                    io.save_tiff(mov=frames, fname=fname)
+                if (k+1)%4==0:
+                    print('Registered %d/%d in %0.2fs'%(min((k+1)*ops['batch_size'], ops['nframes']), ops['nframes'], time.time()-t0))
 
     ops['yoff'], ops['xoff'], ops['corrXY'] = utils.combine_offsets_across_batches(rigid_offsets, rigid=True)
     if ops['nonrigid']:
@@ -434,22 +640,26 @@ def register_binary(ops: Dict[str, Any], refImg=None, raw=True, base_shift = Non
 
         t0 = time.time()
         mean_img_sum = np.zeros((ops['Ly'], ops['Lx']))
-        with io.BinaryFile(Ly=ops['Ly'], Lx=ops['Lx'],
-                           read_filename=raw_file_alt if raw_file_alt else reg_file_alt,
-                           write_filename=reg_file_alt) as f:
+        with open_reg_binary(ops, read_filename=raw_file_alt if raw_file_alt else reg_file_alt,
+                             write_filename=None if lazy else reg_file_alt) as f, \
+                io.TemporalPyramidWriter(reg_file_alt, [] if align_is_functional else pyramid_factors,
+                                         Ly=ops['Ly'], Lx=ops['Lx']) as pyramid:
 
-            for k, (iframes, frames) in enumerate(f.iter_frames(batch_size=ops['batch_size'])):
+            for k, (iframes, frames) in enumerate(f.iter_frames(batch_size=ops['batch_size'], dtype=np.int16)):
                 # apply shifts
                 
-                yoff, xoff = ops['yoff'][iframes].astype(int), ops['xoff'][iframes].astype(int)
+                yoff, xoff = ops['yoff'][iframes], ops['xoff'][iframes]
                 yoff1, xoff1 = None, None
                 if ops['nonrigid']:
                     yoff1, xoff1 = ops['yoff1'][iframes], ops['xoff1'][iframes]
 
-                frames = shift_frames(frames, yoff, xoff, yoff1, xoff1, ops)
+                with profiling.stage('shift_batch_chan2', batch=k):
+                    frames = shift_frames(frames, yoff, xoff, yoff1, xoff1, ops)
                 
                 # write
-                f.write(frames)
+                if not lazy:
+                    f.write(frames)
+                pyramid.write(frames)
                 if (ops['reg_tif_chan2'] if ops['functional_chan'] == ops['align_by_chan'] else ops['reg_tif']):
                     fname = io.generate_tiff_filename(
                         functional_chan=ops['functional_chan'],
@@ -1,10 +1,9 @@
 from typing import Tuple
 
 import numpy as np
+from numba import njit, prange
 
-from .utils import convolve, convolve_faster, complex_fft2, spatial_taper, addmultiply, gaussian_fft, temporal_smooth
-
-import torch
+from .utils import cross_spectrum, inverse_cross_spectrum, spectrum_fft_shape, reference_fft_shape, get_fft_backend, complex_fft2, spatial_taper, addmultiply, addmultiply_real, gaussian_fft, temporal_smooth
 
 
 def compute_masks(refImg, maskSlope) -> Tuple[np.ndarray, np.ndarray]:
@@ -28,7 +27,7 @@ def compute_masks(refImg, maskSlope) -> Tuple[np.ndarray, np.ndarray]:
     return maskMul.astype('float32'), maskOffset.astype('float32')
 
 
-def apply_masks(data: np.ndarray, maskMul: np.ndarray, maskOffset: np.ndarray) -> np.ndarray:
+def apply_masks(data: np.ndarray, maskMul: np.ndarray, maskOffset: np.ndarray, real: bool = False) -> np.ndarray:
     """
     Returns a 3D image 'data', multiplied by 'maskMul' and then added 'maskOffet'.
 
@@ -37,15 +36,17 @@ def apply_masks(data: np.ndarray, maskMul: np.ndarray, maskOffset: np.ndarray) -
     data: nImg x Ly x Lx
     maskMul
     maskOffset
+    real: bool
+        Whether to return float32 (for the real-input FFT) instead of complex64
 
     Returns
     --------
     maskedData: nImg x Ly x Lx
     """
-    return addmultiply(data, maskMul, maskOffset)
+    return addmultiply_real(data, maskMul, maskOffset) if real else addmultiply(data, maskMul, maskOffset)
 
 
-def phasecorr_reference(refImg: np.ndarray, smooth_sigma=None) -> np.ndarray:
+def phasecorr_reference(refImg: np.ndarray, smooth_sigma=None, real: bool = False, pad_fft: bool = False) -> np.ndarray:
     """
     Returns reference image fft'ed and complex conjugate and multiplied by gaussian filter in the fft domain,
     with standard deviation 'smooth_sigma' computes fft'ed reference image for phasecorr.
@@ -54,51 +55,63 @@ def phasecorr_reference(refImg: np.ndarray, smooth_sigma=None) -> np.ndarray:
     ----------
     refImg : 2D array, int16
         reference image
+    real : bool
+        whether to return the half spectrum used by phasecorr with real-input FFTs
+    pad_fft : bool
+        whether to pad Ly x Lx to a size that is fast to transform (utils.reference_fft_shape), if it is not one already
 
     Returns
     -------
     cfRefImg : 2D array, complex64
+        size pLy x pLx (pLy x pLx // 2 + 1 if real), pLy x pLx is Ly x Lx or its padded size
     """
-    cfRefImg = complex_fft2(img=refImg)
+    pLy, pLx = reference_fft_shape(*refImg.shape, real=real, pad_fft=pad_fft)
+    pad_fft = (pLy, pLx) != refImg.shape
+    if pad_fft:
+        # padded with its mean like the frames (see utils.pad_frames)
+        refImg = refImg - refImg.mean()
+    cfRefImg = complex_fft2(img=refImg, pad_fft=pad_fft, real=real)
     cfRefImg /= (1e-5 + np.absolute(cfRefImg))
-    cfRefImg *= gaussian_fft(smooth_sigma, cfRefImg.shape[0], cfRefImg.shape[1])
+    cfRefImg *= gaussian_fft(smooth_sigma, pLy, pLx)[:, :cfRefImg.shape[1]]
     return cfRefImg.astype('complex64')
 
-def phasecorr(data, cfRefImg, maxregshift, smooth_sigma_time, convolve_method='old') -> Tuple[int, int, float]:
+def phasecorr(data, cfRefImg, maxregshift, smooth_sigma_time, convolve_method='old',
+              subpixel: int = 1, fft_shape: Tuple[int, int] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
     """ compute phase correlation between data and reference image
 
     Parameters
     ----------
     data : int16
-        array that's frames x Ly x Lx
+        array that's frames x Ly x Lx (float32 if cfRefImg is a half spectrum, see apply_masks)
+    cfRefImg : complex64
+        reference spectrum from phasecorr_reference, full or half (real-input FFTs), optionally padded
     maxregshift : float
         maximum shift as a fraction of the minimum dimension of data (min(Ly,Lx) * maxregshift)
     smooth_sigma_time : float
         how many frames to smooth in time
+    convolve_method : str
+        FFT backend, see utils.get_fft_backend ('auto' times the installed backends and uses the fastest)
+    subpixel : int
+        if > 1, the integer peaks are refined to 1 / subpixel pixels with an upsampled DFT (see upsampled_peaks)
+    fft_shape : (int, int)
+        FFT size of cfRefImg (utils.reference_fft_shape), needed if cfRefImg is padded
 
     Returns
     -------
-    ymax : int
+    ymax : int (float32 if subpixel > 1)
         shifts in y from cfRefImg to data for each frame
-    xmax : int
+    xmax : int (float32 if subpixel > 1)
         shifts in x from cfRefImg to data for each frame
     cmax : float
         maximum of phase correlation for each frame
 
     """
-    min_dim = np.minimum(*data.shape[1:])  # maximum registration shift allowed
+    Ly, Lx = data.shape[1:]
+    min_dim = np.minimum(Ly, Lx)  # maximum registration shift allowed
     lcorr = int(np.minimum(np.round(maxregshift * min_dim), min_dim // 2))
     
-    if convolve_method == 'fast_cpu': 
-        data = convolve_faster(data, cfRefImg)
-    elif convolve_method == 'old':  
-        data = convolve(data, cfRefImg)
-    elif convolve_method == 'part_gpu':
-        data = convolve_part_gpu(data, cfRefImg)
-    elif convolve_method == 'full_gpu':
-        data = convolve_full_gpu(data, cfRefImg)
-    elif convolve_method == 'tf_gpu':
-        data = convolve_tf_gpu(data, cfRefImg)
+    spectrum = cross_spectrum(data, cfRefImg, backend=convolve_method, fft_shape=fft_shape)
+    data = inverse_cross_spectrum(spectrum, Ly, Lx, backend=convolve_method, fft_shape=fft_shape)
 
     cc = np.real(
             np.block(
@@ -109,14 +122,125 @@ def phasecorr(data, cfRefImg, maxregshift, smooth_sigma_time, convolve_method='o
     
     cc = temporal_smooth(cc, smooth_sigma_time) if smooth_sigma_time > 0 else cc
 
-    ymax, xmax = np.zeros(data.shape[0], np.int32), np.zeros(data.shape[0], np.int32)
-    for t in np.arange(data.shape[0]):
-        ymax[t], xmax[t] = np.unravel_index(np.argmax(cc[t], axis=None), (2 * lcorr + 1, 2 * lcorr + 1))
+    # peak of every frame at once
+    ymax, xmax = np.unravel_index(np.argmax(cc.reshape(cc.shape[0], -1), axis=1), (2 * lcorr + 1, 2 * lcorr + 1))
+    ymax, xmax = ymax.astype(np.int32), xmax.astype(np.int32)
     cmax = cc[np.arange(len(cc)), ymax, xmax]
     ymax, xmax = ymax - lcorr, xmax - lcorr
 
+    if subpixel > 1:
+        if smooth_sigma_time > 0:
+            # the correlation is linear in the spectrum, so smoothing it in time smooths the correlation
+            spectrum = (temporal_smooth(np.ascontiguousarray(spectrum.real), smooth_sigma_time)
+                        + 1j * temporal_smooth(np.ascontiguousarray(spectrum.imag), smooth_sigma_time))
+        ymax, xmax, cmax = upsampled_peaks(spectrum, ymax, xmax, Ly, Lx, subpixel=subpixel, lcorr=lcorr,
+                                           fft_shape=fft_shape)
+
     return ymax, xmax, cmax.astype(np.float32)
 
+
+def upsampled_peaks(spectrum: np.ndarray, ymax: np.ndarray, xmax: np.ndarray, Ly: int, Lx: int,
+                    subpixel: int = 10, lcorr: int = None,
+                    fft_shape: Tuple[int, int] = None) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Returns the subpixel peaks of the phase correlations within one pixel of the integer peaks (ymax, xmax).
+
+    The correlation is evaluated on a (2 * subpixel + 1)^2 grid of 1 / subpixel steps around each peak
+    with a matrix-multiply DFT of the cross-power spectrum (Guizar-Sicairos et al., 2008), which is
+    much cheaper than upsampling the whole correlation.
+
+    Parameters
+    ----------
+    spectrum: nImg x pLy x pLx or nImg x pLy x (pLx // 2 + 1)
+        cross-power spectra of the frames, see utils.cross_spectrum
+    ymax: nImg
+        integer peaks in y (as returned by phasecorr)
+    xmax: nImg
+        integer peaks in x
+    Ly: int
+        Height of the frames
+    Lx: int
+        Width of the frames
+    subpixel: int
+        upsampling factor (precision of 1 / subpixel pixels)
+    lcorr: int
+        maximum absolute shift, peaks beyond it are ignored
+    fft_shape: (int, int)
+        FFT size of the spectra (utils.reference_fft_shape), needed if they are padded
+
+    Returns
+    -------
+    ymax: float32
+    xmax: float32
+    cmax: float32
+    """
+    pLy, pLx, real = spectrum_fft_shape(spectrum[0], Ly, Lx, fft_shape=fft_shape)
+    nimg = spectrum.shape[0]
+    steps = np.arange(-subpixel, subpixel + 1) / subpixel
+    ys = ymax[:, np.newaxis] + steps
+    xs = xmax[:, np.newaxis] + steps
+    if real:
+        # the correlation is real, so the negative frequencies of the half spectrum count twice
+        fx = np.arange(spectrum.shape[-1]) / pLx
+        weights = np.full(fx.size, 2., np.float32)
+        weights[0] = 1
+        if pLx % 2 == 0:
+            weights[-1] = 1
+    else:
+        fx = np.fft.fftfreq(pLx)
+        weights = np.ones(pLx, np.float32)
+    kernel_y = np.exp(2j * np.pi * ys[:, :, np.newaxis] * np.fft.fftfreq(pLy)).astype(np.complex64)
+    kernel_x = (weights[:, np.newaxis] * np.exp(2j * np.pi * fx[:, np.newaxis] * xs[:, np.newaxis, :])).astype(np.complex64)
+    cc = np.real(kernel_y @ spectrum @ kernel_x) / (pLy * pLx)
+    if lcorr is not None:
+        cc[np.abs(ys) > lcorr] = -np.inf
+        cc.transpose(0, 2, 1)[np.abs(xs) > lcorr] = -np.inf
+    iy, ix = np.unravel_index(np.argmax(cc.reshape(nimg, -1), axis=1), cc.shape[1:])
+    frames = np.arange(nimg)
+    return (ys[frames, iy].astype(np.float32), xs[frames, ix].astype(np.float32),
+            cc[frames, iy, ix].astype(np.float32))
+
+
+def shift_frames_subpixel(frames: np.ndarray, ymax: np.ndarray, xmax: np.ndarray, backend: str = 'old') -> np.ndarray:
+    """
+    Returns frames shifted by subpixel amounts ymax and xmax (as shift_frame) with a phase ramp in the Fourier domain.
+
+    The pixels that wrap around the edges are set to 0, as in shift_frame.
+
+    Parameters
+    ----------
+    frames: nImg x Ly x Lx
+    ymax: nImg
+        vertical shift amounts
+    xmax: nImg
+        horizontal shift amounts
+    backend: str
+        FFT backend, see utils.get_fft_backend
+
+    Returns
+    -------
+    frames_shifted: nImg x Ly x Lx, float32
+    """
+    nimg, Ly, Lx = frames.shape
+    ymax = np.asarray(ymax, np.float32)
+    xmax = np.asarray(xmax, np.float32)
+    fft = get_fft_backend(backend, (Ly, Lx), real=True)
+    ramp = np.exp(2j * np.pi * (np.fft.fftfreq(Ly)[:, np.newaxis] * ymax[:, np.newaxis, np.newaxis]
+                                + np.fft.rfftfreq(Lx) * xmax[:, np.newaxis, np.newaxis])).astype(np.complex64)
+    shifted = fft.irfft2(fft.rfft2(frames.astype(np.float32)) * ramp, (Ly, Lx)).astype(np.float32, copy=False)
+    for frame, dy, dx in zip(shifted, ymax, xmax):
+        ny, nx = int(np.ceil(abs(dy))), int(np.ceil(abs(dx)))
+        if dy > 0:
+            frame[Ly - ny:] = 0
+        elif dy < 0:
+            frame[:ny] = 0
+        if dx > 0:
+            frame[:, Lx - nx:] = 0
+        elif dx < 0:
+            frame[:, :nx] = 0
+    return shifted
+
+
 def shift_frame(frame: np.ndarray, dy: int, dx: int) -> np.ndarray:
     """
     Returns frame, shifted by dy and dx
@@ -149,3 +273,53 @@ def shift_frame(frame: np.ndarray, dy: int, dx: int) -> np.ndarray:
         rolled[:dy, :] = 0
     return rolled
     # return np.roll(frame, (-dy, -dx), axis=(0, 1))
+
+
+@njit(['int16[:, :, ::1], int64[:], int64[:]', 'float32[:, :, ::1], int64[:], int64[:]'], parallel=True, cache=True)
+def _shift_frames_inplace(frames, ymax, xmax):
+    Ly, Lx = frames.shape[1], frames.shape[2]
+    for t in prange(frames.shape[0]):
+        dy, dx = ymax[t], xmax[t]
+        # rows are read from y + dy, so walk away from them to never read an overwritten row
+        x0, x1 = max(0, -dx), min(Lx, Lx - dx)
+        for i in range(Ly):
+            y = i if dy >= 0 else Ly - 1 - i
+            if y + dy < 0 or y + dy >= Ly or x0 >= x1:
+                frames[t, y, :] = 0
+                continue
+            if dy == 0:
+                # the row is shifted onto itself
+                frames[t, y, x0:x1] = frames[t, y, x0 + dx:x1 + dx].copy()
+            else:
+                frames[t, y, x0:x1] = frames[t, y + dy, x0 + dx:x1 + dx]
+            frames[t, y, :x0] = 0
+            frames[t, y, x1:] = 0
+
+
+def shift_frames_integer(frames: np.ndarray, ymax: np.ndarray, xmax: np.ndarray) -> np.ndarray:
+    """
+    Shifts every frame by its integer ymax and xmax (as shift_frame) in place, in parallel over frames.
+
+    C-contiguous int16 and float32 frames are shifted by a compiled kernel; frames of other
+    dtypes or memory layouts are shifted one at a time with shift_frame.
+
+    Parameters
+    ----------
+    frames: nImg x Ly x Lx
+    ymax: nImg
+        vertical shift amounts
+    xmax: nImg
+        horizontal shift amounts
+
+    Returns
+    -------
+    frames: nImg x Ly x Lx
+        the shifted frames (the same array)
+    """
+    ymax, xmax = np.asarray(ymax, np.int64), np.asarray(xmax, np.int64)
+    if frames.dtype in (np.int16, np.float32) and frames.flags.c_contiguous:
+        _shift_frames_inplace(frames, ymax, xmax)
+    else:
+        for frame, dy, dx in zip(frames, ymax, xmax):
+            frame[:] = shift_frame(frame=frame, dy=int(dy), dx=int(dx))
+    return frames
@@ -1,23 +1,37 @@
+import json
+import os
+import pickle
+import time
 import warnings
 from functools import lru_cache
-from typing import Tuple
+from pathlib import Path
+from typing import Callable, NamedTuple, Tuple
 
 import numpy as np
+import scipy.fft
 from numba import vectorize, complex64
-from numpy.fft import ifftshift#, fft2, ifft2
-from scipy.fft import next_fast_len#, fft2, ifft2
+from numpy.fft import ifftshift
+from scipy.fft import next_fast_len
 from scipy.ndimage import gaussian_filter1d
-from torch import from_numpy
-from torch.fft import fft2 as torch_fft2
-from torch.fft import ifft2 as torch_ifft2
 
-from mkl_fft import fft2, ifft2
+try:
+    import mkl_fft
+    from mkl_fft import fft2, ifft2
+except ModuleNotFoundError:
+    mkl_fft = None
+    from scipy.fft import fft2, ifft2
+    warnings.warn("mkl_fft not installed.  Install it with conda: conda install mkl_fft", ImportWarning)
 
+try:
+    import torch
+except ModuleNotFoundError:
+    torch = None
 
-#try:
-#    from mkl_fft import fft2, ifft2
-#except ModuleNotFoundError:
-#    warnings.warn("mkl_fft not installed.  Install it with conda: conda install mkl_fft", ImportWarning)
+try:
+    import pyfftw
+    import pyfftw.interfaces.scipy_fft
+except ModuleNotFoundError:
+    pyfftw = None
 
 
 @vectorize([complex64(complex64, complex64)], nopython=True, target='parallel')
@@ -30,6 +44,11 @@ def addmultiply(x, mul, add):
     return np.complex64(np.float32(x) * mul + add)
 
 
+@vectorize(['float32(int16, float32, float32)', 'float32(float32, float32, float32)'], nopython=True, target='parallel', cache=True)
+def addmultiply_real(x, mul, add):
+    return np.float32(x) * mul + add
+
+
 def combine_offsets_across_batches(offset_list, rigid):
     yoff, xoff, corr_xy = [], [], []
     for batch in offset_list:
@@ -193,71 +212,320 @@ def spatial_high_pass(data, N):
     return data_filtered.squeeze()
 
 
-def convolve(mov: np.ndarray, img: np.ndarray) -> np.ndarray:
+class FFTBackend(NamedTuple):
+    """
+    2D FFTs over the last two axes: fft2 / ifft2 of complex64 arrays (returning complex64), and rfft2 of float32
+    arrays (returning the complex64 half spectrum) / irfft2(x, s) back to float32 arrays of size s
+    """
+    name: str
+    fft2: Callable[[np.ndarray], np.ndarray]
+    ifft2: Callable[[np.ndarray], np.ndarray]
+    rfft2: Callable[[np.ndarray], np.ndarray]
+    irfft2: Callable[[np.ndarray, Tuple[int, int]], np.ndarray]
+
+
+# registered backends, by name
+_fft_backends = {}
+# fastest backend for each (Ly, Lx, real) measured by select_fft_backend
+_fastest_fft_backends = {}
+# older names of the mkl_fft and torch versions of convolve
+_fft_backend_aliases = {'old': 'mkl_fft', 'fast_cpu': 'torch'}
+
+fft_backend_file = Path.home().joinpath('.suite2p', 'fft_backends.json')
+fftw_wisdom_file = Path.home().joinpath('.suite2p', 'fftw_wisdom.pkl')
+
+
+def register_fft_backend(name: str, fft2: Callable, ifft2: Callable, rfft2: Callable, irfft2: Callable) -> None:
+    """ adds an FFT backend that can be chosen by name or by select_fft_backend """
+    _fft_backends[name] = FFTBackend(name, fft2, ifft2, rfft2, irfft2)
+
+
+def fft_backend_names():
+    """ names of the registered (installed) FFT backends """
+    return list(_fft_backends)
+
+
+def _register_default_fft_backends():
+    n_workers = os.cpu_count() or 1
+    register_fft_backend('numpy', lambda x: np.fft.fft2(x).astype(np.complex64, copy=False),
+                         lambda x: np.fft.ifft2(x).astype(np.complex64, copy=False),
+                         lambda x: np.fft.rfft2(x).astype(np.complex64, copy=False),
+                         lambda x, s: np.fft.irfft2(x, s).astype(np.float32, copy=False))
+    register_fft_backend('scipy', lambda x: scipy.fft.fft2(x, workers=n_workers),
+                         lambda x: scipy.fft.ifft2(x, workers=n_workers),
+                         lambda x: scipy.fft.rfft2(x, workers=n_workers),
+                         lambda x, s: scipy.fft.irfft2(x, s, workers=n_workers))
+    if mkl_fft is not None:
+        register_fft_backend('mkl_fft', mkl_fft.fft2, mkl_fft.ifft2, mkl_fft.rfft2,
+                             lambda x, s: mkl_fft.irfft2(x, s=s))
+    if torch is not None:
+        register_fft_backend('torch', lambda x: torch.fft.fft2(torch.from_numpy(x)).numpy(),
+                             lambda x: torch.fft.ifft2(torch.from_numpy(x)).numpy(),
+                             lambda x: torch.fft.rfft2(torch.from_numpy(x)).numpy(),
+                             lambda x, s: torch.fft.irfft2(torch.from_numpy(x), s=s).numpy())
+    if pyfftw is not None:
+        # plans are cached between calls and the planning (wisdom) is kept across runs
+        pyfftw.interfaces.cache.enable()
+        try:
+            with open(fftw_wisdom_file, 'rb') as f:
+                pyfftw.import_wisdom(pickle.load(f))
+        except (OSError, pickle.UnpicklingError, EOFError):
+            pass
+        register_fft_backend('pyfftw', lambda x: pyfftw.interfaces.scipy_fft.fft2(x, workers=n_workers),
+                             lambda x: pyfftw.interfaces.scipy_fft.ifft2(x, workers=n_workers),
+                             lambda x: pyfftw.interfaces.scipy_fft.rfft2(x, workers=n_workers),
+                             lambda x, s: pyfftw.interfaces.scipy_fft.irfft2(x, s, workers=n_workers))
+
+
+_register_default_fft_backends()
+
+
+def _save_fftw_wisdom():
+    try:
+        fftw_wisdom_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(fftw_wisdom_file, 'wb') as f:
+            pickle.dump(pyfftw.export_wisdom(), f)
+    except OSError:
+        pass
+
+
+def _load_fft_backend_choices():
+    try:
+        with open(fft_backend_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def select_fft_backend(shape: Tuple[int, int], real: bool = False, n_images: int = 16, n_repeats: int = 3,
+                       persist: bool = True) -> str:
+    """
+    Returns the name of the fastest backend for FFTs of n_images x Ly x Lx arrays (shape = (Ly, Lx)).
+
+    The backends are timed on random data the first time a shape is seen; the choice is kept for the process
+    and, if persist, saved in ~/.suite2p/fft_backends.json for later runs on the same host.
+
+    Parameters
+    ----------
+    shape: int, int
+        The height and width of the transformed images (frames or nonrigid blocks)
+    real: bool
+        Whether to time the real-input transforms (rfft2 / irfft2) instead of fft2 / ifft2
+    n_images: int
+        The number of images transformed at once in the benchmark
+    n_repeats: int
+        The number of timed repeats (the fastest repeat is used)
+    persist: bool
+        Whether to load and save the choice from ~/.suite2p/fft_backends.json
+
+    Returns
+    -------
+    name: str
+    """
+    shape = tuple(int(L) for L in shape[-2:])
+    if shape + (real,) in _fastest_fft_backends:
+        return _fastest_fft_backends[shape + (real,)]
+    key = '%dx%d%s:%s' % (shape + ('r' if real else '', ','.join(sorted(_fft_backends))))
+    choices = _load_fft_backend_choices() if persist else {}
+    if choices.get(key) in _fft_backends:
+        _fastest_fft_backends[shape + (real,)] = choices[key]
+        return choices[key]
+
+    rs = np.random.RandomState(0)
+    data = rs.randn(n_images, *shape).astype(np.float32)
+    if not real:
+        data = (data + 1j * rs.randn(n_images, *shape)).astype(np.complex64)
+    timings = {}
+    for name, backend in _fft_backends.items():
+        transform = (lambda: backend.irfft2(backend.rfft2(data), shape)) if real else \
+                    (lambda: backend.ifft2(backend.fft2(data)))
+        try:
+            transform()  # warm-up, plans the transforms
+            best = np.inf
+            for _ in range(n_repeats):
+                t0 = time.perf_counter()
+                transform()
+                best = min(best, time.perf_counter() - t0)
+            timings[name] = best
+        except Exception as e:
+            warnings.warn('FFT backend %s failed: %s' % (name, e))
+    _fastest_fft_backends[shape + (real,)] = min(timings, key=timings.get)
+    if 'pyfftw' in timings:
+        _save_fftw_wisdom()
+    if persist:
+        choices = _load_fft_backend_choices()
+        choices[key] = _fastest_fft_backends[shape + (real,)]
+        try:
+            fft_backend_file.parent.mkdir(parents=True, exist_ok=True)
+            with open(fft_backend_file, 'w') as f:
+                json.dump(choices, f, indent=1)
+        except OSError:
+            pass
+    return _fastest_fft_backends[shape + (real,)]
+
+
+def fastest_fft_backends() -> dict:
+    """ the backends chosen by select_fft_backend in this process, {(Ly, Lx, real): name} """
+    return dict(_fastest_fft_backends)
+
+
+def set_fastest_fft_backends(choices: dict) -> None:
+    """ uses the given {(Ly, Lx, real): name} choices instead of timing the backends (e.g. in worker processes) """
+    _fastest_fft_backends.update({tuple(key): name for key, name in choices.items() if name in _fft_backends})
+
+
+def get_fft_backend(name: str = 'old', shape: Tuple[int, int] = None, real: bool = False) -> FFTBackend:
+    """
+    Returns the FFT backend "name", or the fastest backend for images of shape (Ly, Lx) if name is 'auto'.
+
+    'old' and 'fast_cpu' are the mkl_fft and torch backends; backends that are not installed fall back to
+    mkl_fft, or scipy if mkl_fft is not installed either. Only 'auto' times the backends (see select_fft_backend).
+    """
+    name = _fft_backend_aliases.get(name, name)
+    if name != 'auto' and name not in _fft_backends:
+        default = 'mkl_fft' if mkl_fft is not None else 'scipy'
+        warnings.warn('FFT backend %s is not available, using %s' % (name, default))
+        name = default
+    if name == 'auto':
+        name = select_fft_backend(shape, real) if shape is not None else ('mkl_fft' if mkl_fft is not None else 'scipy')
+    return _fft_backends[name]
+
+
+def is_half_spectrum(img: np.ndarray, Lx: int) -> bool:
+    """ whether the reference spectrum 'img' is the half spectrum (rfft2) of images of width Lx (or padded from Lx) """
+    return img.shape[-1] < Lx
+
+
+def fast_fft_shape(Ly: int, Lx: int, real: bool = False) -> Tuple[int, int]:
+    """ the smallest FFT size of at least Ly x Lx that is fast to transform (see scipy.fft.next_fast_len) """
+    return next_fast_len(int(Ly), real), next_fast_len(int(Lx), real)
+
+
+def reference_fft_shape(Ly: int, Lx: int, real: bool = False, pad_fft: bool = False) -> Tuple[int, int]:
+    """ the FFT size of the reference spectrum of Ly x Lx images, Ly x Lx or padded to fast_fft_shape if pad_fft """
+    return fast_fft_shape(Ly, Lx, real) if pad_fft else (int(Ly), int(Lx))
+
+
+def spectrum_fft_shape(img: np.ndarray, Ly: int, Lx: int, fft_shape: Tuple[int, int] = None) -> Tuple[int, int, bool]:
+    """
+    Returns the size (pLy, pLx) of the FFTs of Ly x Lx images convolved with the reference spectrum 'img',
+    which is Ly x Lx or padded to fast_fft_shape (see complex_fft2), and whether 'img' is a half spectrum.
+
+    The padded width cannot always be told from a half spectrum (Lx padded to Lx + 1 has as many frequencies
+    as Lx when Lx is even), so 'fft_shape' (see reference_fft_shape) must be given for padded references.
+    Without it, a half spectrum of Lx // 2 + 1 frequencies is taken to be unpadded.
+    """
+    pLy, nfreq = img.shape[-2:]
+    if fft_shape is not None:
+        pLy, pLx = fft_shape
+        return int(pLy), int(pLx), nfreq != pLx
+    if not is_half_spectrum(img, Lx):
+        return pLy, nfreq, False
+    return pLy, (Lx if nfreq == Lx // 2 + 1 else next_fast_len(int(Lx), True)), True
+
+
+def pad_frames(mov: np.ndarray, Ly: int, Lx: int) -> np.ndarray:
+    """
+    Returns 'mov' padded at the end of its last two axes to Ly x Lx with the mean of each frame, so that
+    the padding adds no edges to the (tapered) frames.
+    """
+    if mov.shape[-2:] == (Ly, Lx):
+        return mov
+    padded = np.empty(mov.shape[:-2] + (Ly, Lx), mov.dtype)
+    padded[:] = mov.mean(axis=(-2, -1), keepdims=True)
+    padded[..., :mov.shape[-2], :mov.shape[-1]] = mov
+    return padded
+
+
+def convolve(mov: np.ndarray, img: np.ndarray, backend: str = 'old', fft_shape: Tuple[int, int] = None) -> np.ndarray:
     """
     Returns the 3D array 'mov' convolved by a 2D array 'img'.
 
+    If 'img' is a half spectrum (see complex_fft2), the real-valued 'mov' is transformed with rfft2 / irfft2 and
+    the (real) result is float32, otherwise 'mov' is transformed with fft2 / ifft2 and the result is complex64.
+    If 'img' is the spectrum of padded images, 'mov' is padded with pad_frames and the result is padded too.
+
     Parameters
     ----------
     mov: nImg x Ly x Lx
         The frames to process
     img: 2D array
-        The convolution kernel
+        The convolution kernel, pLy x pLx or pLy x (pLx // 2 + 1), where pLy x pLx is Ly x Lx or its padded size
+    backend: str
+        The FFT backend (see get_fft_backend)
+    fft_shape: (int, int)
+        The FFT size pLy x pLx of 'img' (see spectrum_fft_shape), needed if 'img' is padded
 
     Returns
     -------
-    convolved_data: nImg x Ly x Lx
+    convolved_data: nImg x pLy x pLx
     """
-    return ifft2(apply_dotnorm(fft2(mov), img)) #.astype(np.complex64)
+    return inverse_cross_spectrum(cross_spectrum(mov, img, backend=backend, fft_shape=fft_shape), *mov.shape[-2:],
+                                  backend=backend, fft_shape=fft_shape)
 
-def convolve_faster(mov: np.ndarray, img: np.ndarray) -> np.ndarray:
+
+def cross_spectrum(mov: np.ndarray, img: np.ndarray, backend: str = 'old', fft_shape: Tuple[int, int] = None) -> np.ndarray:
     """
-    Returns the 3D array 'mov' convolved by a 2D array 'img'.
+    Returns the whitened cross-power spectrum of the 3D array 'mov' and the reference spectrum 'img' (see convolve).
 
     Parameters
     ----------
     mov: nImg x Ly x Lx
         The frames to process
     img: 2D array
-        The convolution kernel
+        The reference spectrum, pLy x pLx or pLy x (pLx // 2 + 1) (see spectrum_fft_shape)
+    backend: str
+        The FFT backend (see get_fft_backend)
+    fft_shape: (int, int)
+        The FFT size pLy x pLx of 'img' (see spectrum_fft_shape), needed if 'img' is padded
+
+    Returns
+    -------
+    spectrum: nImg x img.shape, complex64
+    """
+    pLy, pLx, real = spectrum_fft_shape(img, *mov.shape[-2:], fft_shape=fft_shape)
+    if real:
+        fft = get_fft_backend(backend, (pLy, pLx), real=True)
+        mov = pad_frames(np.real(mov).astype(np.float32, copy=False), pLy, pLx)
+        return apply_dotnorm(fft.rfft2(mov), img)
+    fft = get_fft_backend(backend, (pLy, pLx))
+    return apply_dotnorm(fft.fft2(pad_frames(mov, pLy, pLx)), img)
+
+
+def inverse_cross_spectrum(spectrum: np.ndarray, Ly: int, Lx: int, backend: str = 'old',
+                           fft_shape: Tuple[int, int] = None) -> np.ndarray:
+    """
+    Returns the phase correlation of Ly x Lx frames from their cross-power spectrum (see cross_spectrum).
+
+    Parameters
+    ----------
+    spectrum: nImg x pLy x pLx or nImg x pLy x (pLx // 2 + 1)
+    Ly: int
+        Height of the frames
+    Lx: int
+        Width of the frames
+    backend: str
+        The FFT backend (see get_fft_backend)
+    fft_shape: (int, int)
+        The FFT size pLy x pLx of the spectrum (see spectrum_fft_shape), needed if it is padded
 
     Returns
     -------
-    convolved_data: nImg x Ly x Lx
-    """
-    mov_torch = from_numpy(mov)
-    mov_f = torch_fft2(mov_torch).cpu().numpy()
-    normed_f = apply_dotnorm(mov_f, img)
-    normed_f_torch = from_numpy(normed_f)
-    normed_torch_cpu = torch_ifft2(normed_f_torch).cpu().numpy()
-    return normed_torch_cpu
-
-# def convolve_full_gpu(mov: np.ndarray, img: np.ndarray) -> np.ndarray:
-#     mov_torch = torch.from_numpy(mov).to('cuda').type(torch.complex64)
-#     ref_torch = torch.from_numpy(img).to('cuda')
-#     mov_f = torch.fft.fft2(mov_torch)
-#     normed_f_torch = mov_f / (torch.abs(mov_f)) * ref_torch
-#     normed_torch_full_gpu = torch.fft.ifft2(normed_f_torch).real.cpu().numpy()
-#     return normed_torch_full_gpu
-
-# def convolve_part_gpu(mov: np.ndarray, img: np.ndarray) -> np.ndarray:
-#     mov_torch = torch.from_numpy(mov).to('cuda')
-#     mov_f = torch.fft.fft2(mov_torch).cpu().numpy()
-#     normed_f = apply_dotnorm(mov_f, img)
-#     normed_f_torch = torch.from_numpy(normed_f).to('cuda')
-#     normed_torch_partial_gpu = torch.fft.ifft2(normed_f_torch).cpu().numpy()
-#     return normed_torch_partial_gpu
-
-# def convolve_tf_gpu(mov: np.ndarray, img: np.ndarray) -> np.ndarray:
-#     mov_tf = tf.convert_to_tensor(mov)
-#     ref_tf = tf.convert_to_tensor(img)
-#     mov_tf_f = tf.signal.fft2d(mov_tf)
-#     normed_mov_f = mov_tf_f / tf.cast(tf.math.abs(mov_tf_f), tf.complex64) * ref_tf
-#     normed_mov = tf.signal.ifft2d(normed_mov_f).numpy()
-#     return normed_mov
-
-
-def complex_fft2(img: np.ndarray, pad_fft: bool = False) -> np.ndarray:
+    correlation: nImg x pLy x pLx, float32 for a half spectrum, complex64 otherwise
+    """
+    pLy, pLx, real = spectrum_fft_shape(spectrum[0], Ly, Lx, fft_shape=fft_shape)
+    if real:
+        return get_fft_backend(backend, (pLy, pLx), real=True).irfft2(spectrum, (pLy, pLx))
+    return get_fft_backend(backend, (pLy, pLx)).ifft2(spectrum)
+
+def convolve_faster(mov: np.ndarray, img: np.ndarray) -> np.ndarray:
+    """
+    Returns the 3D array 'mov' convolved by a 2D array 'img' with the torch FFT.
+    """
+    return convolve(mov, img, backend='torch')
+
+
+def complex_fft2(img: np.ndarray, pad_fft: bool = False, real: bool = False) -> np.ndarray:
     """
     Returns the complex conjugate of the fft-transformed 2D array 'img', optionally padded for speed.
 
@@ -266,12 +534,16 @@ def complex_fft2(img: np.ndarray, pad_fft: bool = False) -> np.ndarray:
     img: Ly x Lx
         The image to process
     pad_fft: bool
-        Whether to pad the image
+        Whether to pad the image to fast_fft_shape (with zeros)
+    real: bool
+        Whether to return only the half spectrum (Ly x Lx // 2 + 1) of the real-valued image, as
+        used by convolve with rfft2 / irfft2
 
 
     """
     Ly, Lx = img.shape
-    return np.conj(fft2(img, (next_fast_len(Ly), next_fast_len(Lx)))) if pad_fft else np.conj(fft2(img))
+    cfimg = np.conj(fft2(img, fast_fft_shape(Ly, Lx, real))) if pad_fft else np.conj(fft2(img))
+    return np.ascontiguousarray(cfimg[:, :cfimg.shape[1] // 2 + 1]) if real else cfimg
 
 
 def kernelD(xs: np.ndarray, ys: np.ndarray, sigL: float = 0.85) -> np.ndarray:
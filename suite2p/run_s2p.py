@@ -1,6 +1,8 @@
+import multiprocessing
 import os
 import shutil
 import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from natsort import natsorted
 from datetime import datetime
 from getpass import getpass
@@ -9,7 +11,7 @@ import pathlib
 import numpy as np
 #from scipy.io import savemat
 
-from . import extraction, io, registration, detection, classification
+from . import extraction, io, registration, detection, classification, profiling
 from .version import version
 
 try:
@@ -54,12 +56,16 @@ def default_ops():
         'force_sktiff': False, # whether or not to use scikit-image for tiff reading
         'frames_include': -1,
         'multiplane_parallel': False, # whether or not to run on server
+        'profile': False,  # record wall/cpu time, memory and io of each stage to profile.json and profile_trace.json
+        'n_plane_workers': 1,  # number of planes processed concurrently in local worker processes (0 uses all cores)
+        'plane_worker_mem_gb': 0.,  # expected peak memory of one plane worker; if > 0, limits n_plane_workers to available RAM
         'ignore_flyback': [],
 
         # output settings
         'preclassify': 0.,  # apply classifier before signal extraction with probability 0.3
         'save_mat': False,  # whether to save output as matlab files
         'save_NWB': False,  # whether to save output as NWB file
+        'save_h5': False,  # whether to also save output as a single chunked, compressed HDF5 file (Fall.h5)
         'combined': True,  # combine multiple planes into a single result /single canvas for GUI
         'aspect': 1.0,  # um/pixels in X / um/pixels in Y (for correct aspect ratio in GUI)
 
@@ -72,19 +78,32 @@ def default_ops():
         'do_registration': 1,  # whether to register data (2 forces re-registration)
         'two_step_registration': False,
         'keep_movie_raw': False,
+        'lazy_registration': False,  # if True (and keep_movie_raw), the registered binary is not written, frames are registered from the raw binary when read
         'nimg_init': 300,  # subsampled frames for finding reference image
+        'ref_bin_size': 1,  # spatial binning of frames when correlating them to pick the initial reference (0: bin to at most 128 x 128)
+        'ref_n_seeds': None,  # number of frames tried as the seed of the initial reference (None: all nimg_init frames)
+        'ref_tol': 0,  # stop refining the reference when the mean correlation changes by less than this fraction (0: never)
         'batch_size': 500,  # number of frames per batch
         'maxregshift': 0.1,  # max allowed registration shift, as a fraction of frame max(width and height)
         'align_by_chan' : 1,  # when multi-channel, you can align by non-functional channel (1-based)
         'reg_tif': False,  # whether to save registered tiffs
         'reg_tif_chan2': False,  # whether to save channel 2 registered tiffs
         'subpixel' : 10,  # precision of subpixel registration (1/subpixel steps)
+        'subpixel_rigid': False,  # refine rigid shifts to 1/subpixel steps with an upsampled DFT and shift frames with a Fourier phase ramp
         'smooth_sigma_time': 0,  # gaussian smoothing in time
         'smooth_sigma': 1.15,  # ~1 good for 2P recordings, recommend 3-5 for 1P recordings
         'th_badframes': 1.0,  # this parameter determines which frames to exclude when determining cropping - set it smaller to exclude more frames
         'norm_frames': True, # normalize frames when detecting shifts
         'force_refImg': False, # if True, use refImg stored in ops if available
-        'pad_fft': False,
+        'pad_fft': False,  # pad frames and nonrigid blocks to the next fast FFT size if their size is not one
+        'real_fft': False,  # phase correlation with real-input FFTs (rfft2) and half-spectrum references
+        'fft_backend': 'old',  # FFT library for registration ('old' = 'mkl_fft', 'scipy', 'pyfftw', 'torch', 'numpy'); 'auto' times the installed ones and saves the fastest in ~/.suite2p
+        'save_tiled': False,  # also save a tile-major copy of the registered movie (data_tiled.bin) for fast per-ROI reads
+        'tile_size': 32,  # height and width of the tiles of data_tiled.bin
+        'temporal_pyramid': [],  # bin sizes (e.g. [4, 16, 64]) of temporally binned copies of the registered movie saved for playback in the GUI
+        'n_reg_workers': 1,  # number of processes registering contiguous chunks of the movie in parallel
+        'pipeline_io': True,  # overlap binary reads and writes with registration compute
+        'n_prefetch': 2,  # number of batches to read ahead / write behind when pipeline_io is on
         
         # non rigid registration settings
         'nonrigid': True,  # whether to use nonrigid registration
@@ -111,11 +130,13 @@ def default_ops():
         'spatial_scale': 0,  # 0: multi-scale; 1: 6 pixels, 2: 12 pixels, 3: 24 pixels, 4: 48 pixels
         'connected': True,  # whether or not to keep ROIs fully connected (set to 0 for dendrites)
         'nbinned': 5000,  # max number of binned frames for cell detection
+        'bin_cache': False,  # save the binned movie next to the binary and reuse it in later detection runs
         'max_iterations': 20,  # maximum number of iterations to do cell detection
         'threshold_scaling': 1.0,  # adjust the automatically determined threshold by this scalar multiplier
         'max_overlap': 0.75,  # cells with more overlap than this get removed during triage, before refinement
         'high_pass': 100,  # running mean subtraction with window of size 'high_pass' (use low values for 1P)
         'denoise': False, # denoise binned movie for cell detection in sparse_mode
+        'n_proc_detect': 8,  # number of worker processes in the pool shared by the 3D detection filters (their n_proc)
 
         # classification parameters
         'soma_crop': True, # crop dendrites for cell classification stats like compactness
@@ -125,6 +146,7 @@ def default_ops():
         'min_neuropil_pixels': 350,  # minimum number of pixels in the neuropil
         'lam_percentile': 50., # percentile of lambda within area to ignore when excluding cell pixels for neuropil extraction
         'allow_overlap': False,  # pixels that are overlapping are thrown out (False) or added to both ROIs (True)
+        'sparse_extraction': False,  # extract all cell and neuropil traces as one sparse matrix product per batch
         'use_builtin_classifier': False,  # whether or not to use built-in classifier for cell detection (overrides
                                          # classifier specified in classifier_path if set to True)
         'classifier_path': 0, # path to classifier
@@ -156,6 +178,15 @@ def run_plane(ops, ops_path=None, stat=None):
     --------
     ops : :obj:`dict` 
     """
+    if ops.get('profile', False) and profiling.get_active() is None:
+        # record the stages of this plane and save them in save_path (profile.json, profile_trace.json)
+        with profiling.activate(profiling.StageProfiler()) as profiler:
+            with profiling.stage('plane'):
+                ops = run_plane(ops, ops_path=ops_path, stat=stat)
+        profiler.save_json(os.path.join(ops['save_path'], 'profile.json'))
+        profiler.save_chrome_trace(os.path.join(ops['save_path'], 'profile_trace.json'))
+        return ops
+
     t1 = time.time()
     
     ops = {**default_ops(), **ops}
@@ -167,7 +198,8 @@ def run_plane(ops, ops_path=None, stat=None):
         ops['save_path'] = os.path.split(ops_path)[0]
         ops['ops_path'] = ops_path 
         if len(ops['fast_disk'])==0 or ops['save_path']!=ops['fast_disk']:
-            if os.path.exists(os.path.join(ops['save_path'], 'data.bin')):
+            if (os.path.exists(os.path.join(ops['save_path'], 'data.bin'))
+                    or os.path.exists(os.path.join(ops['save_path'], 'data_raw.bin'))):
                 ops['reg_file'] = os.path.join(ops['save_path'], 'data.bin')
                 if 'reg_file_chan2' in ops:
                     ops['reg_file_chan2'] = os.path.join(ops['save_path'], 'data_chan2.bin')    
@@ -175,6 +207,8 @@ def run_plane(ops, ops_path=None, stat=None):
                     ops['raw_file'] = os.path.join(ops['save_path'], 'data_raw.bin')
                 if 'raw_file_chan2' in ops:
                     ops['raw_file_chan2'] = os.path.join(ops['save_path'], 'data_chan2_raw.bin')
+                if 'reg_file_tiled' in ops:
+                    ops['reg_file_tiled'] = os.path.join(ops['save_path'], 'data_tiled.bin')
 
     # check if registration should be done
     if ops['do_registration']>0:
@@ -199,7 +233,8 @@ def run_plane(ops, ops_path=None, stat=None):
         t11=time.time()
         print('----------- REGISTRATION')
         refImg = ops['refImg'] if 'refImg' in ops and ops.get('force_refImg', False) else None
-        ops = registration.register_binary(ops, refImg=refImg) # register binary
+        with profiling.stage('registration'):
+            ops = registration.register_binary(ops, refImg=refImg) # register binary
         np.save(ops['ops_path'], ops)
         plane_times['registration'] = time.time()-t11
         print('----------- Total %0.2f sec' % plane_times['registration'])
@@ -207,17 +242,31 @@ def run_plane(ops, ops_path=None, stat=None):
         if ops['two_step_registration'] and ops['keep_movie_raw']:
             print('----------- REGISTRATION STEP 2')
             print('(making mean image (excluding bad frames)')
-            with io.BinaryFile(Lx=ops['Lx'], Ly=ops['Ly'], read_filename=ops['reg_file']) as f:
+            with registration.open_registered(ops) as f:
                 refImg = f.sampled_mean()
-            ops = registration.register_binary(ops, refImg, raw=False)
+            with profiling.stage('two_step_registration'):
+                # lazily registered frames are registered again from the raw binary
+                ops = registration.register_binary(ops, refImg, raw=ops.get('lazy_registration', False))
             np.save(ops['ops_path'], ops)
             plane_times['two_step_registration'] = time.time()-t11
             print('----------- Total %0.2f sec' % plane_times['two_step_registration'])
 
+        if ops.get('save_tiled', False):
+            t0 = time.time()
+            ops['reg_file_tiled'] = os.path.join(ops['save_path'], 'data_tiled.bin')
+            with profiling.stage('save_tiled'):
+                with registration.open_registered(ops) as f:
+                    io.write_tiled(f, ops['reg_file_tiled'], tile_size=ops['tile_size'], batch_size=ops['batch_size'])
+            ops['reg_file_tiled_key'] = io.registration_key(ops)
+            np.save(ops['ops_path'], ops)
+            plane_times['save_tiled'] = time.time() - t0
+            print('Saved tiled copy of registered movie, %0.2f sec.' % plane_times['save_tiled'])
+
         # compute metrics for registration
         if ops.get('do_regmetrics', True) and ops['nframes']>=1500:
             t0 = time.time()
-            ops = registration.get_pc_metrics(ops)
+            with profiling.stage('registration_metrics'):
+                ops = registration.get_pc_metrics(ops)
             plane_times['registration_metrics'] = time.time()-t0
             print('Registration metrics, %0.2f sec.' % plane_times['registration_metrics'])
             np.save(os.path.join(ops['save_path'], 'ops.npy'), ops)
@@ -242,14 +291,16 @@ def run_plane(ops, ops_path=None, stat=None):
         t11=time.time()
         print('----------- ROI DETECTION')
         if stat is None:
-            ops, stat = detection.detect(ops=ops, classfile=classfile)
+            with profiling.stage('detection'):
+                ops, stat = detection.detect(ops=ops, classfile=classfile)
         plane_times['detection'] = time.time()-t11
         print('----------- Total %0.2f sec.' % plane_times['detection'])
 
         ######## ROI EXTRACTION ##############
         t11=time.time()
         print('----------- EXTRACTION')
-        ops, stat, F, Fneu, F_chan2, Fneu_chan2 = extraction.create_masks_and_extract(ops, stat)
+        with profiling.stage('extraction'):
+            ops, stat, F, Fneu, F_chan2, Fneu_chan2 = extraction.create_masks_and_extract(ops, stat)
         # save results
         np.save(ops['ops_path'], ops)
         fpath = ops['save_path']
@@ -267,7 +318,8 @@ def run_plane(ops, ops_path=None, stat=None):
         t11=time.time()
         print('----------- CLASSIFICATION')
         if len(stat):
-            iscell = classification.classify(stat=stat, classfile=classfile)
+            with profiling.stage('classification'):
+                iscell = classification.classify(stat=stat, classfile=classfile)
         else:
             iscell = np.zeros((0, 2))
         np.save(Path(ops['save_path']).joinpath('iscell.npy'), iscell)
@@ -288,7 +340,8 @@ def run_plane(ops, ops_path=None, stat=None):
                 fs=ops['fs'],
                 prctile_baseline=ops['prctile_baseline']
             )
-            spks = extraction.oasis(F=dF, batch_size=ops['batch_size'], tau=ops['tau'], fs=ops['fs'])
+            with profiling.stage('deconvolution'):
+                spks = extraction.oasis(F=dF, batch_size=ops['batch_size'], tau=ops['tau'], fs=ops['fs'])
             plane_times['deconvolution'] = time.time()-t11
             print('----------- Total %0.2f sec.' % plane_times['deconvolution'])
         else:
@@ -302,6 +355,14 @@ def run_plane(ops, ops_path=None, stat=None):
             iscell = np.load(os.path.join(ops['save_path'], 'iscell.npy'))
             redcell = np.load(os.path.join(ops['save_path'], 'redcell.npy')) if ops['nchannels']==2 else []
             io.save_mat(ops, stat, F, Fneu, spks, iscell, redcell)
+
+        # save as chunked HDF5 file
+        if ops.get('save_h5'):
+            redcell_path = os.path.join(ops['save_path'], 'redcell.npy')
+            redcell = np.load(redcell_path) if os.path.isfile(redcell_path) else []
+            io.save_h5(ops, stat, F, Fneu, spks, iscell, redcell,
+                       F_chan2 if 'meanImg_chan2' in ops else None,
+                       Fneu_chan2 if 'meanImg_chan2' in ops else None)
             
     else:
         print("WARNING: skipping cell detection (ops['roidetect']=False)")
@@ -331,6 +392,65 @@ def run_plane(ops, ops_path=None, stat=None):
     return ops
 
 
+def available_memory():
+    """ returns the physical memory currently available in bytes (None if it cannot be determined) """
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def plane_workers(ops, nplanes):
+    """ number of planes to run concurrently, from ops['n_plane_workers'] and ops['plane_worker_mem_gb'] """
+    n_workers = int(ops.get('n_plane_workers', 1))
+    if n_workers <= 0:
+        n_workers = os.cpu_count() or 1
+    n_workers = min(n_workers, nplanes)
+    if n_workers > 1 and ops.get('plane_worker_mem_gb', 0) > 0:
+        mem = available_memory()
+        if mem is not None:
+            n_workers = min(n_workers, max(1, int(mem // (ops['plane_worker_mem_gb'] * 2**30))))
+            print('NOTE: %0.1f GB available, running up to %d planes at once' % (mem / 2**30, n_workers))
+    return n_workers
+
+
+def _init_plane_worker(nthreads):
+    """ splits the cores between plane workers so that numba and torch do not oversubscribe them """
+    import numba
+    import torch
+    numba.set_num_threads(min(nthreads, numba.config.NUMBA_NUM_THREADS))
+    torch.set_num_threads(nthreads)
+
+
+def _run_plane_worker(ipl, op, ops_path):
+    op = run_plane(op, ops_path=ops_path)
+    return ipl, op
+
+
+def run_planes_parallel(planes, n_workers):
+    """ runs run_plane on each (ipl, ops, ops_path) in planes in a pool of n_workers local processes
+
+    Returns
+    -------
+    op : :obj:`dict`
+        ops of the last plane
+    """
+    nthreads = max(1, (os.cpu_count() or 1) // n_workers)
+    print('>>>>>>>>>>>>>>>>>>>>> RUNNING %d PLANES ON %d WORKERS (%d threads each) <<<<<<<<<<<<<<<<<<<<<<'
+          % (len(planes), n_workers, nthreads))
+    ops_out = {}
+    # spawn (rather than fork) so that workers do not inherit numba / torch thread pools
+    with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_plane_worker, initargs=(nthreads,)) as executor:
+        futures = [executor.submit(_run_plane_worker, ipl, op, ops_path) for ipl, op, ops_path in planes]
+        for future in as_completed(futures):
+            ipl, op = future.result()
+            ops_out[ipl] = op
+            print('Plane %d processed in %0.2f sec (can open in GUI).' %
+                    (ipl, op['timing']['total_plane_runtime']))
+    return ops_out[planes[-1][0]]
+
+
 def run_s2p(ops={}, db={}, server={}):
     """ run suite2p pipeline
 
@@ -432,6 +552,7 @@ def run_s2p(ops={}, db={}, server={}):
             io.server.send_jobs(save_folder)
         return None
     else:
+        planes = []
         for ipl, ops_path in enumerate(ops_paths):
             if ipl in ops['ignore_flyback']:
                 print('>>>> skipping flyback PLANE', ipl)
@@ -443,11 +564,17 @@ def run_s2p(ops={}, db={}, server={}):
                 if key not in ['data_path', 'save_path0', 'fast_disk', 'save_folder', 'subfolders']:
                     if key in ops:
                         op[key] = ops[key]
-            
-            print('>>>>>>>>>>>>>>>>>>>>> PLANE %d <<<<<<<<<<<<<<<<<<<<<<'%ipl)
-            op = run_plane(op, ops_path=ops_path)
-            print('Plane %d processed in %0.2f sec (can open in GUI).' % 
-                    (ipl, op['timing']['total_plane_runtime']))  
+            planes.append((ipl, op, ops_path))
+
+        n_workers = plane_workers(ops, len(planes))
+        if n_workers > 1:
+            op = run_planes_parallel(planes, n_workers)
+        else:
+            for ipl, op, ops_path in planes:
+                print('>>>>>>>>>>>>>>>>>>>>> PLANE %d <<<<<<<<<<<<<<<<<<<<<<'%ipl)
+                op = run_plane(op, ops_path=ops_path)
+                print('Plane %d processed in %0.2f sec (can open in GUI).' % 
+                        (ipl, op['timing']['total_plane_runtime']))  
         run_time = time.time()-t0
         print('total = %0.2f sec.' % run_time)
 
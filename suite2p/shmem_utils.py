@@ -0,0 +1,144 @@
+import atexit
+import multiprocessing
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as n
+
+# long-lived worker pool, reused across the 3D filtering steps and the registration chunks
+_pool = None
+_pool_size = 0
+
+
+def create_shmem(shmem_params):
+    """ creates a shared memory block of shmem_params['nbytes'] and stores its name in shmem_params """
+    shmem = shared_memory.SharedMemory(create=True, size=max(1, int(shmem_params['nbytes'])))
+    shmem_params['name'] = shmem.name
+    return shmem, shmem_params
+
+
+def create_shmem_array(shape, dtype=n.float32):
+    """ creates an uninitialized shared memory array, returns (shmem, shmem_params, shmem_arr) """
+    dtype = n.dtype(dtype)
+    shmem_params = {'dtype': dtype.str, 'shape': tuple(shape), 'nbytes': int(n.prod(shape)) * dtype.itemsize}
+    shmem, shmem_params = create_shmem(shmem_params)
+    shmem_arr = n.ndarray(shmem_params['shape'], dtype, buffer=shmem.buf)
+    return shmem, shmem_params, shmem_arr
+
+
+def create_shmem_from_arr(sample_arr, copy=False):
+    """ creates a shared memory array with the shape and dtype of sample_arr (and its contents if copy)
+
+    Returns
+    -------
+    shmem : SharedMemory
+        handle that owns the block, must be kept alive (and freed with free_shmem) by the caller
+    shmem_params : dict
+        'name', 'shape', 'dtype', 'nbytes' -- picklable, pass this to workers and load it with load_shmem
+    shmem_arr : ndarray
+        array backed by the shared memory block
+    """
+    shmem, shmem_params, shmem_arr = create_shmem_array(sample_arr.shape, sample_arr.dtype)
+    if copy:
+        shmem_arr[:] = sample_arr
+    return shmem, shmem_params, shmem_arr
+
+
+def load_shmem(shmem_params):
+    """ attaches to the shared memory array described by shmem_params, returns (shmem, arr)
+
+    when done, delete arr and then call shmem.close() so that the block can be freed by its owner
+    """
+    try:
+        # the creating process owns the block, attaching processes must not unlink it on exit
+        shmem = shared_memory.SharedMemory(name=shmem_params['name'], create=False, track=False)
+    except TypeError:
+        # registers the block with the parent's resource tracker, which the pool workers share
+        shmem = shared_memory.SharedMemory(name=shmem_params['name'], create=False)
+    arr = n.ndarray(shmem_params['shape'], n.dtype(shmem_params['dtype']), buffer=shmem.buf)
+    return shmem, arr
+
+
+def free_shmem(shmem):
+    """ detaches and releases a shared memory block created with create_shmem """
+    try:
+        shmem.close()
+    except BufferError:
+        # arrays still view the block, the mapping goes away with them
+        pass
+    shmem.unlink()
+
+
+class SharedArrays:
+    """
+    Creates shared memory arrays and keeps track of them so that they can all be released at once.
+
+    Usage
+    -----
+    with SharedArrays() as shm:
+        mov_params, mov_sh = shm.create(mov, copy=True)
+        np_sub_and_conv3d_shmem(mov_params, ...)
+        result = mov_sh.copy()
+    """
+
+    def __init__(self):
+        self.blocks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.free_all()
+
+    def create(self, sample_arr=None, shape=None, dtype=n.float32, copy=True):
+        """ creates a shared array like sample_arr (or of shape and dtype), returns (shmem_params, shmem_arr) """
+        if sample_arr is None:
+            shmem, shmem_params, shmem_arr = create_shmem_array(shape, dtype)
+        else:
+            shmem, shmem_params, shmem_arr = create_shmem_from_arr(sample_arr, copy=copy)
+        self.blocks[shmem_params['name']] = shmem
+        return shmem_params, shmem_arr
+
+    def free(self, shmem_params):
+        """ releases the shared array described by shmem_params """
+        free_shmem(self.blocks.pop(shmem_params['name']))
+
+    def free_all(self):
+        """ releases all shared arrays created by this manager """
+        for name in list(self.blocks):
+            free_shmem(self.blocks.pop(name))
+
+
+def get_pool(n_proc=None):
+    """ returns a long-lived pool of worker processes, started on first use and reused by later calls
+
+    starting a process costs 1-2 s of suite2p re-import (with the spawn start method), which would
+    otherwise dominate short filtering steps, so the pool is reused whatever size later calls ask for,
+    and only restarted to grow it when more than its n_proc workers are asked for
+
+    Parameters
+    ----------
+    n_proc : int (optional, default the existing pool, or 8 workers)
+        minimum number of workers
+    """
+    global _pool, _pool_size
+    if _pool is not None and n_proc is not None and n_proc > _pool_size:
+        close_pool()
+    if _pool is None:
+        n_proc = n_proc or 8
+        # forking after torch / numba have started their threads can deadlock the workers
+        resource_tracker.ensure_running()
+        _pool = multiprocessing.get_context('spawn').Pool(n_proc)
+        _pool_size = n_proc
+    return _pool
+
+
+def close_pool():
+    """ shuts down the worker pool created by get_pool """
+    global _pool, _pool_size
+    if _pool is not None:
+        _pool.close()
+        _pool.join()
+        _pool, _pool_size = None, 0
+
+
+atexit.register(close_pool)
@@ -1,4 +1,9 @@
+from pathlib import Path
+
+import numpy as np
+
 import suite2p
+from suite2p.run_s2p import available_memory, plane_workers, run_planes_parallel
 
 
 def test_do_registration_do_roi_detect_settings_check_timing(test_ops):
@@ -32,3 +37,32 @@ def test_do_registration_do_roi_detect_settings_check_timing(test_ops):
     det_dec_ops = suite2p.run_s2p(ops=test_ops)  # detection & deconvolution
     assert list(det_dec_ops['timing'].keys()) == ['detection', 'extraction', 'classification',
                                                      'deconvolution', 'total_plane_runtime']
+
+
+def test_plane_workers_respects_worker_count_and_memory_budget():
+    ops = suite2p.default_ops()
+    assert plane_workers(ops, nplanes=30) == 1
+    ops['n_plane_workers'] = 4
+    assert plane_workers(ops, nplanes=30) == 4
+    assert plane_workers(ops, nplanes=2) == 2
+    ops['plane_worker_mem_gb'] = 1e9
+    assert plane_workers(ops, nplanes=30) == (4 if available_memory() is None else 1)
+
+
+def test_planes_run_in_parallel_worker_processes(tmpdir):
+    rs = np.random.RandomState(0)
+    ops = suite2p.default_ops()
+    ops.update({'Ly': 64, 'Lx': 64, 'nframes': 100, 'batch_size': 50, 'nimg_init': 50, 'data_path': [],
+                'nonrigid': False, 'roidetect': False, 'do_regmetrics': False})
+    planes = []
+    for ipl in range(2):
+        save_path = Path(tmpdir).joinpath('plane%d' % ipl)
+        save_path.mkdir()
+        rs.randint(0, 1000, (100, 64, 64)).astype(np.int16).tofile(str(save_path.joinpath('data.bin')))
+        op = {**ops, 'save_path': str(save_path), 'reg_file': str(save_path.joinpath('data.bin')),
+              'ops_path': str(save_path.joinpath('ops.npy'))}
+        planes.append((ipl, op, op['ops_path']))
+    op = run_planes_parallel(planes, n_workers=2)
+    assert op['save_path'] == planes[-1][1]['save_path']
+    for _, op, ops_path in planes:
+        assert 'registration' in np.load(ops_path, allow_pickle=True).item()['timing']
@@ -0,0 +1,66 @@
+"""
+Tests for the Suite2p Detection module.
+"""
+import numpy as np
+import pytest
+
+from suite2p import shmem_utils
+
+
+def add_one_worker(shmem_params, idxs):
+    shmem, arr = shmem_utils.load_shmem(shmem_params)
+    arr[idxs] += 1
+    del arr
+    shmem.close()
+
+
+def test_shared_arrays_are_updated_in_place_by_a_reused_pool():
+    mov = np.arange(40, dtype=np.float32).reshape(10, 4)
+    pool = shmem_utils.get_pool(2)
+    try:
+        with shmem_utils.SharedArrays() as shm:
+            shmem_params, mov_sh = shm.create(mov, copy=True)
+            pool.starmap(add_one_worker, [(shmem_params, np.arange(i, i + 5)) for i in (0, 5)])
+            assert np.array_equal(mov_sh, mov + 1)
+            pool.starmap(add_one_worker, [(shmem_params, np.arange(10))])
+            assert np.array_equal(mov_sh, mov + 2)
+            assert len(shm.blocks) == 1
+        assert len(shm.blocks) == 0
+        assert shmem_utils.get_pool(2) is pool
+    finally:
+        shmem_utils.close_pool()
+
+
+def test_pool_is_reused_for_any_size_and_only_restarted_to_grow():
+    pool = shmem_utils.get_pool(2)
+    try:
+        assert shmem_utils.get_pool(1) is pool
+        assert shmem_utils.get_pool() is pool
+        assert shmem_utils.get_pool(2) is pool
+        larger = shmem_utils.get_pool(3)
+        assert larger is not pool
+        assert shmem_utils.get_pool(2) is larger
+    finally:
+        shmem_utils.close_pool()
+
+
+def test_streamed_svd_reconstruction_matches_dense_reconstruction(tmpdir):
+    pytest.importorskip('dask')
+    pytest.importorskip('dask_image')
+    pytest.importorskip('zarr')
+    from dask import array as darr
+    from suite2p.detection import svd_utils
+
+    # nz x nt x ny x nx, with as many components as frames so that every block is reconstructed exactly
+    rs = np.random.RandomState(0)
+    mov = rs.randn(2, 30, 24, 24).astype(np.float32)
+    svd_info = svd_utils.block_and_svd(darr.from_array(mov), n_comp=30, block_shape=(1, 16, 16),
+                                       block_overlaps=(0, 8, 8), svd_dir=str(tmpdir))
+    dense = svd_utils.reconstruct_overlapping_movie(svd_info, (5, 27))
+
+    chunks = list(svd_utils.reconstruct_stream(str(tmpdir), t_indices=(5, 27), t_chunk=8))
+    assert [t_start for t_start, _ in chunks] == [5, 13, 21]
+    streamed = np.concatenate([chunk for _, chunk in chunks])
+    assert streamed.shape == dense.shape == (22, 2, 24, 24)
+    np.testing.assert_allclose(streamed, dense, atol=1e-4)
+    np.testing.assert_allclose(streamed, mov[:, 5:27].swapaxes(0, 1), atol=1e-3)
@@ -0,0 +1,84 @@
+"""
+Tests for the Suite2p Extraction module.
+"""
+from pathlib import Path
+
+import numpy as np
+
+from suite2p import extraction, io
+from suite2p.extraction.extract import extract_traces
+from suite2p.io import BinaryFile
+
+
+def test_sparse_extraction_matches_per_roi_extraction(tmpdir):
+    rs = np.random.RandomState(0)
+    Ly, Lx, nframes = 32, 40, 130
+    bin_filename = str(Path(tmpdir).joinpath('data.bin'))
+    rs.randint(0, 1000, (nframes, Ly, Lx)).astype(np.int16).tofile(bin_filename)
+    cell_masks = []
+    for _ in range(12):
+        ipix = np.unique(rs.randint(0, Ly * Lx, 30))
+        lam = rs.rand(len(ipix)).astype(np.float32)
+        cell_masks.append((ipix, lam / lam.sum()))
+    neuropil_masks = [np.unique(rs.randint(0, Ly * Lx, 200)) for _ in range(12)]
+
+    results = []
+    for sparse_extraction in [False, True]:
+        ops = {'Ly': Ly, 'Lx': Lx, 'nframes': nframes, 'batch_size': 50, 'sparse_extraction': sparse_extraction}
+        with BinaryFile(Ly=Ly, Lx=Lx, read_filename=bin_filename) as f:
+            F, Fneu, _ = extract_traces(ops, cell_masks, neuropil_masks, f)
+        results.append((F, Fneu))
+    assert np.allclose(results[0][0], results[1][0], rtol=1e-5)
+    assert np.allclose(results[0][1], results[1][1], rtol=1e-5)
+
+
+def test_tiled_extraction_matches_streamed_extraction(tmpdir):
+    rs = np.random.RandomState(1)
+    Ly, Lx, nframes = 40, 36, 50
+    mov = rs.randint(0, 2000, size=(nframes, Ly, Lx)).astype(np.int16)
+    reg_file = str(Path(tmpdir).joinpath('data.bin'))
+    mov.tofile(reg_file)
+    cell_masks = [(np.array([0, 1, 37, 500]), np.array([.1, .2, .3, .4], np.float32)),
+                  (np.arange(700, 740), np.full(40, 1 / 40, np.float32))]
+    neuropil_masks = [np.arange(100, 300), np.arange(1000, 1400)]
+    ops = {'Ly': Ly, 'Lx': Lx, 'nframes': nframes, 'batch_size': 16, 'reg_file': reg_file}
+    F, Fneu, _, _, _ = extraction.extract_traces_from_masks(ops, cell_masks, neuropil_masks)
+
+    ops['reg_file_tiled'] = str(Path(tmpdir).joinpath('data_tiled.bin'))
+    ops['tile_size'] = 8
+    with io.BinaryFile(Ly=Ly, Lx=Lx, read_filename=reg_file) as f:
+        io.write_tiled(f, ops['reg_file_tiled'], tile_size=8, batch_size=16)
+    ops['reg_file_tiled_key'] = io.registration_key(ops)
+    F_tiled, Fneu_tiled, _, _, _ = extraction.extract_traces_from_masks(ops, cell_masks, neuropil_masks, tiled=True)
+    assert np.allclose(F_tiled, F, rtol=1e-5)
+    assert np.allclose(Fneu_tiled, Fneu, rtol=1e-5)
+
+
+def test_tiled_copy_is_only_read_when_asked_for_and_saved_with_the_current_offsets(tmpdir):
+    rs = np.random.RandomState(2)
+    Ly, Lx, nframes = 24, 20, 30
+    mov = rs.randint(0, 2000, size=(nframes, Ly, Lx)).astype(np.int16)
+    reg_file = str(Path(tmpdir).joinpath('data.bin'))
+    mov.tofile(reg_file)
+    cell_masks = [(np.arange(40, 60), np.full(20, 1 / 20, np.float32))]
+    neuropil_masks = [np.arange(200, 300)]
+    ops = {'Ly': Ly, 'Lx': Lx, 'nframes': nframes, 'batch_size': 16, 'reg_file': reg_file,
+           'yoff': np.zeros(nframes, np.int32), 'xoff': np.zeros(nframes, np.int32),
+           'reg_file_tiled': str(Path(tmpdir).joinpath('data_tiled.bin')), 'tile_size': 8}
+    F, _, _, _, _ = extraction.extract_traces_from_masks(ops, cell_masks, neuropil_masks)
+
+    # a tiled copy of a different movie tells which file the traces were read from
+    other_file = str(Path(tmpdir).joinpath('other.bin'))
+    (mov // 2).tofile(other_file)
+    with io.BinaryFile(Ly=Ly, Lx=Lx, read_filename=other_file) as f:
+        io.write_tiled(f, ops['reg_file_tiled'], tile_size=8, batch_size=16)
+    ops['reg_file_tiled_key'] = io.registration_key(ops)
+    F_tiled, _, _, _, _ = extraction.extract_traces_from_masks(ops, cell_masks, neuropil_masks, tiled=True)
+    assert not np.allclose(F_tiled, F)
+    F_streamed, _, _, _, _ = extraction.extract_traces_from_masks(ops, cell_masks, neuropil_masks)
+    assert np.allclose(F_streamed, F)
+
+    # registering again changes the offsets, so the tiled copy is stale
+    ops['yoff'] = np.ones(nframes, np.int32)
+    F_stale, _, _, _, _ = extraction.extract_traces_from_masks(ops, cell_masks, neuropil_masks, tiled=True)
+    assert np.allclose(F_stale, F)
@@ -12,6 +12,7 @@ from pynwb import NWBHDF5IO
 from suite2p import io
 from suite2p.io.nwb import save_nwb
 from suite2p.io.utils import get_suite2p_path
+from suite2p.registration.register import shift_frames
 
 
 @pytest.fixture()
@@ -163,3 +164,192 @@ def test_get_suite2p_path(input_path, expected_path, success):
     else:
         with pytest.raises(FileNotFoundError):
             get_suite2p_path(Path(input_path))
+
+
+@pytest.fixture()
+def synthetic_binfile(tmpdir):
+    data = np.random.RandomState(0).randint(0, 1000, size=(60, 16, 12)).astype(np.int16)
+    bin_filename = str(Path(tmpdir).joinpath('data.bin'))
+    data.tofile(bin_filename)
+    return bin_filename, data
+
+
+def test_memmap_binaryfile_matches_buffered_reads(synthetic_binfile):
+    bin_filename, data = synthetic_binfile
+    inds = np.array([3, 4, 5, 40, 12])
+    with io.BinaryFile(Ly=16, Lx=12, read_filename=bin_filename, mmap_mode='r') as f:
+        assert f.n_frames == 60
+        assert np.array_equal(f.data, data)
+        assert np.array_equal(f[inds], data[inds])
+        assert np.array_equal(f[10:20], data[10:20])
+        assert np.allclose(f.sampled_mean(), data.astype(np.float32).mean(axis=0))
+        batches = [frames for _, frames in f.iter_frames(batch_size=25, dtype=np.int16)]
+        assert np.array_equal(np.concatenate(batches), data)
+        with pytest.raises(IOError):
+            f.write(data[:1])
+
+
+def test_memmap_binaryfile_writes_in_place(synthetic_binfile):
+    bin_filename, data = synthetic_binfile
+    with io.BinaryFile(Ly=16, Lx=12, read_filename=bin_filename, write_filename=bin_filename, mmap_mode='r+') as f:
+        for _, frames in f.iter_frames(batch_size=25):
+            f.write(frames + 1)
+    assert np.array_equal(np.fromfile(bin_filename, np.int16).reshape(data.shape), data + 1)
+
+
+@pytest.mark.parametrize('mmap_mode', [None, 'r'])
+def test_binaryfile_sizes_of_empty_and_closed_files(synthetic_binfile, tmpdir, mmap_mode):
+    empty_filename = str(Path(tmpdir).joinpath('empty.bin'))
+    open(empty_filename, 'wb').close()
+    with io.BinaryFile(Ly=16, Lx=12, read_filename=empty_filename, mmap_mode=mmap_mode) as f:
+        assert f.n_frames == 0
+        assert f.data.shape == (0, 16, 12)
+        assert len(list(f.iter_frames(batch_size=10))) == 0
+
+    bin_filename, data = synthetic_binfile
+    f = io.BinaryFile(Ly=16, Lx=12, read_filename=bin_filename, mmap_mode=mmap_mode)
+    f.close()
+    assert f.n_frames == 60 and f.shape == data.shape
+
+
+def test_coalesced_reads_match_requested_frames(synthetic_binfile):
+    bin_filename, data = synthetic_binfile
+    inds = np.array([40, 3, 4, 5, 12, 4, 59, 0])
+    with io.BinaryFile(Ly=16, Lx=12, read_filename=bin_filename) as f:
+        _, first = f.read(batch_size=2, dtype=np.int16)
+        assert np.array_equal(f[inds], data[inds])
+        assert np.array_equal(f[10:20], data[10:20])
+        assert np.allclose(f.sampled_mean(), data.astype(np.float32).mean(axis=0))
+        # random access does not move the position of sequential reads
+        _, second = f.read(batch_size=2, dtype=np.int16)
+    assert np.array_equal(np.concatenate([first, second]), data[:4])
+
+    runs = io.binary.coalesce_runs(np.array([0, 1, 2, 5, 6, 30, 31]), nbytes_frame=100, max_gap_bytes=300)
+    assert runs == [(0, 5), (5, 7)]
+    runs = io.binary.coalesce_runs(np.arange(10), nbytes_frame=100, max_run_bytes=400)
+    assert runs == [(0, 4), (4, 8), (8, 10)]
+
+
+def test_h5_results_store_loads_subsets_of_rois_and_frames(tmpdir):
+    rs = np.random.RandomState(0)
+    ncells, nframes = 30, 500
+    F, Fneu, spks = [rs.randn(ncells, nframes).astype(np.float32) for _ in range(3)]
+    iscell = np.stack([rs.rand(ncells) > 0.5, rs.rand(ncells)], axis=1)
+    stat = np.array([{'ypix': np.arange(n), 'xpix': np.arange(n) + 1, 'lam': rs.rand(n).astype(np.float32),
+                      'med': [n, n + 1], 'npix': n} for n in rs.randint(5, 50, ncells)])
+    ops = {'save_path': str(tmpdir), 'meanImg': rs.rand(64, 48).astype(np.float32), 'Ly': 64, 'tau': 1.5,
+           'save_path0': Path(tmpdir)}
+
+    filename = io.save_h5(ops, stat, F, Fneu, spks, iscell, [], roi_chunk=8, time_chunk=128)
+    rois, frames = np.array([2, 5, 17]), slice(100, 300)
+    results = io.load_h5(filename, rois=rois, frames=frames)
+
+    for key, trace in zip(['F', 'Fneu', 'spks'], [F, Fneu, spks]):
+        np.testing.assert_array_equal(results[key], trace[rois, frames])
+    np.testing.assert_array_equal(results['iscell'], iscell[rois])
+    for s, s0 in zip(results['stat'], stat[rois]):
+        for key in ['ypix', 'xpix', 'lam', 'med', 'npix']:
+            np.testing.assert_array_equal(s[key], s0[key])
+    np.testing.assert_array_equal(results['ops']['meanImg'], ops['meanImg'])
+    assert results['ops']['tau'] == 1.5
+
+
+def test_binned_movie_cache_is_reused_until_binary_changes(tmpdir):
+    rs = np.random.RandomState(0)
+    data = rs.randint(0, 1000, size=(600, 16, 12)).astype(np.int16)
+    bin_filename = str(Path(tmpdir).joinpath('data.bin'))
+    data.tofile(bin_filename)
+    kwargs = dict(bin_size=10, y_range=[2, 14], x_range=[1, 11])
+    with io.BinaryFile(Ly=16, Lx=12, read_filename=bin_filename) as f:
+        mov = f.bin_movie(**kwargs)
+    with io.BinaryFile(Ly=16, Lx=12, read_filename=bin_filename) as f:
+        mov_cached = f.bin_movie(cache=True, **kwargs)
+        cache_filename = f.bin_movie_cache_filename(**kwargs)
+        assert f.bin_movie_cache_filename(bin_size=5) != cache_filename
+    assert Path(cache_filename).is_file()
+    np.testing.assert_array_equal(mov, mov_cached)
+
+    with io.BinaryFile(Ly=16, Lx=12, read_filename=bin_filename) as f:
+        mov_loaded = f.bin_movie(cache=True, **kwargs)
+    assert isinstance(mov_loaded, np.memmap)
+    np.testing.assert_array_equal(mov, mov_loaded)
+    # in-place changes to the loaded movie are not written back to the cache
+    mov_loaded -= 1
+    np.testing.assert_array_equal(np.load(cache_filename), mov)
+
+    (data + 1).tofile(bin_filename)
+    with io.BinaryFile(Ly=16, Lx=12, read_filename=bin_filename) as f:
+        assert f.bin_movie_cache_filename(**kwargs) != cache_filename
+
+
+def test_binned_movie_cache_of_lazily_registered_binary_changes_with_the_offsets(tmpdir):
+    rs = np.random.RandomState(0)
+    data = rs.randint(0, 1000, size=(200, 16, 12)).astype(np.int16)
+    raw_filename = str(Path(tmpdir).joinpath('data_raw.bin'))
+    data.tofile(raw_filename)
+    ops = {'yoff': rs.randint(-2, 3, 200), 'xoff': rs.randint(-2, 3, 200),
+           'nonrigid': False, 'bidiphase': 0, 'bidi_corrected': False}
+    with io.RegisteredBinaryFile(Ly=16, Lx=12, read_filename=raw_filename, ops=ops,
+                                 shift_frames=shift_frames) as f:
+        mov = f.bin_movie(bin_size=10, cache=True)
+        cache_filename = f.bin_movie_cache_filename(bin_size=10)
+        registered = f.data
+    np.testing.assert_allclose(mov, registered.reshape(20, 10, 16, 12).mean(axis=1), rtol=1e-5)
+
+    # registering again changes the frames read, but not the raw binary
+    ops['yoff'] = ops['yoff'] + 1
+    with io.RegisteredBinaryFile(Ly=16, Lx=12, read_filename=raw_filename, ops=ops,
+                                 shift_frames=shift_frames) as f:
+        assert f.bin_movie_cache_filename(bin_size=10) != cache_filename
+        assert not np.allclose(f.bin_movie(bin_size=10, cache=True), mov)
+
+
+@pytest.mark.parametrize('mmap_mode', [None, 'r+'])
+def test_binaryfile_writes_int16_and_clipped_float_batches(synthetic_binfile, mmap_mode):
+    bin_filename, data = synthetic_binfile
+    expected = data.copy()
+    expected[:25] = np.minimum(data[:25].astype(np.float32) * 40 + 0.5, 2 ** 15 - 2).astype(np.int16)
+    with io.BinaryFile(Ly=16, Lx=12, read_filename=bin_filename, write_filename=bin_filename,
+                       mmap_mode=mmap_mode) as f:
+        for k, (_, frames) in enumerate(f.iter_frames(batch_size=25, dtype=np.int16)):
+            assert frames.dtype == np.int16
+            f.write(frames.astype(np.float32) * 40 + 0.5 if k == 0 else frames)
+    assert np.array_equal(np.fromfile(bin_filename, np.int16).reshape(data.shape), expected)
+
+    buffer = io.binary.Int16Buffer()
+    out = buffer.to_int16(np.full((2, 4), 1e6, np.float32))
+    assert out.dtype == np.int16 and (out == 2 ** 15 - 2).all()
+    assert buffer.to_int16(np.ones((1, 4), np.float64)).base is buffer.buffer
+
+
+def test_combined_binary_reads_windows_from_overlapping_planes(tmpdir):
+    rs = np.random.RandomState(0)
+    Ly, Lx = np.array([10, 10, 8]), np.array([12, 12, 12])
+    dy, dx = np.array([0, 0, 12]), np.array([0, 14, 0])
+    filenames, canvas = [], np.zeros((30, 20, 26), np.int16)
+    for n in range(3):
+        plane = rs.randint(1, 1000, size=(30, Ly[n], Lx[n])).astype(np.int16)
+        canvas[:, dy[n]:dy[n] + Ly[n], dx[n]:dx[n] + Lx[n]] = plane
+        filenames.append(str(Path(tmpdir).joinpath(f'plane{n}.bin')))
+        plane.tofile(filenames[-1])
+
+    inds = np.array([20, 3, 4, 5, 3])
+    with io.BinaryFileCombined(LY=20, LX=26, Ly=Ly, Lx=Lx, dy=dy, dx=dx, read_filenames=filenames) as f:
+        assert list(f.overlapping_planes((2, 9), (1, 20))) == [0, 1]
+        assert list(f.overlapping_planes((10, 12), (0, 26))) == []
+        assert np.array_equal(f.read_window(inds, y_range=(2, 15), x_range=(5, 20)), canvas[inds, 2:15, 5:20])
+        assert np.array_equal(f[10:13, 12:, :4], canvas[10:13, 12:, :4])
+        assert np.array_equal(f[7], canvas[[7]])
+        batches = [frames for _, frames in f.iter_frames(batch_size=12)]
+        assert np.array_equal(np.concatenate(batches), canvas)
+
+
+def test_tiled_copy_returns_pixel_traces(synthetic_binfile, tmpdir):
+    bin_filename, data = synthetic_binfile
+    tiled_filename = str(Path(tmpdir).joinpath('data_tiled.bin'))
+    with io.BinaryFile(Ly=16, Lx=12, read_filename=bin_filename) as f:
+        io.write_tiled(f, tiled_filename, tile_size=5, batch_size=25)
+    ipix = np.array([0, 11, 12 * 15 + 11, 57, 58, 100, 57])
+    with io.TiledBinaryFile(Ly=16, Lx=12, read_filename=tiled_filename, tile_size=5) as f:
+        assert f.n_frames == 60
+        assert np.array_equal(f.pixel_traces(ipix), data.reshape(60, -1)[:, ipix].T.astype(np.float32))
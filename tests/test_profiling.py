@@ -0,0 +1,61 @@
+"""
+Tests for the Suite2p stage profiler.
+"""
+import json
+import sys
+import threading
+from pathlib import Path
+
+import numpy as np
+
+from suite2p import profiling
+
+
+def test_stage_is_a_noop_without_active_profiler():
+    with profiling.stage('anything'):
+        pass
+    assert profiling.get_active() is None
+
+
+def record_stage_in_thread():
+    with profiling.stage('thread'):
+        pass
+
+
+def test_profiler_records_nested_stages_and_exports_traces(tmpdir):
+    with profiling.activate(profiling.StageProfiler()) as profiler:
+        with profiling.stage('outer'):
+            for k in range(3):
+                with profiling.stage('batch', batch=k):
+                    np.ones((256, 256)).sum()
+            thread = threading.Thread(target=record_stage_in_thread)
+            with profiling.stage('in_thread'):
+                thread.start(); thread.join()
+    assert profiling.get_active() is None
+
+    summary = profiler.summary()
+    assert summary['batch']['calls'] == 3
+    assert summary['outer']['wall'] >= summary['batch']['wall']
+    events = {(e['name'], e['args'].get('batch')): e for e in profiler.events}
+    assert events[('outer', None)]['depth'] == 0
+    assert events[('batch', 2)]['depth'] == 1
+
+    json_file, trace_file = Path(tmpdir).joinpath('profile.json'), Path(tmpdir).joinpath('trace.json')
+    profiler.save_json(json_file)
+    profiler.save_chrome_trace(trace_file)
+    assert set(json.loads(json_file.read_text())['summary']) == {'outer', 'batch', 'in_thread', 'thread'}
+    trace = json.loads(trace_file.read_text())['traceEvents']
+    assert len(trace) == 6
+    assert all(e['ph'] == 'X' and e['dur'] >= 0 for e in trace)
+    assert [e['name'] for e in trace][:2] == ['outer', 'batch']
+
+
+def test_peak_memory_is_recorded_without_the_resource_module(monkeypatch):
+    # as on windows, where the resource module does not exist
+    monkeypatch.setitem(sys.modules, 'resource', None)
+    monkeypatch.setitem(sys.modules, 'psutil', None)
+    assert profiling._peak_rss() == 0
+    with profiling.activate(profiling.StageProfiler()) as profiler:
+        with profiling.stage('stage'):
+            pass
+    assert profiler.summary()['stage']['peak_rss'] == 0
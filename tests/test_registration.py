@@ -1,5 +1,11 @@
+from pathlib import Path
+
 import numpy as np
-from suite2p.registration import bidiphase, utils
+import pytest
+
+import suite2p
+from suite2p import io
+from suite2p.registration import bidiphase, nonrigid, register, rigid, utils
 
 
 def test_spatial_smooth_has_not_regressed_during_refactor():
@@ -55,4 +61,371 @@ def test_negative_bidiphase_shift_shifts_every_other_line():
 
     shifted = orig.copy()
     bidiphase.shift(shifted, -2)
-    assert np.allclose(shifted, expected)
\ No newline at end of file
+    assert np.allclose(shifted, expected)
+
+def make_shifted_movie(nframes=120, Ly=96, Lx=112, max_shift=4, seed=0, smooth=2):
+    """Returns an int16 movie of a smooth random image rolled by known integer shifts, and the shifts."""
+    rs = np.random.RandomState(seed)
+    img = rs.rand(Ly + 2 * max_shift, Lx + 2 * max_shift).astype(np.float32)
+    if smooth > 1:
+        img = utils.spatial_smooth(img, smooth)
+    img = (1000 * img / img.max()).astype(np.float32)
+    ys = rs.randint(-max_shift, max_shift + 1, nframes)
+    xs = rs.randint(-max_shift, max_shift + 1, nframes)
+    mov = np.stack([img[max_shift + y:max_shift + y + Ly, max_shift + x:max_shift + x + Lx] for y, x in zip(ys, xs)])
+    mov += 10 * rs.rand(*mov.shape)
+    return mov.astype(np.int16), ys, xs
+
+
+def make_registration_ops(tmpdir, mov, **kwargs):
+    ops = suite2p.default_ops()
+    reg_file = str(Path(tmpdir).joinpath('data.bin'))
+    mov.tofile(reg_file)
+    ops.update({
+        'reg_file': reg_file,
+        'save_path': str(tmpdir),
+        'data_path': [],
+        'nframes': mov.shape[0],
+        'Ly': mov.shape[1],
+        'Lx': mov.shape[2],
+        'batch_size': 50,
+        'nimg_init': 60,
+        'do_regmetrics': False,
+    })
+    ops.update(kwargs)
+    return ops
+
+
+@pytest.mark.parametrize("nonrigid", [False, True])
+def test_pipelined_registration_matches_serial_registration(tmpdir, nonrigid):
+    mov, _, _ = make_shifted_movie()
+    results = []
+    for pipeline_io in [False, True]:
+        folder = Path(tmpdir).joinpath(str(pipeline_io))
+        folder.mkdir()
+        ops = make_registration_ops(folder, mov, pipeline_io=pipeline_io, nonrigid=nonrigid, block_size=[32, 32])
+        ops = register.register_binary(ops)
+        reg = np.fromfile(ops['reg_file'], np.int16).reshape(mov.shape)
+        results.append((reg, ops['yoff'], ops['xoff']))
+    for a, b in zip(*results):
+        assert np.array_equal(a, b)
+
+
+def test_batched_peak_finding_recovers_known_shifts():
+    mov, ys, xs = make_shifted_movie(nframes=20)
+    ops = suite2p.default_ops()
+    ops.update({'Ly': mov.shape[1], 'Lx': mov.shape[2], 'block_size': [32, 32]})
+    maskMul, maskOffset, cfRefImg, maskMulNR, maskOffsetNR, cfRefImgNR = register.compute_reference_masks(
+        mov[0].astype(np.float32), ops)
+
+    ymax, xmax, _ = rigid.phasecorr(rigid.apply_masks(mov, maskMul, maskOffset), cfRefImg, maxregshift=0.1,
+                                    smooth_sigma_time=0)
+    assert np.array_equal(ymax - ymax[0], ys[0] - ys)
+    assert np.array_equal(xmax - xmax[0], xs[0] - xs)
+
+    ymax1, xmax1, cmax1 = nonrigid.phasecorr(mov, maskMulNR.squeeze(), maskOffsetNR.squeeze(), cfRefImgNR.squeeze(),
+                                             snr_thresh=1.2, NRsm=ops['NRsm'], xblock=ops['xblock'],
+                                             yblock=ops['yblock'], maxregshiftNR=5)
+    assert ymax1.shape == xmax1.shape == cmax1.shape == (mov.shape[0], len(ops['yblock']))
+    assert np.allclose(np.median(ymax1, axis=1), ys[0] - ys, atol=0.2)
+    assert np.allclose(np.median(xmax1, axis=1), xs[0] - xs, atol=0.2)
+
+
+def test_registration_writes_temporal_pyramid(tmpdir):
+    mov, _, _ = make_shifted_movie()
+    ops = make_registration_ops(tmpdir, mov, nonrigid=False, temporal_pyramid=[4, 16])
+    ops = register.register_binary(ops)
+    reg = np.fromfile(ops['reg_file'], np.int16).reshape(mov.shape).astype(np.float32)
+    levels = io.pyramid_levels(ops['reg_file'])
+    assert list(levels) == [4, 16]
+    for factor, filename in levels.items():
+        binned = np.fromfile(filename, np.int16).reshape(-1, *mov.shape[1:])
+        # 120 frames in batches of 50: the last 16x bin averages the 8 remaining frames
+        expected = [reg[t:t + factor].mean(axis=0) for t in range(0, mov.shape[0], factor)]
+        assert np.array_equal(binned, np.array(expected).astype(np.int16))
+
+
+@pytest.mark.parametrize("nonrigid", [False, True])
+def test_chunked_registration_matches_single_process_registration(tmpdir, nonrigid):
+    mov, _, _ = make_shifted_movie()
+    results = []
+    for n_reg_workers in [1, 2]:
+        folder = Path(tmpdir).joinpath(str(n_reg_workers))
+        folder.mkdir()
+        ops = make_registration_ops(folder, mov, n_reg_workers=n_reg_workers, nonrigid=nonrigid, block_size=[32, 32])
+        ops = register.register_binary(ops)
+        reg = np.fromfile(ops['reg_file'], np.int16).reshape(mov.shape)
+        results.append([reg, ops['yoff'], ops['xoff'], ops['corrXY']] +
+                       ([ops['yoff1'], ops['xoff1'], ops['corrXY1']] if nonrigid else []))
+    for a, b in zip(*results):
+        assert np.array_equal(a, b)
+
+
+def test_fft_backends_agree_and_fastest_is_selected():
+    rs = np.random.RandomState(0)
+    mov = (rs.randn(4, 24, 30) + 1j * rs.randn(4, 24, 30)).astype(np.complex64)
+    cfRefImg = np.exp(2j * np.pi * rs.rand(24, 30)).astype(np.complex64)
+    expected = utils.convolve(mov, cfRefImg, backend='numpy')
+    expected_real = utils.convolve(mov.real, cfRefImg[:, :16], backend='numpy')
+    for name in utils.fft_backend_names():
+        out = utils.convolve(mov, cfRefImg, backend=name)
+        assert out.dtype == np.complex64
+        assert np.allclose(out, expected, atol=1e-4)
+        out = utils.convolve(mov.real, cfRefImg[:, :16], backend=name)
+        assert out.dtype == np.float32 and out.shape == mov.shape
+        assert np.allclose(out, expected_real, atol=1e-4)
+
+    assert utils.select_fft_backend((24, 30), n_images=2, n_repeats=1, persist=False) in utils.fft_backend_names()
+    assert utils.fastest_fft_backends()[(24, 30, False)] == utils.get_fft_backend('auto', (24, 30)).name
+    with pytest.warns(UserWarning):
+        assert utils.get_fft_backend('not_a_backend', (24, 30)).name in utils.fft_backend_names()
+
+
+def test_default_fft_backend_is_not_timed(monkeypatch):
+    def select_fft_backend(*args, **kwargs):
+        raise AssertionError('FFT backends are only timed for fft_backend="auto"')
+    monkeypatch.setattr(utils, 'select_fft_backend', select_fft_backend)
+    mov, ys, xs = make_shifted_movie(nframes=8, Ly=32, Lx=40)
+    ops = suite2p.default_ops()
+    ops.update({'Ly': 32, 'Lx': 40, 'nonrigid': True, 'block_size': [16, 20], 'subpixel_rigid': True, 'norm_frames': False})
+    refAndMasks = register.compute_reference_masks(mov[0].astype(np.float32), ops)
+    register.register_frames(refAndMasks, mov.copy(), ops)
+    with pytest.warns(UserWarning):
+        assert utils.get_fft_backend('not_a_backend', (32, 40)).name in utils.fft_backend_names()
+
+
+@pytest.mark.parametrize("Lx", [112, 111])
+def test_real_fft_phasecorr_matches_complex_phasecorr(Lx):
+    mov, ys, xs = make_shifted_movie(nframes=20, Lx=Lx)
+    refImg = mov[0].astype(np.float32)
+    maskMul, maskOffset = rigid.compute_masks(refImg, maskSlope=3)
+    results = []
+    for real in [False, True]:
+        cfRefImg = rigid.phasecorr_reference(refImg, smooth_sigma=1.15, real=real)
+        assert cfRefImg.shape == (96, Lx // 2 + 1 if real else Lx)
+        data = rigid.apply_masks(mov, maskMul, maskOffset, real=real)
+        assert data.dtype == (np.float32 if real else np.complex64)
+        results.append(rigid.phasecorr(data, cfRefImg, maxregshift=0.1, smooth_sigma_time=0))
+    (ymax, xmax, cmax), (ymax_r, xmax_r, cmax_r) = results
+    assert np.array_equal(ymax_r, ymax) and np.array_equal(xmax_r, xmax)
+    assert np.allclose(cmax_r, cmax, atol=1e-5)
+    assert np.array_equal(ymax - ymax[0], ys[0] - ys)
+
+
+@pytest.mark.parametrize("real", [False, True])
+def test_padded_phasecorr_recovers_shifts_of_awkward_frame_sizes(real):
+    mov, ys, xs = make_shifted_movie(nframes=20, Ly=97, Lx=113)
+    refImg = mov[0].astype(np.float32)
+    maskMul, maskOffset = rigid.compute_masks(refImg, maskSlope=3)
+    cfRefImg = rigid.phasecorr_reference(refImg, smooth_sigma=1.15, real=real, pad_fft=True)
+    pLy, pLx = utils.fast_fft_shape(97, 113, real)
+    assert (pLy, pLx) != (97, 113)
+    assert cfRefImg.shape == (pLy, pLx // 2 + 1 if real else pLx)
+    assert utils.spectrum_fft_shape(cfRefImg, 97, 113) == (pLy, pLx, real)
+    ymax, xmax, _ = rigid.phasecorr(rigid.apply_masks(mov, maskMul, maskOffset, real=real), cfRefImg,
+                                    maxregshift=0.1, smooth_sigma_time=0)
+    assert np.array_equal(ymax - ymax[0], ys[0] - ys)
+    assert np.array_equal(xmax - xmax[0], xs[0] - xs)
+
+
+@pytest.mark.parametrize("Lx", [124, 224])
+def test_padded_half_spectra_of_widths_padded_by_one_register_known_shifts(Lx):
+    # the half spectra of Lx and Lx + 1 (the next fast size) have the same number of frequencies,
+    # so the padded width can only come from the shape stored with the reference
+    assert utils.fast_fft_shape(96, Lx, True)[1] == Lx + 1
+    mov, ys, xs = make_shifted_movie(nframes=40, Lx=Lx, smooth=1)
+    ops = suite2p.default_ops()
+    ops.update({'Ly': 96, 'Lx': Lx, 'nonrigid': False, 'real_fft': True, 'pad_fft': True,
+                'smooth_sigma_time': 0, 'norm_frames': False})
+    refAndMasks = register.compute_reference_masks(mov[0].astype(np.float32), ops)
+    assert ops['fft_shape'] == (96, Lx + 1)
+
+    _, ymax, xmax, _, _, _, _ = register.register_frames(refAndMasks, mov.copy(), ops)
+    assert np.array_equal(ymax, ys[0] - ys) and np.array_equal(xmax, xs[0] - xs)
+
+
+def test_nonrigid_reference_stores_the_padded_block_fft_shape():
+    ops = suite2p.default_ops()
+    ops.update({'Ly': 96, 'Lx': 124, 'nonrigid': True, 'block_size': [48, 124], 'real_fft': True, 'pad_fft': True})
+    register.compute_reference_masks(make_shifted_movie(nframes=1, Lx=124)[0][0].astype(np.float32), ops)
+    (y0, y1), (x0, x1) = ops['yblock'][0], ops['xblock'][0]
+    assert ops['fft_shape_NR'] == utils.fast_fft_shape(int(y1 - y0), int(x1 - x0), True)
+
+
+@pytest.mark.parametrize("real", [False, True])
+def test_upsampled_phasecorr_recovers_subpixel_shifts(real):
+    rs = np.random.RandomState(0)
+    img = utils.spatial_smooth(rs.rand(128, 144).astype(np.float32), 4)
+    ys, xs = rs.uniform(-3, 3, 20), rs.uniform(-3, 3, 20)
+    fy, fx = np.fft.fftfreq(128)[:, np.newaxis], np.fft.fftfreq(144)
+    mov = np.stack([np.fft.ifft2(np.fft.fft2(img) * np.exp(-2j * np.pi * (fy * y + fx * x))).real[16:-16, 16:-16]
+                    for y, x in zip(ys, xs)]).astype(np.float32)
+    refImg = img[16:-16, 16:-16]
+    maskMul, maskOffset = rigid.compute_masks(refImg, maskSlope=3)
+    cfRefImg = rigid.phasecorr_reference(refImg, smooth_sigma=1.15, real=real)
+    data = rigid.apply_masks(mov, maskMul, maskOffset, real=real)
+    ymax, xmax, _ = rigid.phasecorr(data, cfRefImg, maxregshift=0.1, smooth_sigma_time=0, subpixel=10)
+    ymax_int, _, _ = rigid.phasecorr(data, cfRefImg, maxregshift=0.1, smooth_sigma_time=0)
+    assert np.abs(ymax - ys).mean() < 0.1 and np.abs(xmax - xs).mean() < 0.1
+    assert np.abs(ymax - ys).mean() < np.abs(ymax_int - ys).mean()
+
+    # phase ramp shifts undo the subpixel shifts, and match shift_frame for integer shifts
+    shifted = rigid.shift_frames_subpixel(mov, ymax, xmax)
+    assert np.abs(shifted[:, 8:-8, 8:-8] - refImg[8:-8, 8:-8]).mean() < 0.05 * refImg.std()
+    frames = make_shifted_movie(nframes=3)[0]
+    expected = np.stack([rigid.shift_frame(frame, dy, dx) for frame, dy, dx in zip(frames.copy(), [2, -3, 0], [-1, 0, 4])])
+    assert np.allclose(rigid.shift_frames_subpixel(frames, [2, -3, 0], [-1, 0, 4]), expected, atol=0.5)
+
+
+def test_subpixel_rigid_registration_stores_fractional_offsets(tmpdir):
+    mov, ys, xs = make_shifted_movie()
+    ops = make_registration_ops(tmpdir, mov, nonrigid=False, subpixel_rigid=True)
+    ops = register.register_binary(ops)
+    assert ops['yoff'].dtype == np.float32
+    assert np.allclose(ops['yoff'] - ops['yoff'][0], ys[0] - ys, atol=0.2)
+    assert np.allclose(ops['xoff'] - ops['xoff'][0], xs[0] - xs, atol=0.2)
+
+
+@pytest.mark.parametrize("dtype", [np.int16, np.float32, np.float64, np.uint16])
+def test_batched_integer_shifts_match_shift_frame(dtype):
+    frames = make_shifted_movie(nframes=12)[0].astype(dtype)
+    rs = np.random.RandomState(1)
+    ymax, xmax = rs.randint(-5, 6, 12).astype(np.int32), rs.randint(-5, 6, 12).astype(np.int32)
+    ymax[:2] = 0  # rows shifted onto themselves
+    expected = np.stack([rigid.shift_frame(frame, dy, dx) for frame, dy, dx in zip(frames.copy(), ymax, xmax)])
+    shifted = rigid.shift_frames_integer(frames, ymax, xmax)
+    assert shifted is frames and shifted.dtype == dtype
+    assert np.array_equal(shifted, expected)
+
+
+def test_batched_integer_shifts_of_non_contiguous_frames_are_in_place():
+    movie = make_shifted_movie(nframes=12, Lx=40)[0].astype(np.float32)
+    frames = movie[:, :, ::2]
+    assert not frames.flags.c_contiguous
+    ymax, xmax = np.arange(-6, 6), np.arange(6, -6, -1)
+    expected = np.stack([rigid.shift_frame(frame, dy, dx) for frame, dy, dx in zip(frames.copy(), ymax, xmax)])
+    rigid.shift_frames_integer(frames, ymax, xmax)
+    assert np.array_equal(movie[:, :, ::2], expected)
+
+
+def test_float64_frames_are_registered_like_int16_frames():
+    mov, ys, xs = make_shifted_movie(nframes=20)
+    ops = suite2p.default_ops()
+    ops.update({'Ly': mov.shape[1], 'Lx': mov.shape[2], 'nonrigid': False, 'norm_frames': False})
+    refAndMasks = register.compute_reference_masks(mov[0].astype(np.float32), ops)
+    expected, ymax, xmax = register.register_frames(refAndMasks, mov.copy(), ops)[:3]
+    frames, ymax64, xmax64 = register.register_frames(refAndMasks, mov.astype(np.float64), ops)[:3]
+    assert frames.dtype == np.float64
+    assert np.array_equal(ymax64, ymax) and np.array_equal(xmax64, xmax)
+    assert np.array_equal(frames, expected)
+
+
+@pytest.mark.parametrize("bilinear", [True, False])
+def test_fused_transform_data_matches_upsampled_shift_maps(bilinear):
+    mov = make_shifted_movie(nframes=6)[0]
+    _, Ly, Lx = mov.shape
+    yblock, xblock, nblocks, _, _ = nonrigid.make_blocks(Ly, Lx, [32, 32])
+    rs = np.random.RandomState(2)
+    ymax1, xmax1 = (3 * rs.randn(2, mov.shape[0], len(yblock))).astype(np.float32)
+    yup, xup = nonrigid.upsample_block_shifts(Lx, Ly, nblocks, xblock, yblock, ymax1, xmax1)
+    if not bilinear:
+        yup, xup = np.round(yup), np.round(xup)
+    mshx, mshy = np.meshgrid(np.arange(Lx, dtype=np.float32), np.arange(Ly, dtype=np.float32))
+    expected = np.zeros(mov.shape, np.float32)
+    nonrigid.shift_coordinates(mov, yup, xup, mshy, mshx, expected)
+    Y = nonrigid.transform_data(mov, nblocks, xblock, yblock, ymax1, xmax1, bilinear=bilinear)
+    assert Y.dtype == np.float32
+    assert np.allclose(Y, expected, atol=1e-2)
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.uint16, np.int32])
+def test_transform_data_converts_other_dtypes_to_float32(dtype):
+    mov = make_shifted_movie(nframes=4)[0]
+    _, Ly, Lx = mov.shape
+    yblock, xblock, nblocks, _, _ = nonrigid.make_blocks(Ly, Lx, [32, 32])
+    ymax1, xmax1 = (3 * np.random.RandomState(3).randn(2, mov.shape[0], len(yblock))).astype(np.float64)
+    expected = nonrigid.transform_data(mov, nblocks, xblock, yblock, ymax1, xmax1)
+    Y = nonrigid.transform_data(mov.astype(dtype), nblocks, xblock, yblock, ymax1, xmax1)
+    assert Y.dtype == np.float32
+    assert np.allclose(Y, expected, atol=1e-3)
+    # the kernel itself only takes int16 and float32 data
+    iy, ix = nonrigid.block_coordinates(Ly, Lx, nblocks, xblock, yblock)
+    with pytest.raises(TypeError):
+        nonrigid.shift_coordinates_blocks(mov.astype(dtype), ymax1.astype(np.float32).reshape(4, *nblocks),
+                                          xmax1.astype(np.float32).reshape(4, *nblocks), iy, ix, True,
+                                          np.zeros(mov.shape, np.float32))
+
+
+@pytest.mark.parametrize("bin_size, n_seeds", [(1, None), (2, 20), (0, 20)])
+def test_initial_reference_is_picked_from_the_most_common_position(bin_size, n_seeds):
+    mov, ys, xs = make_shifted_movie(nframes=120, max_shift=4)
+    still = (ys == ys[0]) & (xs == xs[0])
+    mov[40:] = mov[np.flatnonzero(still)[0]] + np.random.RandomState(1).randint(0, 10, (80,) + mov.shape[1:])
+    refImg = register.pick_initial_reference(mov, bin_size=bin_size, n_seeds=n_seeds)
+    assert refImg.shape == mov.shape[1:]
+    assert np.corrcoef(refImg.ravel(), mov[still][0].ravel())[0, 1] > 0.99
+
+
+def test_reference_refinement_stops_once_correlations_converge(monkeypatch):
+    mov, _, _ = make_shifted_movie(nframes=60)
+    calls = []
+    phasecorr = rigid.phasecorr
+    monkeypatch.setattr(rigid, 'phasecorr', lambda *args, **kwargs: calls.append(1) or phasecorr(*args, **kwargs))
+    for ref_tol, niter in [(0, 8), (1., 2)]:
+        calls.clear()
+        ops = suite2p.default_ops()
+        ops.update({'Ly': mov.shape[1], 'Lx': mov.shape[2], 'ref_tol': ref_tol})
+        refImg = register.compute_reference(ops, mov.copy())
+        assert len(calls) == niter
+        assert refImg.shape == mov.shape[1:]
+
+
+@pytest.mark.parametrize("nonrigid", [False, True])
+def test_lazy_registration_reads_the_registered_frames_from_the_raw_binary(tmpdir, nonrigid):
+    mov, _, _ = make_shifted_movie()
+    results = []
+    for lazy in [False, True]:
+        folder = Path(tmpdir).joinpath(str(lazy))
+        folder.mkdir()
+        ops = make_registration_ops(folder, mov, keep_movie_raw=True, lazy_registration=lazy, nonrigid=nonrigid,
+                                    block_size=[32, 32], raw_file=str(folder.joinpath('data_raw.bin')))
+        Path(ops['reg_file']).rename(ops['raw_file'])
+        ops = register.register_binary(ops)
+        assert Path(ops['reg_file']).exists() != lazy
+        with register.open_registered(ops) as f:
+            assert isinstance(f, io.RegisteredBinaryFile) == lazy
+            batches = [frames for _, frames in f.iter_frames(batch_size=50, dtype=np.int16)]
+            results.append((np.concatenate(batches), f[[3, 70, 8]], ops['yoff'], ops['xoff']))
+    for a, b in zip(*results):
+        assert np.array_equal(a, b)
+
+
+@pytest.mark.parametrize("subpixel_rigid, bidiphase", [(False, 0), (True, 0), (False, 2)])
+def test_lazy_view_of_a_raw_binary_longer_than_its_offsets(tmpdir, subpixel_rigid, bidiphase):
+    # odd width, more raw frames than registered ones, and frames read as float32
+    rs = np.random.RandomState(4)
+    Ly, Lx, nframes, nreg = 40, 37, 30, 25
+    raw = rs.randint(0, 2000, (nframes, Ly, Lx)).astype(np.int16)
+    raw_file = str(Path(tmpdir).joinpath('data_raw.bin'))
+    raw.tofile(raw_file)
+    yblock, xblock, nblocks, _, _ = nonrigid.make_blocks(Ly, Lx, [16, 16])
+    offsets = rs.uniform(-3, 3, (2, nreg)) if subpixel_rigid else rs.randint(-3, 4, (2, nreg))
+    ops = {'yoff': offsets[0], 'xoff': offsets[1], 'yoff1': rs.uniform(-1, 1, (nreg, len(yblock))),
+           'xoff1': rs.uniform(-1, 1, (nreg, len(yblock))), 'nonrigid': True, 'nblocks': nblocks,
+           'yblock': yblock, 'xblock': xblock, 'bilinear_reg': True, 'subpixel_rigid': subpixel_rigid,
+           'bidiphase': bidiphase, 'bidi_corrected': False}
+    expected = io.binary.to_int16(register.shift_frames(raw[:nreg].copy(), ops['yoff'], ops['xoff'],
+                                                        ops['yoff1'], ops['xoff1'], ops))
+
+    with io.RegisteredBinaryFile(Ly=Ly, Lx=Lx, read_filename=raw_file, ops=ops,
+                                 shift_frames=register.shift_frames) as f:
+        assert f.n_frames == nreg
+        assert np.array_equal(f.data, expected)
+        assert np.array_equal(f[[24, 0, 7]], expected[[24, 0, 7]])
+        batches = [frames for _, frames in f.iter_frames(batch_size=8, dtype=np.float32)]
+        assert all(frames.dtype == np.float32 for frames in batches)
+        assert np.array_equal(np.concatenate(batches), expected.astype(np.float32))
+        with pytest.raises(IOError):
+            f.write(expected)
+    # the raw binary is never modified
+    assert np.array_equal(np.fromfile(raw_file, np.int16).reshape(raw.shape), raw)